@@ -4,17 +4,28 @@ import time
 #import data_tools
 # Basic utilities
 import numpy as np
-import pandas as pd
-import pickle
 from pathlib import Path
-# Here is the LSTM model we want to run
-import nextgen_cuda_lstm
-# Configuration file functionality
-import yaml
-# LSTM here is based on PyTorch
-import torch
-from torch import nn
 import sys
+import copy
+import functools
+import threading
+import weakref
+# Note: torch, pandas, yaml and pickle are imported when first needed rather than here, since importing them
+#       (torch in particular) takes far longer than anything else at startup. See _import_torch().
+# LSTM here is based on PyTorch, and this is the LSTM model we want to run
+torch = None
+nextgen_cuda_lstm = None
+
+# Held while an engine is added to a model bundle shared by instances initializing in several threads
+_engines_lock = threading.Lock()
+
+def _locked(method):
+    """Run a method of ``bmi_LSTM`` holding the instance's lock, so threads calling it do not interleave."""
+    @functools.wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked_method
 
 class bmi_LSTM(Bmi):
 
@@ -36,6 +47,21 @@ class bmi_LSTM(Bmi):
         self.streamflow_fms = 0.0
         self.surface_runoff_mm = 0.0
 
+        # Output recorders written to on every update(), see attach_recorder()
+        self._recorders = []
+        # Daily/monthly output aggregators updated on every update(), see lstm_aggregation.py
+        self._aggregators = []
+
+        # Paged state store holding h_t and c_t instead of this instance, see attach_state_store()
+        self.state_store = None
+        # Instances running the model bundle this one runs, this one included, see _use_bundle()
+        self._bundle_users = None
+        # At-rest codec of the states when pickled or saved, see lstm_state_codec.py
+        self.state_codec = 'float32'
+        # Held by update(), the value getters and setters and the other methods that read or change the time, states
+        # or variables, so an instance can be used from several threads (see lstm_thread_pool.py)
+        self._lock = threading.RLock()
+
     #----------------------------------------------
     # Required, static attributes of the model
     #----------------------------------------------
@@ -117,6 +143,20 @@ class bmi_LSTM(Bmi):
                                 'basin_centroid__longitude':['gauge_lon', 'degrees']
                                  }
 
+    #------------------------------------------------------
+    # Numeric types the LSTM can run with, set with "dtype:" in the BMI configuration (default float32).
+    #   The scaled inputs, weights and states are all kept in this type, so update() does no casting.
+    #   bfloat16 is experimental: weights and states stay float32, but the matrix products are done in
+    #   bfloat16 (torch CPU autocast), which is faster on CPUs with native bfloat16 support.
+    #------------------------------------------------------
+    _numeric_dtypes = {'float32': np.float32, 'float64': np.float64, 'bfloat16': np.float32}
+
+    #------------------------------------------------------
+    # Forcings that are summed, rather than averaged, over a model time step longer than the BMI time step
+    #   (e.g. a daily LSTM coupled hourly, see _buffer_forcings()).
+    #------------------------------------------------------
+    _summed_forcings = ['total_precipitation']
+
     #------------------------------------------------------
     # A list of static attributes. Not all these need to be used.
     #------------------------------------------------------
@@ -176,6 +216,10 @@ class bmi_LSTM(Bmi):
         implementation of this function.  In any other cases, just pass the given ``key`` and ``value`` to a nested
         call.
 
+        Once a BMI variable has a backing array, values of the same size (or scalars) are copied into it rather than
+        replacing it, so the arrays returned by ``get_value_ptr()`` stay valid for the lifetime of the instance and a
+        framework can read them without copying or looking them up again.
+
         This supports automatically having a BMI variable be backed by a numpy array, even if it is initialized using a
         scalar, while otherwise maintaining standard behavior.
 
@@ -191,17 +235,42 @@ class bmi_LSTM(Bmi):
         # Have these work explicitly (or else loops)
         if key == '_input_var_names' or key == '_output_var_names':
             super(bmi_LSTM, self).__setattr__(key, value)
-
-        # Pass thru if value is already an array
-        if isinstance(value, np.ndarray):
-            super(bmi_LSTM, self).__setattr__(key, value)
-        # Override to put scalars into ndarray for BMI input/output variables
-        elif key in self._input_var_names or key in self._output_var_names:
-            super(bmi_LSTM, self).__setattr__(key, np.array([value]))
+            return
+
+        if key in self._input_var_names or key in self._output_var_names:
+            # Update an existing backing array in place, only reallocate if the number of values changes
+            backing_array = self.__dict__.get(key)
+            if isinstance(backing_array, np.ndarray) and np.size(value) in (1, backing_array.size):
+                np.copyto(backing_array, np.reshape(value, backing_array.shape) if np.size(value) > 1 else value)
+            elif isinstance(value, np.ndarray):
+                super(bmi_LSTM, self).__setattr__(key, value)
+            else:
+                super(bmi_LSTM, self).__setattr__(key, np.array([value]))
         # By default, use normal behavior
         else:
             super(bmi_LSTM, self).__setattr__(key, value)
 
+    def __getstate__(self):
+        """Pickle the hidden and cell states in the instance's ``state_codec`` (see ``lstm_state_codec.py``)."""
+        state = dict(self.__dict__)
+        state.pop('_lock', None)
+        # An unpickled instance does not run the bundle this one runs
+        state.pop('_bundle_users', None)
+        if state.get('state_codec', 'float32') != 'float32' and state.get('h_t') is not None:
+            import lstm_state_codec
+            state['_encoded_states'] = lstm_state_codec.encode_states(state.pop('h_t'), state.pop('c_t'),
+                                                                      self.state_codec)
+        return state
+
+    def __setstate__(self, state):
+        encoded = state.pop('_encoded_states', None)
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._bundle_users = None
+        if encoded is not None:
+            import lstm_state_codec
+            self.h_t, self.c_t = lstm_state_codec.decode_states(encoded, self._np_dtype)
+
     #------------------------------------------------------------
     #------------------------------------------------------------
     # BMI: Model Control Functions
@@ -213,6 +282,34 @@ class bmi_LSTM(Bmi):
         #NJF ensure this is a Path type so the follow open works as expected
         #When used with NGen, the bmi_cfg_file is just a string...
         bmi_cfg_file = Path(bmi_cfg_file)
+
+        # -------------- Read in the BMI configuration -------------------------#
+        # This will direct all the next moves.
+        if bmi_cfg_file is not None:
+            cfg_bmi = read_bmi_config(bmi_cfg_file)
+        else:
+            print("Error: No configuration provided, nothing to do...")
+
+        self.initialize_from_config(cfg_bmi)
+
+    #-------------------------------------------------------------------
+    def initialize_from_config( self, cfg_bmi, model_bundle=None ):
+        """
+        Initialize the model from an already parsed BMI configuration.
+
+        This does everything ``initialize()`` does after reading the BMI configuration file. A ``model_bundle`` from
+        ``load_model_bundle()`` can be passed in so that many instances running the same trained LSTM share one copy of
+        the training configuration, scaler and weights (see ``lstm_bulk_initialize.py``). The bundle's LSTM module only
+        holds weights, the states are kept on each instance, so sharing it is safe.
+
+        Parameters
+        ----------
+        cfg_bmi : dict
+            BMI configuration, as returned by ``read_bmi_config()``.
+        model_bundle : dict, optional
+            Trained model bundle, as returned by ``load_model_bundle()``. Loaded from ``cfg_bmi['train_cfg_file']``
+            if not given.
+        """
         # ----- Create some lookup tabels from the long variable names --------#
         self._var_name_map_long_first = {long_name:self._var_name_units_map[long_name][0] for \
                                          long_name in self._var_name_units_map.keys()}
@@ -221,60 +318,72 @@ class bmi_LSTM(Bmi):
         self._var_units_map = {long_name:self._var_name_units_map[long_name][1] for \
                                           long_name in self._var_name_units_map.keys()}
         
+        # -------------- One instance can run several basins --------------------#
+        # -------------- if the basin keys of the config are lists -------------#
+        self.cfg_bmi = cfg_bmi
+        basin_id = self.cfg_bmi.get('basin_id')
+        self.n_basins = len(basin_id) if isinstance(basin_id, list) else 1
+
         # -------------- Initalize all the variables --------------------------# 
         # -------------- so that they'll be picked up with the get functions --#
         for var_name in list(self._var_name_units_map.keys()):
-            # ---------- All the variables are single values ------------------#
+            # ---------- All the variables hold one value per basin -----------#
             # ---------- so just set to zero for now.        ------------------#
             #self._values[var_name] = 0
-            setattr( self, var_name, 0 )
-        
-        # -------------- Read in the BMI configuration -------------------------#
-        # This will direct all the next moves.
-        if bmi_cfg_file is not None:
-
-            with bmi_cfg_file.open('r') as fp:
-                cfg = yaml.safe_load(fp)
-            self.cfg_bmi = self._parse_config(cfg)
-        else:
-            print("Error: No configuration provided, nothing to do...")
+            setattr( self, var_name, np.zeros(self.n_basins) )
+
+        # -------------- Optional daily/monthly aggregation of the outputs ----#
+        # -------------- with the aggregated values as extra outputs ----------#
+        self._aggregators = []
+        self._output_var_names = list(bmi_LSTM._output_var_names)
+        aggregation_periods = self.cfg_bmi.get('aggregation_periods') or []
+        if aggregation_periods:
+            import lstm_aggregation
+            time_origin = self.cfg_bmi.get('time_origin', lstm_aggregation.default_time_origin)
+        for period in aggregation_periods:
+            aggregator = lstm_aggregation.PeriodAggregator(period, self.n_basins, time_origin)
+            for var_name, units in lstm_aggregation.aggregated_var_names(period).items():
+                self._output_var_names.append(var_name)
+                self._var_name_map_long_first[var_name] = var_name
+                self._var_name_map_short_first[var_name] = var_name
+                self._var_units_map[var_name] = units
+                setattr( self, var_name, np.zeros(self.n_basins) )
+            self._aggregators.append(aggregator)
+
+        self.set_numeric_type(self.cfg_bmi.get('dtype', 'float32'))
+        self.state_codec = self.cfg_bmi.get('state_codec', 'float32')
         
         # ------------- Load in the configuration file for the specific LSTM --#
         # This will include all the details about how the model was trained
         # Inputs, outputs, hyper-parameters, scalers, weights, etc. etc.
-        self.get_training_configurations()
+        # An onnx_file (see lstm_onnx.py) is run with ONNX Runtime, without torch
+        if model_bundle is None:
+            model_bundle = load_config_bundle(self.cfg_bmi)
+        self.get_training_configurations(model_bundle)
         self.get_scaler_values()
         
-        # ------------- Initialize an LSTM model ------------------------------#
-        self.lstm = nextgen_cuda_lstm.Nextgen_CudaLSTM(input_size=self.input_size, 
-                                                       hidden_layer_size=self.hidden_layer_size, 
-                                                       output_size=self.output_size, 
-                                                       batch_size=1, 
-                                                       seq_length=1)
-
-        # ------------ Load in the trained weights ----------------------------#
-        # Save the default model weights. We need to make sure we have the same keys.
-        default_state_dict = self.lstm.state_dict()
-
-        # Trained model weights from Neuralhydrology.
-        trained_model_file = '..' / self.cfg_train['run_dir'] / 'model_epoch{}.pt'.format(str(self.cfg_train['epochs']).zfill(3))
-        trained_state_dict = torch.load(trained_model_file, map_location=torch.device('cpu'))
-
-        # Changing the name of the head weights, since different in NH
-        trained_state_dict['head.weight'] = trained_state_dict.pop('head.net.0.weight')
-        trained_state_dict['head.bias'] = trained_state_dict.pop('head.net.0.bias')
-        trained_state_dict = {x:trained_state_dict[x] for x in default_state_dict.keys()}
-
-        # Load in the trained weights.
-        self.lstm.load_state_dict(trained_state_dict)
+        # ------------- LSTM model with the trained weights loaded ------------#
+        # ------------- and the inference engine that runs it -----------------#
+        self.engine_name = self.cfg_bmi.get('engine', 'onnxruntime' if model_bundle['lstm'] is None else 'torch')
+        self.engine = self._get_engine(model_bundle)
+        self.lstm = self.engine.lstm
+        self._use_bundle(model_bundle)
 
         # ------------- Initialize the values for the input to the LSTM  -----#
         self.set_static_attributes()
         self.initialize_forcings()
+
+        # ------------- The LSTM can run on a longer time step than BMI -------#
+        # e.g. a daily model coupled hourly. The forcings of each BMI step are then
+        # kept in a ring buffer and the LSTM only runs once a model step is complete.
+        self.steps_per_model_step = self._steps_per_model_step()
+        self._forcing_buffer = np.zeros((self.steps_per_model_step, self.n_basins,
+                                         len(self.cfg_train['dynamic_inputs'])))
+        self._n_buffered = 0
         
         if self.cfg_bmi['initial_state'] == 'zero':
-            self.h_t = torch.zeros(1, self.batch_size, self.hidden_layer_size).float()
-            self.c_t = torch.zeros(1, self.batch_size, self.hidden_layer_size).float()
+            self.h_t = np.zeros((1, self.batch_size, self.hidden_layer_size), dtype=self._np_dtype)
+            self.c_t = np.zeros((1, self.batch_size, self.hidden_layer_size), dtype=self._np_dtype)
 
         # ------------- Start a simulation time  -----------------------------#
         # jmframe: Since the simulation time here doesn't really matter. 
@@ -284,25 +393,38 @@ class bmi_LSTM(Bmi):
 
         # ----------- The output is area normalized, this is needed to un-normalize it
         #                         mm->m                             km2 -> m2          hour->s    
-        self.output_factor_cms =  (1/1000) * (self.cfg_bmi['area_sqkm'] * 1000*1000) * (1/3600)
+        self.output_factor_cms =  (1/1000) * (self._basin_values('area_sqkm') * 1000*1000) * (1/3600)
 
         # Gather verbosity lvl from bmi-config for stdout printing, etc.    
         self.verbose = self.cfg_bmi['verbose']
 
     #------------------------------------------------------------ 
+    @_locked
     def update(self):
-        with torch.no_grad():
+        # With a model time step longer than the BMI time step, the outputs of the last
+        # complete model step are held (spread evenly over its BMI steps) until the next one
+        model_step_complete = self._buffer_forcings() if self.steps_per_model_step > 1 else True
 
+        if model_step_complete:
             self.create_scaled_input_tensor()
 
-            self.lstm_output, self.h_t, self.c_t = self.lstm.forward(self.input_tensor, self.h_t, self.c_t)
-            
+            h_t, c_t = self._get_states()
+            self.lstm_output, h_t, c_t = self.engine.step(self.input_array_scaled, h_t, c_t)
+            self._set_states(h_t, c_t)
+
             self.scale_output()
-            
-            #self.t += self._time_step_size
-            self.t += self.get_time_step()
+
+        #self.t += self._time_step_size
+        self.t += self.get_time_step()
+
+        for aggregator in self._aggregators:
+            aggregator.update(self)
+
+        for recorder, first_basin in self._recorders:
+            recorder.record(self, first_basin)
 
     #------------------------------------------------------------ 
+    @_locked
     def update_frac(self, time_frac):
         """Update model by a fraction of a time step.
         Parameters
@@ -318,6 +440,7 @@ class bmi_LSTM(Bmi):
         self._time_step_size = time_step
 
     #------------------------------------------------------------ 
+    @_locked
     def update_until(self, then):
         """Update model until a particular time.
         Parameters
@@ -341,9 +464,152 @@ class bmi_LSTM(Bmi):
     #    for t in range(first_update, last_update):
     #        self.update()
     #------------------------------------------------------------    
+    @_locked
     def finalize( self ):
         """Finalize model."""
+        # Emit the last, possibly incomplete, aggregation periods
+        for aggregator in self._aggregators:
+            if aggregator.n_steps > 0:
+                aggregator.close(self)
+        for recorder, _ in self._recorders:
+            recorder.flush()
         self._model = None
+
+    #------------------------------------------------------------ 
+    @_locked
+    def reload_model(self, model_bundle):
+        """
+        Swap to the weights and scalers of another trained model, e.g. a newer training epoch, while running.
+
+        The hidden and cell states, the time and the BMI variables are kept, so the new model must have the same
+        hidden size, inputs and time step. Everything is checked and prepared before the instance is changed, so on an
+        error it keeps running the old model. See ``lstm_model_registry.py`` for reloading many instances.
+
+        Parameters
+        ----------
+        model_bundle : dict
+            Trained model bundle, as returned by ``load_model_bundle()``.
+        """
+        self.check_reload(model_bundle)
+        scalers = scaler_values(model_bundle['cfg_train'], model_bundle['train_data_scaler'], self._np_dtype)
+        engine = self._get_engine(model_bundle)
+
+        self.cfg_train = model_bundle['cfg_train']
+        self.train_data_scaler = model_bundle['train_data_scaler']
+        self.input_mean, self.input_std, self.out_mean, self.out_std = scalers
+        self.engine = engine
+        self.lstm = engine.lstm
+        self._use_bundle(model_bundle)
+
+    #------------------------------------------------------------ 
+    def check_reload(self, model_bundle):
+        """Raise a ValueError if this instance cannot keep its states with the model of ``model_bundle``."""
+        cfg_train = model_bundle['cfg_train']
+        if cfg_train['hidden_size'] != self.hidden_layer_size:
+            raise ValueError("Cannot reload a model with hidden size {} into an instance with hidden size {}".format(
+                             cfg_train['hidden_size'], self.hidden_layer_size))
+        if cfg_train['dynamic_inputs'] + cfg_train['static_attributes'] != self.all_lstm_inputs:
+            raise ValueError("Cannot reload a model with other inputs than " + ', '.join(self.all_lstm_inputs))
+        if cfg_train.get('use_frequencies') != self.cfg_train.get('use_frequencies'):
+            raise ValueError("Cannot reload a model with another time step")
+
+    #------------------------------------------------------------ 
+    @_locked
+    def attach_state_store(self, store):
+        """
+        Keep the hidden and cell states in a paged state store instead of this instance.
+
+        The current states are moved to the store, and are paged in from it for every ``update()``.
+
+        Parameters
+        ----------
+        store : lstm_state_store.StateStore
+            Store with rows for this instance's basins, with pages of the type this instance runs with.
+        """
+        if store.dtype != np.dtype(self._np_dtype):
+            raise ValueError("A state store of {} pages cannot hold the states of an instance running in {}".format(
+                             store.dtype, np.dtype(self._np_dtype)))
+        h_t, c_t = self._get_states()
+        self._state_rows = store.basin_rows(self.cfg_bmi['basin_id'])
+        store.put(self._state_rows, h_t, c_t)
+        self.state_store = store
+        self.h_t = None
+        self.c_t = None
+
+    #------------------------------------------------------------ 
+    @_locked
+    def save_states(self, states_file, codec=None):
+        """
+        Checkpoint the hidden and cell states, the time and the buffered forcings of this instance's basins.
+
+        Parameters
+        ----------
+        states_file : str or Path
+            ``.npz`` file to write.
+        codec : str or lstm_state_codec.StateCodec, optional
+            At-rest codec of the states, by default the instance's ``state_codec``.
+        """
+        import lstm_state_codec
+        encoded = lstm_state_codec.encode_states(*self._get_states(), codec or self.state_codec)
+        np.savez(states_file, basin_id=np.atleast_1d(self.cfg_bmi['basin_id']).astype(str), t=self.t,
+                 forcing_buffer=self._forcing_buffer, n_buffered=self._n_buffered, **encoded)
+
+    #------------------------------------------------------------ 
+    @_locked
+    def load_states(self, states_file):
+        """
+        Restart from a checkpoint of ``save_states()``.
+
+        The checkpoint is matched by basin id, so it can hold more basins than this instance, e.g. a snapshot of a
+        whole domain loaded by the instances of its parts.
+        """
+        import lstm_state_codec
+        basin_ids = np.atleast_1d(self.cfg_bmi['basin_id']).astype(str)
+        with np.load(states_file) as checkpoint:
+            rows = {basin_id: row for row, basin_id in enumerate(checkpoint['basin_id'])}
+            missing = [basin_id for basin_id in basin_ids if basin_id not in rows]
+            if missing:
+                raise ValueError("No states for basins {} in {}".format(', '.join(missing), states_file))
+            basin_rows = [rows[basin_id] for basin_id in basin_ids]
+            h_t, c_t = lstm_state_codec.decode_states({'codec': checkpoint['codec'],
+                                                       'block_size': checkpoint['block_size'],
+                                                       'records': checkpoint['records'][basin_rows]},
+                                                      self._np_dtype)
+            if checkpoint['forcing_buffer'].shape[0] == self.steps_per_model_step:
+                self._forcing_buffer = checkpoint['forcing_buffer'][:, basin_rows]
+                self._n_buffered = int(checkpoint['n_buffered'])
+            self.t = checkpoint['t'].item()
+        self._set_states(h_t, c_t)
+
+    #------------------------------------------------------------ 
+    def _get_states(self):
+        """The hidden and cell states, paged in from the state store if one is attached."""
+        if self.state_store is None:
+            return self.h_t, self.c_t
+        return self.state_store.get(self._state_rows)
+
+    #------------------------------------------------------------ 
+    def _set_states(self, h_t, c_t):
+        """Keep new hidden and cell states, in the state store if one is attached."""
+        if self.state_store is None:
+            self.h_t = h_t
+            self.c_t = c_t
+        else:
+            self.state_store.put(self._state_rows, h_t, c_t)
+
+    #------------------------------------------------------------ 
+    def attach_recorder(self, recorder, first_basin=0):
+        """
+        Record the output variables after every ``update()``.
+
+        Parameters
+        ----------
+        recorder : lstm_output_recorder.OutputRecorder
+            Recorder to write to. Several models can share a recorder, each with its own ``first_basin``.
+        first_basin : int
+            Basin index in the recorder of this model's (first) basin.
+        """
+        self._recorders.append((recorder, first_basin))
     
     #------------------------------------------------------------
     #------------------------------------------------------------
@@ -352,19 +618,18 @@ class bmi_LSTM(Bmi):
     #------------------------------------------------------------
 
     #-------------------------------------------------------------------
-    def get_training_configurations(self):
-        if self.cfg_bmi['train_cfg_file'] is not None:
-            with self.cfg_bmi['train_cfg_file'].open('r') as fp:
-                cfg = yaml.safe_load(fp)
-            self.cfg_train = self._parse_config(cfg)
+    def get_training_configurations(self, model_bundle=None):
+        if model_bundle is None:
+            model_bundle = load_model_bundle(self.cfg_bmi['train_cfg_file'])
+        self.cfg_train = model_bundle['cfg_train']
 
         # Collect the LSTM model architecture details from the configuration file
         self.input_size        = len(self.cfg_train['dynamic_inputs']) + len(self.cfg_train['static_attributes'])
         self.hidden_layer_size = self.cfg_train['hidden_size']
         self.output_size       = len(self.cfg_train['target_variables']) 
 
-        # WARNING: This implimentation of the LSTM can only handle a batch size of 1
-        self.batch_size        = 1 #self.cfg_train['batch_size']
+        # The batch is the basins of this instance, not the training batch size
+        self.batch_size        = self.n_basins #self.cfg_train['batch_size']
 
         # Including a list of the model input names.
         self.all_lstm_inputs = []
@@ -372,64 +637,341 @@ class bmi_LSTM(Bmi):
         self.all_lstm_inputs.extend(self.cfg_train['static_attributes'])
         
         # Scaler data from the training set. This is used to normalize the data (input and output).
-        with open('..' / self.cfg_train['run_dir'] / 'train_data' / 'train_data_scaler.p', 'rb') as fb:
-            self.train_data_scaler = pickle.load(fb)
+        self.train_data_scaler = model_bundle['train_data_scaler']
 
     #------------------------------------------------------------ 
     def get_scaler_values(self):
 
         """Mean and standard deviation for the inputs and LSTM outputs""" 
 
-        self.out_mean = self.train_data_scaler['xarray_feature_center'][self.cfg_train['target_variables'][0]].values
-        self.out_std = self.train_data_scaler['xarray_feature_scale'][self.cfg_train['target_variables'][0]].values
-
-        self.input_mean = []
-        self.input_mean.extend([self.train_data_scaler['xarray_feature_center'][x].values for x in self.cfg_train['dynamic_inputs']])
-        self.input_mean.extend([self.train_data_scaler['attribute_means'][x] for x in self.cfg_train['static_attributes']])
-        self.input_mean = np.array(self.input_mean)
-
-        self.input_std = []
-        self.input_std.extend([self.train_data_scaler['xarray_feature_scale'][x].values for x in self.cfg_train['dynamic_inputs']])
-        self.input_std.extend([self.train_data_scaler['attribute_stds'][x] for x in self.cfg_train['static_attributes']]) 
-        self.input_std = np.array(self.input_std)
+        self.input_mean, self.input_std, self.out_mean, self.out_std = scaler_values(self.cfg_train,
+                                                                                     self.train_data_scaler,
+                                                                                     self._np_dtype)
 
     #------------------------------------------------------------ 
     def create_scaled_input_tensor(self):
         
         # TODO: Choose to store values in dictionary or not.
-        self.input_array = np.array([getattr(self, self._var_name_map_short_first[x]) for x in self.all_lstm_inputs])
+        # One row per basin, scalar values (e.g. static attributes shared by all basins) are broadcast
+        self.input_array = np.empty((self.n_basins, self.input_size), dtype=self._np_dtype)
+        for i, x in enumerate(self.all_lstm_inputs):
+            self.input_array[:, i] = getattr(self, self._var_name_map_short_first[x])
+        if self.steps_per_model_step > 1:
+            self.input_array[:, :len(self.cfg_train['dynamic_inputs'])] = self._model_step_forcings()
         #self.input_array = np.array([self._values[self._var_name_map_short_first[x]] for x in self.all_lstm_inputs])
         
         self.input_array_scaled = (self.input_array - self.input_mean) / self.input_std 
-        self.input_tensor = torch.tensor(self.input_array_scaled)
         
     #------------------------------------------------------------ 
     def scale_output(self):
 
-        if self.cfg_train['target_variables'][0] == 'qobs_mm_per_hour':
-            self.surface_runoff_mm = (self.lstm_output[0,0,0].numpy().tolist() * self.out_std + self.out_mean)
-
-        elif self.cfg_train['target_variables'][0] == 'QObs(mm/d)':
-            self.surface_runoff_mm = (self.lstm_output[0,0,0].numpy().tolist() * self.out_std + self.out_mean) * (1/24)
-            
-        # Bound the runoff to zero or obs, as negative values are illogical
-        #if self.surface_runoff_mm < 0.0: self.surface_runoff_mm = 0.0
-        #np.maximum( self.surface_runoff_mm, 0.0, self.surface_runoff_mm)
-        self.surface_runoff_mm = max(self.surface_runoff_mm,0.0)
+        # Un-scale, convert to mm per time step and bound the runoff to zero, as negative values are illogical
+        runoff_mm = self._output_to_runoff_mm(self.lstm_output[0, :, 0].astype(np.float64))
 
         #self._values['land_surface_water__runoff_depth'] = self.surface_runoff_mm/1000.0
-        setattr(self, 'land_surface_water__runoff_depth', self.surface_runoff_mm/1000.0)
-        self.streamflow_cms = self.surface_runoff_mm * self.output_factor_cms
+        setattr(self, 'land_surface_water__runoff_depth', runoff_mm/1000.0)
+        streamflow_cms = runoff_mm * self.output_factor_cms
+
+        # Keep these as plain numbers for a single basin, as they are used that way in the examples
+        if self.n_basins == 1:
+            self.surface_runoff_mm = float(runoff_mm[0])
+            self.streamflow_cms = float(streamflow_cms[0])
+        else:
+            self.surface_runoff_mm = runoff_mm
+            self.streamflow_cms = streamflow_cms
 
         #self._values['land_surface_water__runoff_volume_flux'] = self.streamflow_cms
         setattr(self, 'land_surface_water__runoff_volume_flux', self.streamflow_cms)
 
+    #-------------------------------------------------------------------
+    def _steps_per_model_step(self):
+        """
+        Number of BMI time steps in one time step of the LSTM.
+
+        The LSTM time step is the highest frequency (shortest time step) in ``use_frequencies`` of the training
+        configuration, e.g. ``['1D']`` for a daily model. Without it, the LSTM runs on the BMI time step.
+        """
+        frequencies = self.cfg_train.get('use_frequencies')
+        if not frequencies:
+            return 1
+        if isinstance(frequencies, list):
+            frequencies = min(frequencies, key=_frequency_hours)
+        steps = _frequency_hours(frequencies) / self.get_time_step()
+        if steps < 1 or steps != int(steps):
+            raise ValueError("The LSTM time step ({}) must be a whole number of BMI time steps ({} {})".format(
+                             frequencies, self.get_time_step(), self.get_time_units()))
+        return int(steps)
+
+    #-------------------------------------------------------------------
+    def _buffer_forcings(self):
+        """Add the current forcings to the ring buffer of the model step, True when the model step is complete."""
+        slot = self._n_buffered
+        for i, x in enumerate(self.cfg_train['dynamic_inputs']):
+            self._forcing_buffer[slot, :, i] = getattr(self, self._var_name_map_short_first[x])
+        self._n_buffered = (slot + 1) % self.steps_per_model_step
+        return self._n_buffered == 0
+
+    #-------------------------------------------------------------------
+    def _model_step_forcings(self):
+        """Forcings of the completed model step: the sums (``_summed_forcings``) or means of the buffered values."""
+        summed = np.array([x in self._summed_forcings for x in self.cfg_train['dynamic_inputs']])
+        return np.where(summed, self._forcing_buffer.sum(axis=0), self._forcing_buffer.mean(axis=0))
+
     #-------------------------------------------------------------------
     def read_initial_states(self):
         h_t = np.genfromtxt(self.h_t_init_file, skip_header=1, delimiter=",")[:,1]
-        self.h_t = torch.tensor(h_t).view(1,1,-1)
+        self.h_t = h_t.astype(self._np_dtype).reshape(1,1,-1)
         c_t = np.genfromtxt(self.c_t_init_file, skip_header=1, delimiter=",")[:,1]
-        self.c_t = torch.tensor(c_t).view(1,1,-1)
+        self.c_t = c_t.astype(self._np_dtype).reshape(1,1,-1)
+
+    #-------------------------------------------------------------------
+    def _get_engine(self, model_bundle):
+        """
+        Inference engine of this instance's ``engine_name`` and numeric type (see ``lstm_engines.py``).
+
+        Engines hold no states, so they are kept in the model bundle and shared by all the instances using it. The
+        bundle's LSTM is float32, the engines of other types run a converted copy of it. A bundle from
+        ``lstm_onnx.load_onnx_bundle()`` has no torch LSTM, only an ONNX file for the onnxruntime engine.
+        """
+        import lstm_engines
+        with _engines_lock:
+            engines = model_bundle.setdefault('engines', {})
+            key = (self.engine_name, self.dtype)
+            if key not in engines:
+                lstm = model_bundle['lstm']
+                if lstm is None:
+                    lstm = model_bundle['onnx_file']
+                elif self._np_dtype != np.float32:
+                    _import_torch()
+                    lstm = copy.deepcopy(lstm).to(getattr(torch, np.dtype(self._np_dtype).name))
+                engines[key] = lstm_engines.make_engine(self.engine_name, lstm, self._np_dtype, self.bfloat16_matmul)
+            return engines[key]
+
+    #-------------------------------------------------------------------
+    def _use_bundle(self, model_bundle):
+        """
+        Add this instance to the users of a model bundle, a weak set kept in the bundle, and remove it from those of
+        the bundle it ran before. ``lstm_model_registry`` never evicts a bundle with live users.
+        """
+        with _engines_lock:
+            users = model_bundle.setdefault('users', weakref.WeakSet())
+            if self.__dict__.get('_bundle_users') is not None and self._bundle_users is not users:
+                self._bundle_users.discard(self)
+            users.add(self)
+            self._bundle_users = users
+
+    #-------------------------------------------------------------------
+    def set_numeric_type(self, dtype):
+        """
+        Set the numeric type the LSTM runs with.
+
+        Parameters
+        ----------
+        dtype : str
+            One of the keys of ``_numeric_dtypes``: 'float32', 'float64' or the experimental 'bfloat16'. If the CPU
+            has no native bfloat16 support, 'bfloat16' falls back to 'float32'.
+        """
+        if dtype not in self._numeric_dtypes:
+            raise ValueError("dtype must be one of {}, not '{}'".format(list(self._numeric_dtypes), dtype))
+
+        if dtype == 'bfloat16' and not _cpu_supports_bfloat16():
+            print("Warning: This CPU has no native bfloat16 support, running the LSTM in float32 instead.")
+            dtype = 'float32'
+
+        self.dtype = dtype
+        self._np_dtype = self._numeric_dtypes[dtype]
+        self.bfloat16_matmul = (dtype == 'bfloat16')
+
+    #-------------------------------------------------------------------
+    def compare_to_float64(self, dynamic_inputs):
+        """
+        Compare the runoff of this instance with the float64 reference.
+
+        Runs a sequence of forcings through the LSTM in this instance's numeric type and through a float64 copy of
+        it, both starting from the current states. The instance itself (states, time and outputs) is not changed. A
+        model loaded from an ``onnx_file`` has no torch LSTM to copy, and raises a ValueError, as does an LSTM with a
+        longer time step than the BMI (see ``run_sequence()``).
+
+        Parameters
+        ----------
+        dynamic_inputs : np.ndarray
+            Forcings, as for ``run_sequence()``.
+
+        Returns
+        -------
+        dict
+            ``max_abs_error`` and ``mean_abs_error`` of the runoff depth (mm) and the two runoff series,
+            ``runoff_mm`` and ``reference_runoff_mm``, with shape (number of time steps, number of basins).
+        """
+        if self.steps_per_model_step > 1:
+            raise ValueError("compare_to_float64() runs the LSTM on the BMI time step, like run_sequence()")
+        _import_torch()
+        if not isinstance(self.lstm, torch.nn.Module):
+            raise ValueError("compare_to_float64() runs a float64 copy of the trained torch LSTM, which the {} engine "
+                             "of an ONNX model does not have".format(self.engine_name))
+        inputs = self._input_sequence(dynamic_inputs)
+        input_mean = self.input_mean.astype(np.float64)
+        input_std = self.input_std.astype(np.float64)
+        inputs_scaled = (inputs - input_mean) / input_std
+
+        h_t, c_t = self._get_states()
+        reference_lstm = copy.deepcopy(self.lstm).double()
+        with torch.no_grad():
+            reference_output, _, _ = reference_lstm.forward(torch.from_numpy(inputs_scaled),
+                                                            torch.from_numpy(h_t.astype(np.float64)),
+                                                            torch.from_numpy(c_t.astype(np.float64)))
+        output, _, _ = self.engine.sequence(inputs_scaled.astype(self._np_dtype), h_t, c_t)
+
+        runoff_mm = self._output_to_runoff_mm(output[:, :, 0].astype(np.float64))
+        reference_runoff_mm = self._output_to_runoff_mm(reference_output.numpy()[:, :, 0])
+        abs_error = np.abs(runoff_mm - reference_runoff_mm)
+
+        return {'max_abs_error': abs_error.max(),
+                'mean_abs_error': abs_error.mean(),
+                'runoff_mm': runoff_mm,
+                'reference_runoff_mm': reference_runoff_mm}
+
+    #-------------------------------------------------------------------
+    @_locked
+    def run_sequence(self, dynamic_inputs):
+        """
+        Run the LSTM over a whole sequence of forcings in a single forward pass.
+
+        This gives the same result as setting the forcings and calling ``update()`` once per time step, without the
+        per step overhead. Afterwards the states, current time and BMI input and output variables are the same as
+        after the last of those ``update()`` calls.
+
+        Parameters
+        ----------
+        dynamic_inputs : np.ndarray
+            Forcings with shape (number of time steps, number of dynamic inputs), ordered as
+            ``cfg_train['dynamic_inputs']``, or (number of time steps, number of basins, number of dynamic inputs) for
+            an instance with several basins. The static attributes are taken from this instance.
+
+        Returns
+        -------
+        np.ndarray
+            Runoff depth (mm) for each time step, with a second dimension for the basins if ``dynamic_inputs`` has one.
+        """
+        return self._run_sequence(dynamic_inputs)[0]
+
+    #-------------------------------------------------------------------
+    @_locked
+    def _run_sequence(self, dynamic_inputs):
+        """``run_sequence()``, also returning the LSTM outputs with shape (time, basin, 1)."""
+        if self.steps_per_model_step > 1:
+            raise ValueError("run_sequence() runs the LSTM on the BMI time step, use update() for an LSTM with a "
+                             "longer time step")
+        inputs = self._input_sequence(dynamic_inputs).astype(self._np_dtype)
+        inputs_scaled = (inputs - self.input_mean) / self.input_std
+
+        output, h_t, c_t = self.engine.sequence(inputs_scaled, *self._get_states())
+        self._finish_sequence(dynamic_inputs, output, h_t, c_t)
+
+        runoff_mm = self._output_to_runoff_mm(output[:, :, 0].astype(np.float64))
+        return (runoff_mm if np.ndim(dynamic_inputs) == 3 else runoff_mm[:, 0]), output
+
+    #-------------------------------------------------------------------
+    def _finish_sequence(self, dynamic_inputs, output, h_t, c_t):
+        """
+        Leave the states, time and BMI variables as ``update()`` would have after the last time step of a sequence,
+        from the LSTM outputs of the sequence, with shape (time, basin, 1), and the states after it.
+
+        With aggregation periods or output recorders, every time step of the sequence is passed through them as
+        ``update()`` would have, otherwise only the last one is set.
+        """
+        self._set_states(h_t, c_t)
+        dynamic_inputs = np.asarray(dynamic_inputs)
+        input_ptrs = [self.get_value_ptr(self._var_name_map_short_first[x]) for x in self.cfg_train['dynamic_inputs']]
+        first_step = 0 if self._aggregators or self._recorders else len(dynamic_inputs) - 1
+        self.t += first_step * self.get_time_step()
+        for step in range(first_step, len(dynamic_inputs)):
+            for i, input_ptr in enumerate(input_ptrs):
+                input_ptr[:] = dynamic_inputs[step, ..., i]
+            self.lstm_output = output[step:step + 1]
+            self.scale_output()
+            self.t += self.get_time_step()
+
+            for aggregator in self._aggregators:
+                aggregator.update(self)
+
+            for recorder, first_basin in self._recorders:
+                recorder.record(self, first_basin)
+
+    #-------------------------------------------------------------------
+    @_locked
+    def run_scenarios(self, scenario_inputs, basin=0):
+        """
+        Run an ensemble of forcing scenarios from the current state of a basin.
+
+        The hidden and cell states of the basin are broadcast to one batch row per scenario, and all scenarios are run
+        as a single batched sequence through the LSTM. This instance (states, time and outputs) is not changed, so
+        forecasts can be branched off a running model without copying or pickling it.
+
+        Parameters
+        ----------
+        scenario_inputs : np.ndarray
+            Forcings with shape (number of scenarios, number of time steps, number of dynamic inputs), ordered as
+            ``cfg_train['dynamic_inputs']``, e.g. the members of a meteorological ensemble.
+        basin : int
+            Index of the basin whose states and static attributes are used.
+
+        Returns
+        -------
+        np.ndarray
+            Runoff depth (mm) with shape (number of scenarios, number of time steps).
+        """
+        if self.steps_per_model_step > 1:
+            raise ValueError("run_scenarios() runs the LSTM on the BMI time step, like run_sequence()")
+        scenario_inputs = np.asarray(scenario_inputs, dtype=np.float64)
+        n_scenarios, n_steps, _ = scenario_inputs.shape
+
+        static_inputs = [np.atleast_1d(getattr(self, self._var_name_map_short_first[x]))[basin]
+                         for x in self.cfg_train['static_attributes']]
+        inputs = np.concatenate([scenario_inputs,
+                                 np.broadcast_to(np.array(static_inputs, dtype=np.float64),
+                                                 (n_scenarios, n_steps, len(static_inputs)))], axis=2)
+        # The LSTM takes (time, batch, input)
+        inputs = np.ascontiguousarray(inputs.transpose(1, 0, 2)).astype(self._np_dtype)
+        inputs_scaled = (inputs - self.input_mean) / self.input_std
+
+        h_t, c_t = self._get_states()
+        h_t = np.repeat(h_t[:, basin:basin+1, :], n_scenarios, axis=1)
+        c_t = np.repeat(c_t[:, basin:basin+1, :], n_scenarios, axis=1)
+        output, _, _ = self.engine.sequence(inputs_scaled, h_t, c_t)
+
+        return self._output_to_runoff_mm(output[:, :, 0].T.astype(np.float64))
+
+    #-------------------------------------------------------------------
+    def _input_sequence(self, dynamic_inputs):
+        """
+        Unscaled LSTM inputs for a sequence of forcings: the forcings followed by this instance's static attributes.
+
+        ``dynamic_inputs`` has shape (number of time steps, number of dynamic inputs) for a single basin, or (number of
+        time steps, number of basins, number of dynamic inputs). Returns a float64 array with shape (number of time
+        steps, number of basins, input size), ordered as ``all_lstm_inputs``.
+        """
+        dynamic_inputs = np.asarray(dynamic_inputs, dtype=np.float64)
+        if dynamic_inputs.ndim == 2:
+            dynamic_inputs = dynamic_inputs[:, np.newaxis, :]
+        n_steps, n_basins, _ = dynamic_inputs.shape
+        static_inputs = np.stack([np.broadcast_to(getattr(self, self._var_name_map_short_first[x]), (n_basins,))
+                                  for x in self.cfg_train['static_attributes']], axis=-1)
+        return np.concatenate([dynamic_inputs,
+                               np.broadcast_to(static_inputs, (n_steps,) + static_inputs.shape)], axis=2)
+
+    #-------------------------------------------------------------------
+    def _basin_values(self, key):
+        """Values of a BMI configuration key for each basin, a scalar value is used for all the basins."""
+        return np.broadcast_to(np.asarray(self.cfg_bmi[key], dtype=np.float64), (self.n_basins,))
+
+    #-------------------------------------------------------------------
+    def _output_to_runoff_mm(self, lstm_output):
+        """Convert scaled LSTM outputs (array) to runoff depth in mm per time step, as ``scale_output()`` does."""
+        runoff_mm = lstm_output * self.out_std + self.out_mean
+        if self.cfg_train['target_variables'][0] == 'QObs(mm/d)':
+            runoff_mm = runoff_mm * (1/24)
+        return np.maximum(runoff_mm, 0.0)
 
     #---------------------------------------------------------------------------- 
     def set_static_attributes(self):
@@ -441,7 +983,9 @@ class bmi_LSTM(Bmi):
                 long_var_name = self._var_name_map_short_first[attribute]
 
                 # This is probably the better way to do it,
-                setattr(self, long_var_name, self.cfg_bmi[attribute])
+                # a list gives each basin its own value
+                value = self.cfg_bmi[attribute]
+                setattr(self, long_var_name, np.array(value, dtype=np.float64) if isinstance(value, list) else value)
                 
                 # and this is just in case. _values dictionary is in the example
                 #self._values[long_var_name] = self.cfg_bmi[attribute]
@@ -449,7 +993,7 @@ class bmi_LSTM(Bmi):
     #---------------------------------------------------------------------------- 
     def initialize_forcings(self):
         for forcing_name in self.cfg_train['dynamic_inputs']:
-            setattr(self, self._var_name_map_short_first[forcing_name], 0)
+            setattr(self, self._var_name_map_short_first[forcing_name], np.zeros(self.n_basins))
 
     #-------------------------------------------------------------------
     #-------------------------------------------------------------------
@@ -494,6 +1038,7 @@ class bmi_LSTM(Bmi):
         return len(self._output_var_names)
 
     #------------------------------------------------------------ 
+    @_locked
     def get_value(self, var_name: str, dest: np.ndarray) -> np.ndarray:
         """
         Copy values for the named variable into the provided destination array.
@@ -623,6 +1168,7 @@ class bmi_LSTM(Bmi):
         return self._time_units
        
     #-------------------------------------------------------------------
+    @_locked
     def set_value(self, var_name: str, values: np.ndarray):
         """Set model values.
 
@@ -638,6 +1184,7 @@ class bmi_LSTM(Bmi):
         internal_array[:] = values
 
     #------------------------------------------------------------ 
+    @_locked
     def set_value_at_indices(self, var_name: str, inds: np.ndarray, src: np.ndarray):
         """
         Set model values at particular indices.
@@ -651,9 +1198,7 @@ class bmi_LSTM(Bmi):
         src : np.ndarray
             Array of new values.
         """
-        internal_array = self.get_value_ptr(var_name)
-        for i in range(inds.shape[0]):
-            internal_array[inds[i]] = src[i]
+        self.get_value_ptr(var_name)[inds] = src[:len(inds)]
 
     #------------------------------------------------------------ 
     def get_var_nbytes(self, var_name):
@@ -671,13 +1216,10 @@ class bmi_LSTM(Bmi):
         #NJF getsizeof returns the size of the python object...not the raw dtype...
         #return sys.getsizeof(self.get_value_ptr(var_name))
         #This is just the itemsize (size per element) * number of elements
-        #Since all are currently scalar, this is 1
-        try:
-            return self.get_var_itemsize(var_name)*len(self.get_value_ptr(var_name))
-        except TypeError:
-            #must be scalar
-            return self.get_var_itemsize(var_name)
+        #There is one element per basin
+        return self.get_value_ptr(var_name).nbytes
     #------------------------------------------------------------ 
+    @_locked
     def get_value_at_indices(self, var_name: str, dest: np.ndarray, indices: np.ndarray) -> np.ndarray:
         """
         Get values at particular indices.
@@ -695,18 +1237,20 @@ class bmi_LSTM(Bmi):
         np.ndarray
             Values at indices.
         """
-        original: np.ndarray = self.get_value_ptr(var_name)
-        for i in range(indices.shape[0]):
-            value_index = indices[i]
-            dest[i] = original[value_index]
+        dest[:len(indices)] = self.get_value_ptr(var_name)[indices]
         return dest
  
-    #   Note: remaining grid funcs do not apply for type 'scalar'
-    #   Yet all functions in the BMI must be implemented 
+    #   Note: grid 0 holds one node per basin. It is a 'scalar' grid for a single basin
+    #   and an unstructured 'points' grid (nodes only, no edges or faces) for several.
+    #   The remaining grid funcs do not apply to these grid types,
+    #   yet all functions in the BMI must be implemented 
     #   See https://bmi.readthedocs.io/en/latest/bmi.best_practices.html          
     #------------------------------------------------------------ 
     def get_grid_edge_count(self, grid):
-        raise NotImplementedError("get_grid_edge_count")
+
+        # 0 is the only id we have, and points have no edges
+        if grid == 0:
+            return 0
 
     #------------------------------------------------------------ 
     def get_grid_edge_nodes(self, grid, edge_nodes):
@@ -714,7 +1258,10 @@ class bmi_LSTM(Bmi):
 
     #------------------------------------------------------------ 
     def get_grid_face_count(self, grid):
-        raise NotImplementedError("get_grid_face_count")
+
+        # 0 is the only id we have, and points have no faces
+        if grid == 0:
+            return 0
     
     #------------------------------------------------------------ 
     def get_grid_face_edges(self, grid, face_edges):
@@ -726,7 +1273,10 @@ class bmi_LSTM(Bmi):
     
     #------------------------------------------------------------ 
     def get_grid_node_count(self, grid):
-        raise NotImplementedError("get_grid_node_count")
+
+        # 0 is the only id we have, with one node per basin
+        if grid == 0:
+            return self.n_basins
 
     #------------------------------------------------------------ 
     def get_grid_nodes_per_face(self, grid, nodes_per_face):
@@ -745,14 +1295,18 @@ class bmi_LSTM(Bmi):
 
     #------------------------------------------------------------ 
     def get_grid_shape(self, grid_id, shape):
-        raise NotImplementedError("get_grid_shape") 
+
+        # 0 is the only id we have, a vector of basins
+        if grid_id == 0:
+            shape[:] = self.n_basins
+            return shape
 
     #------------------------------------------------------------ 
     def get_grid_size(self, grid_id):
        
         # 0 is the only id we have
         if grid_id == 0:
-            return 1
+            return self.n_basins
 
     #------------------------------------------------------------ 
     def get_grid_spacing(self, grid_id, spacing):
@@ -763,19 +1317,25 @@ class bmi_LSTM(Bmi):
 
         # 0 is the only id we have        
         if grid_id == 0:
-            return 'scalar'
+            return self._var_grid_type if self.n_basins == 1 else 'points'
 
     #------------------------------------------------------------ 
-    def get_grid_x(self):
-        raise NotImplementedError("get_grid_x") 
+    def get_grid_x(self, grid, x):
+        """Longitude of the basins (degrees)."""
+        x[:] = self._basin_values('lon')
+        return x
 
     #------------------------------------------------------------ 
-    def get_grid_y(self):
-        raise NotImplementedError("get_grid_y") 
+    def get_grid_y(self, grid, y):
+        """Latitude of the basins (degrees)."""
+        y[:] = self._basin_values('lat')
+        return y
 
     #------------------------------------------------------------ 
-    def get_grid_z(self):
-        raise NotImplementedError("get_grid_z") 
+    def get_grid_z(self, grid, z):
+        """Mean elevation of the basins (m), zero if not in the BMI configuration."""
+        z[:] = self._basin_values('elev_mean') if 'elev_mean' in self.cfg_bmi else 0.0
+        return z
 
 
     #------------------------------------------------------------ 
@@ -784,10 +1344,15 @@ class bmi_LSTM(Bmi):
     #------------------------------------------------------------ 
     #------------------------------------------------------------ 
 
-    def _parse_config(self, cfg):
+    @staticmethod
+    def _parse_config(cfg, skip_keys=()):
         for key, val in cfg.items():
+            # leave anything not needed for running the model as it is
+            if key in skip_keys:
+                pass
+
             # convert all path strings to PosixPath objects
-            if any([key.endswith(x) for x in ['_dir', '_path', '_file', '_files']]):
+            elif any([key.endswith(x) for x in ['_dir', '_path', '_file', '_files']]):
                 if (val is not None) and (val != "None"):
                     if isinstance(val, list):
                         temp_list = []
@@ -801,6 +1366,7 @@ class bmi_LSTM(Bmi):
 
             # convert Dates to pandas Datetime indexs
             elif key.endswith('_date'):
+                import pandas as pd
                 if isinstance(val, list):
                     temp_list = []
                     for elem in val:
@@ -814,3 +1380,250 @@ class bmi_LSTM(Bmi):
 
         # Add more config parsing if necessary
         return cfg
+
+
+#------------------------------------------------------------ 
+#------------------------------------------------------------ 
+#-- Reading configurations and trained models
+#------------------------------------------------------------ 
+#------------------------------------------------------------ 
+
+def _import_torch():
+    """Import torch and the LSTM model built on it, the first time a model is loaded."""
+    global torch, nextgen_cuda_lstm
+    if torch is None:
+        import torch as _torch
+        import nextgen_cuda_lstm as _nextgen_cuda_lstm
+        torch = _torch
+        nextgen_cuda_lstm = _nextgen_cuda_lstm
+
+#------------------------------------------------------------ 
+def _cpu_supports_bfloat16():
+    """Whether torch can run bfloat16 matrix products natively on this CPU."""
+    _import_torch()
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+#------------------------------------------------------------ 
+def _frequency_hours(frequency):
+    """Length in hours of a NeuralHydrology (pandas offset) frequency such as '1D', '3H' or '15min'."""
+    units = {'D': 24.0, 'H': 1.0, 'h': 1.0, 'min': 1/60, 'T': 1/60}
+    frequency = str(frequency).strip()
+    for unit, hours in units.items():
+        if frequency.endswith(unit):
+            number = frequency[:-len(unit)].strip()
+            return (float(number) if number else 1.0) * hours
+    raise ValueError("Unsupported LSTM frequency '{}', use days, hours or minutes (e.g. '1D', '1H')".format(frequency))
+
+#------------------------------------------------------------ 
+def read_bmi_config(bmi_cfg_file):
+    """
+    Read and parse a BMI configuration file.
+
+    Parameters
+    ----------
+    bmi_cfg_file : str or Path
+        Path to the BMI (``*.yml``) configuration file.
+
+    Returns
+    -------
+    dict
+        The parsed configuration.
+    """
+    import yaml
+    with Path(bmi_cfg_file).open('r') as fp:
+        cfg = yaml.safe_load(fp)
+    return bmi_LSTM._parse_config(cfg)
+
+#------------------------------------------------------------ 
+# Keys of a BMI configuration that differ between basins
+_basin_keys = ['basin_id', 'basin_name', 'area_sqkm', 'lat', 'lon'] + bmi_LSTM._static_attributes_list
+
+def combine_bmi_configs(cfgs_bmi):
+    """
+    Combine the BMI configurations of single basins into one configuration for all of them.
+
+    The basin keys (id, name, area, location and static attributes) become lists with one value per basin. All the
+    other keys, the trained model in particular, are taken from the first configuration and must be the same for all.
+
+    Parameters
+    ----------
+    cfgs_bmi : list of dict
+        Parsed BMI configurations (see ``read_bmi_config()``), one per basin.
+
+    Returns
+    -------
+    dict
+        BMI configuration for a ``bmi_LSTM`` running all the basins as one batch.
+    """
+    cfg = dict(cfgs_bmi[0])
+    for key in cfgs_bmi[0]:
+        if key in _basin_keys:
+            cfg[key] = [cfg_bmi[key] for cfg_bmi in cfgs_bmi]
+        elif any(cfg_bmi[key] != cfg[key] for cfg_bmi in cfgs_bmi):
+            raise ValueError("BMI configurations differ in '{}', they cannot be run as one batch".format(key))
+    return cfg
+
+#------------------------------------------------------------ 
+# Keys of a NeuralHydrology training configuration that are only used for training, not for running the model.
+# These are left as they are in the file (in particular, the dates are not converted with pandas).
+_training_only_keys = ('train_start_date', 'train_end_date', 'validation_start_date', 'validation_end_date',
+                       'test_start_date', 'test_end_date', 'train_basin_file', 'validation_basin_file',
+                       'test_basin_file', 'train_dir', 'img_log_dir', 'data_dir')
+
+# Parsed training configurations, keyed by the resolved path and modification time of the file
+_training_config_cache = {}
+
+def read_training_config(train_cfg_file):
+    """
+    Read and parse a training configuration file, or return it from the cache.
+
+    Many instances share a handful of trained models, so the parsed configuration is cached by path and
+    modification time. The returned dictionary is shared between callers and should not be modified.
+
+    Parameters
+    ----------
+    train_cfg_file : str or Path
+        Path to the training configuration (``config.yml``) of the trained model.
+
+    Returns
+    -------
+    cfg_train : dict
+        The parsed configuration.
+    bytes_read : int
+        Size of the file if it was read, zero if the configuration came from the cache.
+    """
+    train_cfg_file = Path(train_cfg_file).resolve()
+    file_stat = train_cfg_file.stat()
+    key = (train_cfg_file, file_stat.st_mtime_ns)
+    if key in _training_config_cache:
+        return _training_config_cache[key], 0
+
+    import yaml
+    with train_cfg_file.open('r') as fp:
+        cfg_train = bmi_LSTM._parse_config(yaml.safe_load(fp), skip_keys=_training_only_keys)
+    _training_config_cache[key] = cfg_train
+    return cfg_train, file_stat.st_size
+
+#------------------------------------------------------------ 
+def scaler_values(cfg_train, train_data_scaler, dtype=np.float32):
+    """
+    Mean and standard deviation of the LSTM inputs and output, from the training data scaler.
+
+    Returns
+    -------
+    input_mean, input_std : np.ndarray
+        Of the dynamic inputs followed by the static attributes, as ``dtype`` arrays.
+    out_mean, out_std
+        Of the (first) target variable.
+    """
+    out_mean = train_data_scaler['xarray_feature_center'][cfg_train['target_variables'][0]].values
+    out_std = train_data_scaler['xarray_feature_scale'][cfg_train['target_variables'][0]].values
+
+    input_mean = []
+    input_mean.extend([train_data_scaler['xarray_feature_center'][x].values for x in cfg_train['dynamic_inputs']])
+    input_mean.extend([train_data_scaler['attribute_means'][x] for x in cfg_train['static_attributes']])
+    input_mean = np.array(input_mean, dtype=dtype)
+
+    input_std = []
+    input_std.extend([train_data_scaler['xarray_feature_scale'][x].values for x in cfg_train['dynamic_inputs']])
+    input_std.extend([train_data_scaler['attribute_stds'][x] for x in cfg_train['static_attributes']])
+    input_std = np.array(input_std, dtype=dtype)
+
+    return input_mean, input_std, out_mean, out_std
+
+#------------------------------------------------------------ 
+def read_train_data_scaler(cfg_train):
+    """Read the training data scaler of a trained model. Returns the scaler and the size of the file."""
+    import pickle
+    scaler_file = '..' / cfg_train['run_dir'] / 'train_data' / 'train_data_scaler.p'
+    with open(scaler_file, 'rb') as fb:
+        train_data_scaler = pickle.load(fb)
+    return train_data_scaler, scaler_file.stat().st_size
+
+#------------------------------------------------------------ 
+def trained_model_file(cfg_train, suffix='.pt'):
+    """Weights file of the last epoch of a trained model, or the file with the same name and another ``suffix``."""
+    return '..' / cfg_train['run_dir'] / 'model_epoch{}{}'.format(str(cfg_train['epochs']).zfill(3), suffix)
+
+#------------------------------------------------------------ 
+def bundle_key(cfg_bmi):
+    """
+    Key of the trained model a parsed BMI configuration runs: its resolved ``train_cfg_file``, ``weights_file`` and
+    ``onnx_file`` (None when not given). Configurations with the same key can share one model bundle.
+    """
+    return tuple(None if cfg_bmi.get(key) is None else Path(cfg_bmi[key]).resolve()
+                 for key in ('train_cfg_file', 'weights_file', 'onnx_file'))
+
+#------------------------------------------------------------
+def load_config_bundle(cfg_bmi):
+    """
+    Model bundle of a parsed BMI configuration, as ``bmi_LSTM.initialize_from_config()`` loads it: the graph of its
+    ``onnx_file`` for ONNX Runtime (without torch), or else its ``weights_file`` (by default the last epoch).
+    """
+    if cfg_bmi.get('onnx_file') is not None:
+        import lstm_onnx
+        return lstm_onnx.load_onnx_bundle(cfg_bmi['train_cfg_file'], cfg_bmi['onnx_file'])
+    return load_model_bundle(cfg_bmi['train_cfg_file'], cfg_bmi.get('weights_file'))
+
+#------------------------------------------------------------
+def load_model_bundle(train_cfg_file, weights_file=None):
+    """
+    Load everything an LSTM instance needs from a trained NeuralHydrology model.
+
+    The bundle holds the parsed training configuration, the training data scaler and an LSTM module with the trained
+    weights loaded. It does not depend on the basin, so one bundle can be shared by every instance running the same
+    trained model.
+
+    Parameters
+    ----------
+    train_cfg_file : str or Path
+        Path to the training configuration (``config.yml``) of the trained model.
+    weights_file : str or Path, optional
+        Trained weights (``model_epochNNN.pt``) to load, by default those of the last training epoch.
+
+    Returns
+    -------
+    dict
+        ``cfg_train``, ``train_data_scaler`` and ``lstm``, plus ``bytes_read``, the total size of the files read.
+    """
+    _import_torch()
+
+    cfg_train, bytes_read = read_training_config(train_cfg_file)
+
+    # Scaler data from the training set. This is used to normalize the data (input and output).
+    train_data_scaler, scaler_bytes = read_train_data_scaler(cfg_train)
+    bytes_read += scaler_bytes
+
+    # ------------- Initialize an LSTM model ------------------------------#
+    lstm = nextgen_cuda_lstm.Nextgen_CudaLSTM(input_size=len(cfg_train['dynamic_inputs']) + len(cfg_train['static_attributes']),
+                                              hidden_layer_size=cfg_train['hidden_size'],
+                                              output_size=len(cfg_train['target_variables']),
+                                              batch_size=1,
+                                              seq_length=1)
+
+    # ------------ Load in the trained weights ----------------------------#
+    # Save the default model weights. We need to make sure we have the same keys.
+    default_state_dict = lstm.state_dict()
+
+    # Trained model weights from Neuralhydrology.
+    if weights_file is None:
+        weights_file = trained_model_file(cfg_train)
+    weights_file = Path(weights_file)
+    trained_state_dict = torch.load(weights_file, map_location=torch.device('cpu'))
+    bytes_read += weights_file.stat().st_size
+
+    # Changing the name of the head weights, since different in NH
+    trained_state_dict['head.weight'] = trained_state_dict.pop('head.net.0.weight')
+    trained_state_dict['head.bias'] = trained_state_dict.pop('head.net.0.bias')
+    trained_state_dict = {x:trained_state_dict[x] for x in default_state_dict.keys()}
+
+    # Load in the trained weights.
+    lstm.load_state_dict(trained_state_dict)
+
+    return {'cfg_train': cfg_train,
+            'train_data_scaler': train_data_scaler,
+            'lstm': lstm,
+            'bytes_read': bytes_read}
@@ -0,0 +1,70 @@
+"""BMI configurations for CAMELS basins.
+
+The example configuration files in ``bmi_config_files/`` are written for a single basin (01022500). To run the same
+trained model on other CAMELS basins, only the basin specific keys (id, name, area, location and static attributes)
+need to change. These are taken from the CAMELS attribute files in ``data/camels_attributes_v2.0/``:
+    Addor, N., A.J. Newman, N. Mizukami, and M.P. Clark. 2017. The CAMELS data set: catchment attributes and
+    meteorology for large-sample studies. https://doi.org/10.5194/hess-21-5293-2017
+"""
+from pathlib import Path
+
+import bmi_lstm
+
+camels_attributes_dir = Path('../data/camels_attributes_v2.0')
+
+
+def read_basin_list(basin_list_file):
+    """Read a list of basin ids (one per line, e.g. ``data/4_basins_test_set.txt``) as 8 digit strings."""
+    with open(basin_list_file, 'r') as f:
+        return [line.strip().zfill(8) for line in f if line.strip()]
+
+
+def read_camels_attributes(attributes_dir=camels_attributes_dir):
+    """
+    Read all the CAMELS attribute files into one table.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per basin, indexed by the integer gauge id, one column per attribute.
+    """
+    import pandas as pd
+
+    attribute_tables = []
+    for attribute_type in ['clim', 'geol', 'hydro', 'name', 'soil', 'topo', 'vege']:
+        with open(Path(attributes_dir) / "camels_{}.txt".format(attribute_type), "r") as f:
+            attribute_tables.append(pd.read_csv(f, sep=";").set_index("gauge_id"))
+    return pd.concat(attribute_tables, axis=1)
+
+
+def make_bmi_config(template_cfg, basin_id, camels_attributes):
+    """
+    Make the BMI configuration of a CAMELS basin from the configuration of another basin.
+
+    Parameters
+    ----------
+    template_cfg : dict
+        Parsed BMI configuration (see ``bmi_lstm.read_bmi_config()``) to copy everything else from.
+    basin_id : str
+        CAMELS gauge id of the basin.
+    camels_attributes : pandas.DataFrame
+        Table from ``read_camels_attributes()``.
+
+    Returns
+    -------
+    dict
+        A new BMI configuration, ``template_cfg`` is not changed.
+    """
+    basin_attributes = camels_attributes.loc[int(basin_id)]
+
+    cfg = dict(template_cfg)
+    cfg['basin_id'] = str(basin_id).zfill(8)
+    cfg['basin_name'] = str(basin_attributes['gauge_name']).strip()
+    cfg['area_sqkm'] = float(basin_attributes['area_geospa_fabric'])
+    cfg['lat'] = float(basin_attributes['gauge_lat'])
+    cfg['lon'] = float(basin_attributes['gauge_lon'])
+    for attribute in bmi_lstm.bmi_LSTM._static_attributes_list:
+        if attribute in basin_attributes.index:
+            cfg[attribute] = float(basin_attributes[attribute])
+
+    return cfg
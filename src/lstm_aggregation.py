@@ -0,0 +1,120 @@
+"""Streaming daily and monthly aggregation of the BMI LSTM outputs.
+
+Downstream users often want daily or monthly runoff totals rather than the hourly series. Instead of storing the
+hourly ``land_surface_water__runoff_depth`` and ``land_surface_water__runoff_volume_flux`` and resampling afterwards,
+a ``PeriodAggregator`` keeps running sums and maxima per basin, and when a period closes writes the period values into
+extra BMI output variables. Memory use is a few arrays of one value per basin, however long the run.
+
+Aggregation is switched on in the BMI configuration:
+
+    aggregation_periods: ['daily', 'monthly']
+    time_origin: '2000-01-01 00:00'
+
+``time_origin`` is the date and time of model time zero, needed to know where days and months start. The extra output
+variables of each period are listed in ``aggregated_var_names()``.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Extra output variables of each period, with their units. {} is replaced by the period name.
+_aggregated_var_units = {'land_surface_water__runoff_depth__{}_sum': 'm',
+                         'land_surface_water__runoff_depth__{}_mean': 'm',
+                         'land_surface_water__runoff_depth__{}_max': 'm',
+                         'land_surface_water__runoff_volume_flux__{}_mean': 'm3 s-1',
+                         'land_surface_water__runoff_volume_flux__{}_max': 'm3 s-1',
+                         'land_surface_water__runoff_volume__{}_sum': 'm3'}
+
+# Function giving the period a date and time belongs to
+_period_keys = {'daily': lambda time: time.date(),
+                'monthly': lambda time: (time.year, time.month)}
+
+default_time_origin = '1970-01-01 00:00'
+
+
+def aggregated_var_names(period):
+    """Names and units of the extra BMI output variables of a period ('daily' or 'monthly')."""
+    return {name.format(period): units for name, units in _aggregated_var_units.items()}
+
+
+class PeriodAggregator:
+    """
+    Running aggregation of the runoff outputs of a ``bmi_LSTM`` over one kind of period.
+
+    Parameters
+    ----------
+    period : str
+        'daily' or 'monthly'.
+    n_basins : int
+        Number of basins of the model.
+    time_origin : str
+        Date and time of model time zero, in ISO format.
+    """
+
+    def __init__(self, period, n_basins, time_origin=default_time_origin):
+        if period not in _period_keys:
+            raise ValueError("aggregation period must be one of {}, not '{}'".format(list(_period_keys), period))
+        self.period = period
+        self.time_origin = datetime.fromisoformat(str(time_origin))
+        self._period_key = _period_keys[period]
+        self.var_names = list(aggregated_var_names(period))
+
+        self.current_period = None
+        self.n_steps = 0
+        self.depth_sum = np.zeros(n_basins)
+        self.depth_max = np.full(n_basins, -np.inf)
+        self.flux_sum = np.zeros(n_basins)
+        self.flux_max = np.full(n_basins, -np.inf)
+        self.volume_sum = np.zeros(n_basins)
+
+    #------------------------------------------------------------
+    def update(self, model):
+        """
+        Add the outputs of the model's last time step, closing the current period first if the step is in a new one.
+
+        Call this after ``update()``, so the model time is the end of the step.
+
+        Returns
+        -------
+        bool
+            Whether a period was closed, and its values written to the model's output variables.
+        """
+        time_step = model.get_time_step()
+        step_start = self.time_origin + timedelta(hours=float(model.get_current_time() - time_step))
+        step_period = self._period_key(step_start)
+
+        closed = self.current_period is not None and step_period != self.current_period
+        if closed:
+            self.close(model)
+        self.current_period = step_period
+
+        depth = model.get_value_ptr('land_surface_water__runoff_depth')
+        flux = model.get_value_ptr('land_surface_water__runoff_volume_flux')
+        self.n_steps += 1
+        self.depth_sum += depth
+        np.maximum(self.depth_max, depth, out=self.depth_max)
+        self.flux_sum += flux
+        np.maximum(self.flux_max, flux, out=self.flux_max)
+        #                    hour->s
+        self.volume_sum += flux * time_step * 3600
+
+        return closed
+
+    #------------------------------------------------------------
+    def close(self, model):
+        """Write the values of the current period to the model's output variables and start a new period."""
+        values = [self.depth_sum,
+                  self.depth_sum / self.n_steps,
+                  self.depth_max,
+                  self.flux_sum / self.n_steps,
+                  self.flux_max,
+                  self.volume_sum]
+        for var_name, value in zip(self.var_names, values):
+            model.get_value_ptr(var_name)[:] = value
+
+        self.n_steps = 0
+        self.depth_sum[:] = 0.0
+        self.depth_max[:] = -np.inf
+        self.flux_sum[:] = 0.0
+        self.flux_max[:] = -np.inf
+        self.volume_sum[:] = 0.0
@@ -0,0 +1,140 @@
+"""Export recorded BMI LSTM outputs as Arrow record batches and Parquet files.
+
+The outputs of an ``lstm_output_recorder.OutputRecorder`` are a (time, basin, variable) array in a memory-mapped
+file. ``record_batches()`` turns them into Arrow record batches of a range of time steps, in long format with one row
+per time step and basin:
+
+    time       time step index (int64)
+    basin_id   dictionary encoded basin id
+    values     fixed size list of the recorded variables, in the order of the ``var_names`` schema metadata
+
+The ``values`` column is built over the memory-mapped file itself, without copying. Arrow arrays cannot be strided,
+so one column per variable needs a copy; ask for it with ``split_variables=True``. ``states_record_batch()`` exports
+the hidden and cell states of a running model the same way. ``write_parquet()`` streams a whole recording to a
+Parquet file, one row group per batch, so hindcasts larger than memory can be converted.
+
+Needs ``pyarrow``, which ``bmi_lstm`` does not.
+
+Example (from the ``/src`` directory):
+
+    lstm_arrow_export.write_parquet('./runoff.dat', './runoff.parquet')
+"""
+import json
+
+import numpy as np
+import pyarrow as pa
+
+import lstm_output_recorder
+
+
+def _zero_copy_array(values, arrow_type=None):
+    """Arrow array over a contiguous one dimensional NumPy array, sharing its memory."""
+    values = np.asarray(values)
+    if not values.flags['C_CONTIGUOUS']:
+        raise ValueError("Only contiguous arrays can be exported without copying")
+    arrow_type = arrow_type or pa.from_numpy_dtype(values.dtype)
+    return pa.Array.from_buffers(arrow_type, values.size, [None, pa.py_buffer(values)])
+
+#------------------------------------------------------------
+def _fixed_size_list(values):
+    """Fixed size list array over the rows of a contiguous two dimensional array, without copying."""
+    return pa.FixedSizeListArray.from_arrays(_zero_copy_array(values.reshape(-1)), values.shape[1])
+
+#------------------------------------------------------------
+def recording_schema(header, split_variables=False):
+    """Arrow schema of the record batches of a recording, with the variable names as metadata."""
+    if split_variables:
+        value_fields = [pa.field(var_name, pa.from_numpy_dtype(np.dtype(header['dtype'])))
+                        for var_name in header['var_names']]
+    else:
+        value_fields = [pa.field('values', pa.list_(pa.from_numpy_dtype(np.dtype(header['dtype'])),
+                                                    len(header['var_names'])))]
+    return pa.schema([pa.field('time', pa.int64()), pa.field('basin_id', pa.dictionary(pa.int32(), pa.string()))]
+                     + value_fields, metadata={'var_names': json.dumps(header['var_names'])})
+
+#------------------------------------------------------------
+def record_batches(path, batch_steps=24*30, start=0, stop=None, split_variables=False):
+    """
+    Record batches of the outputs recorded in a file, ``batch_steps`` time steps at a time.
+
+    Parameters
+    ----------
+    path : str or Path
+        Data file of an ``OutputRecorder``.
+    batch_steps : int
+        Number of time steps per record batch.
+    start, stop : int, optional
+        Range of time steps, all those recorded by default.
+    split_variables : bool
+        One column per variable (copied) instead of the ``values`` list column (not copied).
+
+    Yields
+    ------
+    pyarrow.RecordBatch
+        Rows of ``batch_steps`` time steps times the number of basins, time step major.
+    """
+    data, header = lstm_output_recorder.open_recording(path)
+    n_steps, n_basins, _ = data.shape
+    stop = n_steps if stop is None else min(stop, n_steps)
+    schema = recording_schema(header, split_variables)
+    basin_ids = header['basin_ids'] or [str(basin) for basin in range(n_basins)]
+    basin_dictionary = pa.array(basin_ids, pa.string())
+
+    for batch_start in range(start, stop, batch_steps):
+        batch_stop = min(batch_start + batch_steps, stop)
+        n_rows = (batch_stop - batch_start) * n_basins
+        time = np.repeat(np.arange(batch_start, batch_stop, dtype=np.int64), n_basins)
+        basin_id = pa.DictionaryArray.from_arrays(np.tile(np.arange(n_basins, dtype=np.int32),
+                                                          batch_stop - batch_start), basin_dictionary)
+        # The rows of the batch are contiguous in the file
+        values = data[batch_start:batch_stop].reshape(n_rows, -1)
+        if split_variables:
+            value_columns = [pa.array(values[:, j]) for j in range(values.shape[1])]
+        else:
+            value_columns = [_fixed_size_list(values)]
+        yield pa.RecordBatch.from_arrays([pa.array(time), basin_id] + value_columns, schema=schema)
+
+#------------------------------------------------------------
+def states_record_batch(model):
+    """
+    Record batch of the hidden and cell states of a model, one row per basin, over the model's state arrays.
+
+    The columns are ``basin_id``, ``h_t`` and ``c_t``, the states as fixed size lists of the hidden size. The batch
+    shares memory with the states, which ``update()`` replaces, so it keeps the states of the time it was made.
+    """
+    h_t, c_t = model._get_states()
+    basin_ids = [str(basin_id) for basin_id in np.atleast_1d(model.cfg_bmi['basin_id'])]
+    return pa.RecordBatch.from_arrays([pa.array(basin_ids, pa.string()), _fixed_size_list(h_t[0]),
+                                       _fixed_size_list(c_t[0])], names=['basin_id', 'h_t', 'c_t'])
+
+#------------------------------------------------------------
+def write_parquet(path, parquet_file, batch_steps=24*30, split_variables=False, compression='zstd'):
+    """
+    Stream the outputs recorded in a file to a Parquet file, one row group per record batch.
+
+    Parameters
+    ----------
+    path : str or Path
+        Data file of an ``OutputRecorder``.
+    parquet_file : str or Path
+        Parquet file to write.
+    batch_steps, split_variables
+        As for ``record_batches()``.
+    compression : str
+        Parquet compression codec.
+
+    Returns
+    -------
+    int
+        Number of rows written.
+    """
+    import pyarrow.parquet as pq
+
+    _, header = lstm_output_recorder.open_recording(path)
+    n_rows = 0
+    with pq.ParquetWriter(str(parquet_file), recording_schema(header, split_variables),
+                          compression=compression) as writer:
+        for batch in record_batches(path, batch_steps, split_variables=split_variables):
+            writer.write_batch(batch)
+            n_rows += batch.num_rows
+    return n_rows
@@ -0,0 +1,231 @@
+"""Write BMI LSTM outputs to compressed netCDF4 or Zarr files from a background thread.
+
+Writing every time step to a file as it is computed stalls the model loop. An ``AsyncOutputWriter`` is attached like
+an ``lstm_output_recorder.OutputRecorder`` (see ``bmi_LSTM.attach_recorder()``), but buffers the output variables of
+all the basins in memory in chunks of time steps. A full chunk is put on a bounded queue and written, compressed, by a
+writer thread while the models go on. When the queue is full, the next full chunk waits for room, so a slow disk
+slows the models down instead of filling the memory. The chunks are written in order, and ``flush()`` (called by
+``bmi_LSTM.finalize()``) returns once everything recorded so far is on disk.
+
+The file format follows the file name: a ``.zarr`` directory (needs the ``zarr`` package) or a netCDF4 file, both
+with one (time, basin) variable per output variable, chunked by the chunks of time steps.
+
+Example (from the ``/src`` directory):
+
+    writer = lstm_async_writer.AsyncOutputWriter('./runoff.nc', n_basins=4, basin_ids=basin_ids)
+    model.attach_recorder(writer)
+    ...update the model...
+    model.finalize()
+    writer.close()
+"""
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class AsyncOutputWriter:
+    """
+    Output variables of many basins, buffered in chunks of time steps and written by a background thread.
+
+    Parameters
+    ----------
+    path : str or Path
+        File to write, a ``.zarr`` directory or a netCDF4 file.
+    n_basins : int
+        Number of basins.
+    var_names : list of str, optional
+        BMI output variables to write. Defaults to all the outputs of ``bmi_LSTM``.
+    basin_ids : list of str, optional
+        Basin ids, written as the ``basin_id`` variable.
+    chunk_steps : int
+        Number of time steps per chunk, both in memory and in the file.
+    max_queued_chunks : int
+        Number of full chunks that can wait to be written before recording blocks.
+    complevel : int
+        Compression level (zlib for netCDF4, zstd for Zarr).
+    dtype : numpy dtype
+        Type of the stored values.
+    """
+
+    def __init__(self, path, n_basins, var_names=None, basin_ids=None, chunk_steps=24*30, max_queued_chunks=4,
+                 complevel=4, dtype=np.float32):
+        if var_names is None:
+            import bmi_lstm
+            var_names = list(bmi_lstm.bmi_LSTM._output_var_names)
+        self.path = Path(path)
+        self.format = 'zarr' if self.path.suffix == '.zarr' else 'netcdf'
+        self.var_names = list(var_names)
+        self.n_basins = n_basins
+        self.chunk_steps = chunk_steps
+        self.dtype = np.dtype(dtype)
+
+        # Chunk being filled: the first time step in it, and the next time step to write for each basin
+        self.chunk_start = 0
+        self.next_step = np.zeros(n_basins, dtype=np.int64)
+        # Buffers are recycled: the writer thread hands them back once written, so there are at most
+        # max_queued_chunks + 2 of them (the one being filled and the one being written)
+        self._free_buffers = queue.Queue()
+        self.buffer, self.times = self._new_buffer()
+        self._queue = queue.Queue(maxsize=max_queued_chunks)
+        self._error = None
+        # Models sharing the writer can be updated from several threads (see lstm_thread_pool.py)
+        self._lock = threading.RLock()
+
+        self._file = _open_file(self.format, self.path, self.var_names, n_basins, basin_ids, chunk_steps, complevel,
+                                self.dtype)
+        self._thread = threading.Thread(target=self._write_chunks, name='AsyncOutputWriter', daemon=True)
+        self._thread.start()
+
+    #------------------------------------------------------------
+    @property
+    def n_recorded(self):
+        """Number of time steps recorded for all the basins."""
+        return int(self.next_step.min())
+
+    #------------------------------------------------------------
+    def record(self, model, first_basin=0):
+        """
+        Buffer the current output values of a model, see ``lstm_output_recorder.OutputRecorder.record()``.
+
+        The basins must not get more than a chunk apart.
+        """
+        self._raise_error()
+        with self._lock:
+            for j, var_name in enumerate(self.var_names):
+                values = model.get_value_ptr(var_name)
+                basins = slice(first_basin, first_basin + values.size)
+                rows = self.next_step[basins] - self.chunk_start
+                if rows.max() >= self.chunk_steps:
+                    raise IndexError("Basins got more than a chunk of {} time steps apart".format(self.chunk_steps))
+                self.buffer[rows, np.arange(basins.start, basins.stop), j] = values
+            if first_basin == 0:
+                self.times[self.next_step[0] - self.chunk_start] = model.get_current_time()
+            self.next_step[basins] += 1
+
+            if self.n_recorded - self.chunk_start == self.chunk_steps:
+                # Blocks while the queue is full
+                self._queue.put((self.chunk_start, self.buffer, self.times, True))
+                self.chunk_start += self.chunk_steps
+                self.buffer, self.times = self._new_buffer()
+
+    #------------------------------------------------------------
+    def flush(self):
+        """Write the partial chunk too, and wait until everything recorded so far is written."""
+        with self._lock:
+            n_partial = self.n_recorded - self.chunk_start
+            if n_partial > 0:
+                # A copy, the partial chunk goes on filling; it is written again once full
+                self._queue.put((self.chunk_start, self.buffer[:n_partial].copy(), self.times[:n_partial].copy(),
+                                 False))
+            self._queue.join()
+        self._raise_error()
+
+    #------------------------------------------------------------
+    def close(self):
+        """Flush, stop the writer thread and close the file."""
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #------------------------------------------------------------
+    def _new_buffer(self):
+        try:
+            return self._free_buffers.get_nowait()
+        except queue.Empty:
+            return (np.full((self.chunk_steps, self.n_basins, len(self.var_names)), np.nan, dtype=self.dtype),
+                    np.zeros(self.chunk_steps))
+
+    def _write_chunks(self):
+        """Writer thread: write the queued chunks in order, until the None sentinel."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                start, buffer, times, full = item
+                if self._error is None:
+                    self._file.write(start, buffer, times)
+                if full:
+                    # Reset before reuse, so a recycled buffer never holds values of an earlier chunk
+                    buffer.fill(np.nan)
+                    times.fill(0.0)
+                    self._free_buffers.put((buffer, times))
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Writing {} failed".format(self.path)) from self._error
+
+
+class _NetCDFFile:
+    """(time, basin) variables in a netCDF4 file with an unlimited time dimension."""
+
+    def __init__(self, path, var_names, n_basins, basin_ids, chunk_steps, complevel, dtype):
+        from netCDF4 import Dataset
+        self.data = Dataset(path, 'w')
+        self.data.createDimension('time', None)
+        self.data.createDimension('basin', n_basins)
+        self.data.createVariable('time', 'f8', ('time',))
+        if basin_ids is not None:
+            basin_id = self.data.createVariable('basin_id', str, ('basin',))
+            basin_id[:] = np.array([str(x) for x in basin_ids], dtype=object)
+        self.variables = [self.data.createVariable(var_name, dtype, ('time', 'basin'), zlib=True,
+                                                   complevel=complevel, chunksizes=(chunk_steps, n_basins))
+                          for var_name in var_names]
+
+    def write(self, start, buffer, times):
+        stop = start + len(buffer)
+        self.data['time'][start:stop] = times
+        for j, variable in enumerate(self.variables):
+            variable[start:stop, :] = buffer[:, :, j]
+        self.data.sync()
+
+    def close(self):
+        self.data.close()
+
+
+class _ZarrFile:
+    """(time, basin) arrays in a Zarr group, resized as the chunks are written."""
+
+    def __init__(self, path, var_names, n_basins, basin_ids, chunk_steps, complevel, dtype):
+        import zarr
+        from numcodecs import Blosc
+        self.group = zarr.open_group(str(path), mode='w')
+        compressor = Blosc(cname='zstd', clevel=complevel)
+        self.times = self.group.zeros('time', shape=(0,), chunks=(chunk_steps,), dtype='f8')
+        if basin_ids is not None:
+            self.group.array('basin_id', np.array([str(x) for x in basin_ids]))
+        self.arrays = [self.group.create(var_name, shape=(0, n_basins), chunks=(chunk_steps, n_basins), dtype=dtype,
+                                        compressor=compressor, fill_value=np.nan)
+                       for var_name in var_names]
+
+    def write(self, start, buffer, times):
+        stop = start + len(buffer)
+        for array in [self.times] + self.arrays:
+            if array.shape[0] < stop:
+                array.resize((stop,) + array.shape[1:])
+        self.times[start:stop] = times
+        for j, array in enumerate(self.arrays):
+            array[start:stop] = buffer[:, :, j]
+
+    def close(self):
+        pass
+
+
+#------------------------------------------------------------
+def _open_file(file_format, path, var_names, n_basins, basin_ids, chunk_steps, complevel, dtype):
+    file_class = _ZarrFile if file_format == 'zarr' else _NetCDFFile
+    return file_class(path, var_names, n_basins, basin_ids, chunk_steps, complevel, dtype)
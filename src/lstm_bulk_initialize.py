@@ -0,0 +1,71 @@
+"""Initialize a large set of BMI LSTM instances in parallel.
+
+Calling ``bmi_LSTM.initialize()`` once per catchment re-reads the training configuration, the scaler pickle and the
+trained weights for every instance, even though thousands of catchments usually share one trained model. The bulk
+initializer parses the BMI configuration files concurrently, loads each distinct model bundle once and then builds the
+instances on a thread pool. The returned instances are ready for ``update()``.
+
+Example (from the ``/src`` directory):
+
+    import lstm_bulk_initialize
+    models, stats = lstm_bulk_initialize.bulk_initialize(['../bmi_config_files/01022500_hourly_all_attributes_forcings.yml'])
+    print(stats['wall_time'], stats['bytes_read'])
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# This is the BMI LSTM that we will be initializing
+import bmi_lstm
+
+
+def bulk_initialize(bmi_cfg_files, max_workers=None):
+    """
+    Initialize one ``bmi_LSTM`` instance per BMI configuration file.
+
+    Parameters
+    ----------
+    bmi_cfg_files : list of str or Path
+        BMI configuration files, one per instance.
+    max_workers : int, optional
+        Size of the thread pool. Defaults to the ``ThreadPoolExecutor`` default.
+
+    Returns
+    -------
+    models : list of bmi_lstm.bmi_LSTM
+        Initialized instances, in the same order as ``bmi_cfg_files``.
+    stats : dict
+        ``wall_time`` (seconds), ``bytes_read`` (total size of all files read), ``n_instances`` and ``n_bundles``
+        (the number of distinct trained models loaded).
+    """
+    start_time = time.perf_counter()
+    bmi_cfg_files = [Path(bmi_cfg_file) for bmi_cfg_file in bmi_cfg_files]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        # ------------- Parse all the BMI configurations ---------------------#
+        cfgs_bmi = list(executor.map(bmi_lstm.read_bmi_config, bmi_cfg_files))
+        bytes_read = sum(bmi_cfg_file.stat().st_size for bmi_cfg_file in bmi_cfg_files)
+
+        # ------------- Load each distinct trained model once ----------------#
+        # Keyed on the resolved training configuration, weights and ONNX files, as different relative paths can
+        # point to the same files, and loaded as initialize_from_config() would.
+        bundle_keys = [bmi_lstm.bundle_key(cfg_bmi) for cfg_bmi in cfgs_bmi]
+        unique_cfgs = dict(zip(bundle_keys, cfgs_bmi))
+        bundles = dict(zip(unique_cfgs, executor.map(bmi_lstm.load_config_bundle, unique_cfgs.values())))
+        bytes_read += sum(bundle['bytes_read'] for bundle in bundles.values())
+
+        # ------------- Build the instances ----------------------------------#
+        def _build(cfg_bmi, bundle_key):
+            model = bmi_lstm.bmi_LSTM()
+            model.initialize_from_config(cfg_bmi, model_bundle=bundles[bundle_key])
+            return model
+
+        models = list(executor.map(_build, cfgs_bmi, bundle_keys))
+
+    stats = {'wall_time': time.perf_counter() - start_time,
+             'bytes_read': bytes_read,
+             'n_instances': len(models),
+             'n_bundles': len(bundles)}
+
+    return models, stats
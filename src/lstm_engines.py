@@ -0,0 +1,243 @@
+"""Inference engines that run the trained LSTM of a ``bmi_LSTM``.
+
+An engine holds the weights of a trained ``nextgen_cuda_lstm.Nextgen_CudaLSTM`` (the LSTM cell and the head) and runs
+them on scaled inputs. ``bmi_LSTM`` does all its forward passes through its engine, chosen with the ``engine:`` key of
+the BMI configuration:
+
+    torch         eager PyTorch, the default
+    torchscript   the same module compiled with TorchScript
+    numpy         the LSTM cell written in NumPy, no torch at run time
+    onnxruntime   the LSTM exported to ONNX (see lstm_onnx.py), run with ONNX Runtime on CPU
+
+Other engines are added by subclassing ``LSTMEngine`` and decorating the class with ``@register_engine``. The inputs,
+states and outputs of all the engines are NumPy arrays, so the instances do not depend on the engine they run with.
+Every engine is checked against the step-wise reference by ``run_equivalence_harness.py``.
+"""
+import copy
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+
+# Engine classes by name, see register_engine()
+_engines = {}
+
+
+def register_engine(engine_class):
+    """Class decorator adding an ``LSTMEngine`` subclass to the engines selectable by name."""
+    _engines[engine_class.name] = engine_class
+    return engine_class
+
+
+def engine_names():
+    """Names of the registered engines."""
+    return list(_engines)
+
+
+def make_engine(name, lstm, dtype=np.float32, bfloat16_matmul=False):
+    """
+    Make an engine from a trained LSTM.
+
+    Parameters
+    ----------
+    name : str
+        Registered engine name, see ``engine_names()``.
+    lstm : nextgen_cuda_lstm.Nextgen_CudaLSTM
+        Trained LSTM, with weights of type ``dtype``. The onnxruntime engine also takes an exported ONNX file.
+    dtype : numpy dtype
+        Type of the inputs, states and outputs.
+    bfloat16_matmul : bool
+        Do the matrix products in bfloat16, for the engines that support it (see ``bmi_LSTM.set_numeric_type()``).
+    """
+    if name not in _engines:
+        raise ValueError("engine must be one of {}, not '{}'".format(engine_names(), name))
+    return _engines[name](lstm, dtype, bfloat16_matmul)
+
+
+def module_nbytes(module):
+    """Bytes of the parameters of a torch module."""
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
+
+class LSTMEngine:
+    """
+    Base class of the inference engines.
+
+    Scaled inputs have shape (sequence length, batch size, input size), states (1, batch size, hidden size) and
+    outputs (sequence length, batch size, output size). Engines hold no states, so one engine can be shared by all the
+    instances running the same trained LSTM in the same numeric type.
+    """
+
+    name = None
+
+    def __init__(self, lstm, dtype=np.float32, bfloat16_matmul=False):
+        self.dtype = np.dtype(dtype)
+        self.bfloat16_matmul = bfloat16_matmul
+        # The trained module itself, for what only works with torch (e.g. bmi_LSTM.compare_to_float64())
+        self.lstm = lstm
+        self.load_weights(lstm)
+
+    #------------------------------------------------------------
+    def load_weights(self, lstm):
+        """Take the weights of a trained ``Nextgen_CudaLSTM``, and set ``hidden_layer_size``."""
+        raise NotImplementedError
+
+    #------------------------------------------------------------
+    def weights_nbytes(self):
+        """Bytes of the weights the engine runs, by default those of the trained module."""
+        return module_nbytes(self.lstm)
+
+    #------------------------------------------------------------
+    def sequence(self, inputs_scaled, h_t, c_t):
+        """Run a sequence of scaled inputs. Returns the outputs and the final ``h_t`` and ``c_t``."""
+        raise NotImplementedError
+
+    #------------------------------------------------------------
+    def step(self, inputs_scaled, h_t, c_t):
+        """Run one time step, ``inputs_scaled`` with shape (batch size, input size)."""
+        return self.sequence(inputs_scaled[np.newaxis], h_t, c_t)
+
+    #------------------------------------------------------------
+    def batch_step(self, inputs_list, h_list, c_list):
+        """
+        Run one time step of several instances as one batch.
+
+        Takes lists with the scaled inputs and states of each instance, and returns lists of their outputs and states.
+        """
+        splits = np.cumsum([inputs.shape[0] for inputs in inputs_list])[:-1]
+        output, h_t, c_t = self.step(np.concatenate(inputs_list), np.concatenate(h_list, axis=1),
+                                     np.concatenate(c_list, axis=1))
+        return np.split(output, splits, axis=1), np.split(h_t, splits, axis=1), np.split(c_t, splits, axis=1)
+
+
+@register_engine
+class TorchEngine(LSTMEngine):
+    """The trained ``Nextgen_CudaLSTM`` module itself, run with eager PyTorch."""
+
+    name = 'torch'
+
+    def load_weights(self, lstm):
+        self.hidden_layer_size = lstm.hidden_layer_size
+        self.module = lstm
+
+    def weights_nbytes(self):
+        return module_nbytes(self.module)
+
+    def _matmul_context(self):
+        import torch
+        if self.bfloat16_matmul:
+            return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+        return nullcontext()
+
+    def sequence(self, inputs_scaled, h_t, c_t):
+        import torch
+        with torch.no_grad(), self._matmul_context():
+            output, h_t, c_t = self.module.forward(torch.from_numpy(inputs_scaled), torch.from_numpy(h_t),
+                                                   torch.from_numpy(c_t))
+        # In bfloat16 mode keep the outputs and states in full precision
+        torch_dtype = getattr(torch, self.dtype.name)
+        return output.to(torch_dtype).numpy(), h_t.to(torch_dtype).numpy(), c_t.to(torch_dtype).numpy()
+
+
+@register_engine
+class TorchScriptEngine(TorchEngine):
+    """The trained LSTM compiled with TorchScript."""
+
+    name = 'torchscript'
+
+    def load_weights(self, lstm):
+        import torch
+        self.hidden_layer_size = lstm.hidden_layer_size
+        self.module = torch.jit.script(copy.deepcopy(lstm))
+
+
+@register_engine
+class NumpyEngine(LSTMEngine):
+    """The forward pass of ``Nextgen_CudaLSTM`` in NumPy, with the weights copied from one."""
+
+    name = 'numpy'
+
+    def load_weights(self, lstm):
+        self.hidden_layer_size = lstm.hidden_layer_size
+        # Transposed so the gates are x @ W, PyTorch's gate order is input, forget, cell, output
+        self.weight_ih = lstm.lstm.weight_ih_l0.detach().numpy().T.astype(self.dtype)
+        self.weight_hh = lstm.lstm.weight_hh_l0.detach().numpy().T.astype(self.dtype)
+        self.bias = (lstm.lstm.bias_ih_l0 + lstm.lstm.bias_hh_l0).detach().numpy().astype(self.dtype)
+        self.head_weight = lstm.head.weight.detach().numpy().T.astype(self.dtype)
+        self.head_bias = lstm.head.bias.detach().numpy().astype(self.dtype)
+
+    def weights_nbytes(self):
+        return sum(x.nbytes for x in [self.weight_ih, self.weight_hh, self.bias, self.head_weight, self.head_bias])
+
+    @staticmethod
+    def _sigmoid(x):
+        # Written with tanh so large negative gates do not overflow
+        return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+    def sequence(self, inputs_scaled, h_t, c_t):
+        H = self.hidden_layer_size
+        h_t = h_t[0]
+        c_t = c_t[0]
+        # The input part of the gates does not depend on the states, so do it for all time steps at once
+        input_gates = inputs_scaled @ self.weight_ih + self.bias
+        hidden = np.empty(inputs_scaled.shape[:2] + (H,), dtype=input_gates.dtype)
+        for t in range(inputs_scaled.shape[0]):
+            gates = input_gates[t] + h_t @ self.weight_hh
+            i_t = self._sigmoid(gates[:, :H])
+            f_t = self._sigmoid(gates[:, H:2*H])
+            g_t = np.tanh(gates[:, 2*H:3*H])
+            o_t = self._sigmoid(gates[:, 3*H:])
+            c_t = f_t * c_t + i_t * g_t
+            h_t = o_t * np.tanh(c_t)
+            hidden[t] = h_t
+        return hidden @ self.head_weight + self.head_bias, h_t[np.newaxis], c_t[np.newaxis]
+
+
+@register_engine
+class OnnxRuntimeEngine(LSTMEngine):
+    """
+    The LSTM exported to ONNX, run with ONNX Runtime on CPU.
+
+    Made from an exported file (``lstm_onnx.export_onnx()``), which needs no torch, or from a torch module that is
+    exported on the fly.
+    """
+
+    name = 'onnxruntime'
+
+    def load_weights(self, lstm):
+        if isinstance(lstm, (str, bytes)) or hasattr(lstm, 'read_bytes'):
+            self._graph = lstm if isinstance(lstm, bytes) else Path(lstm).read_bytes()
+        else:
+            import lstm_onnx
+            self._graph = lstm_onnx.export_lstm(lstm)
+        self._start_session()
+
+    def weights_nbytes(self):
+        return len(self._graph)
+
+    def _start_session(self):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(self._graph, providers=['CPUExecutionProvider'])
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if metadata.get('scalers_folded') == 'True':
+            raise ValueError("This ONNX graph has the scalers folded in, it does not take the scaled inputs of bmi_LSTM")
+        self.hidden_layer_size = int(metadata['hidden_size'])
+        self._graph_dtype = np.float64 if self.session.get_inputs()[0].type == 'tensor(double)' else np.float32
+
+    # The session cannot be pickled, start a new one from the graph instead
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['session']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._start_session()
+
+    def sequence(self, inputs_scaled, h_t, c_t):
+        feed = {'inputs': inputs_scaled.astype(self._graph_dtype, copy=False),
+                'h_t': h_t.astype(self._graph_dtype, copy=False),
+                'c_t': c_t.astype(self._graph_dtype, copy=False)}
+        output, h_t, c_t = self.session.run(None, feed)
+        return (output.astype(self.dtype, copy=False), h_t.astype(self.dtype, copy=False),
+                c_t.astype(self.dtype, copy=False))
@@ -0,0 +1,150 @@
+"""Faster alternatives to stepping the BMI LSTM with ``update()``.
+
+Each ``run_*`` function replays a forcing series through an initialized ``bmi_LSTM`` and returns the runoff depth (mm)
+for every time step, so that it can be checked against the step-wise reference, ``run_stepwise()``. See
+``run_equivalence_harness.py`` for the checks and timings.
+
+    sequence              the whole series in one forward pass (``bmi_LSTM.run_sequence()``)
+    batched               separate basin instances sharing a trained model stepped together as one batch
+                          (an instance with several basins does this in update() itself)
+    fused_normalization   input and output scalers folded into the LSTM and head weights
+    numpy                 the whole series through the NumPy engine, no torch at run time
+    quantized             int8 dynamic quantization of the LSTM and head weights
+
+The engines of ``lstm_engines.py`` (e.g. TorchScript) are selected in the BMI configuration and run through
+``update()``, so they are checked with ``run_stepwise()``.
+"""
+import copy
+
+import numpy as np
+import torch
+
+import lstm_engines
+
+
+#------------------------------------------------------------
+def run_stepwise(model, dynamic_inputs):
+    """
+    Reference path: set the forcings through BMI and call ``update()`` for every time step.
+
+    Parameters
+    ----------
+    model : bmi_lstm.bmi_LSTM
+        Initialized model, it is advanced by the number of time steps.
+    dynamic_inputs : np.ndarray
+        Forcings with shape (number of time steps, number of dynamic inputs), ordered as
+        ``model.cfg_train['dynamic_inputs']``, or (number of time steps, number of basins, number of dynamic inputs)
+        for a model with several basins.
+
+    Returns
+    -------
+    np.ndarray
+        Runoff depth (mm) for each time step, and each basin if ``dynamic_inputs`` has a basin dimension.
+    """
+    forcing_names = [model._var_name_map_short_first[x] for x in model.cfg_train['dynamic_inputs']]
+    runoff_mm = np.zeros(dynamic_inputs.shape[:-1])
+    for k, forcings in enumerate(dynamic_inputs):
+        for forcing_name, value in zip(forcing_names, np.transpose(forcings)):
+            model.set_value(forcing_name, np.atleast_1d(value))
+        model.update()
+        runoff_mm[k] = model.surface_runoff_mm
+    return runoff_mm
+
+#------------------------------------------------------------
+def run_sequence(model, dynamic_inputs):
+    """Whole series in a single forward pass. Same arguments as ``run_stepwise()``."""
+    return model.run_sequence(dynamic_inputs)
+
+#------------------------------------------------------------
+def run_batched(models, dynamic_inputs):
+    """
+    Step several basins together, as one batch through the LSTM.
+
+    Parameters
+    ----------
+    models : list of bmi_lstm.bmi_LSTM
+        Initialized models of different basins, all running the same trained LSTM. They are not changed.
+    dynamic_inputs : np.ndarray
+        Forcings with shape (number of time steps, number of models, number of dynamic inputs).
+
+    Returns
+    -------
+    np.ndarray
+        Runoff depth (mm) with shape (number of time steps, number of models).
+    """
+    model = models[0]
+    h_list = [m.h_t for m in models]
+    c_list = [m.c_t for m in models]
+    static_inputs = np.array([[getattr(m, m._var_name_map_short_first[x]) for x in m.cfg_train['static_attributes']]
+                              for m in models], dtype=model._np_dtype)
+
+    runoff_mm = np.zeros(dynamic_inputs.shape[:2])
+    for k, forcings in enumerate(dynamic_inputs):
+        inputs = np.concatenate([forcings.astype(model._np_dtype), static_inputs], axis=1)
+        inputs_scaled = (inputs - model.input_mean) / model.input_std
+        output_list, h_list, c_list = model.engine.batch_step(list(inputs_scaled[:, np.newaxis]), h_list, c_list)
+        runoff_mm[k] = model._output_to_runoff_mm(np.concatenate(output_list, axis=1)[0, :, 0].astype(np.float64))
+    return runoff_mm
+
+#------------------------------------------------------------
+def fuse_normalization(model):
+    """
+    Fold the input and output scalers of a model into a copy of its LSTM.
+
+    With ``x_scaled = (x - mean) / std`` the input weights become ``W / std`` and the bias ``b - W mean / std``, so the
+    returned LSTM takes unscaled inputs. The head is folded the same way and returns runoff depth (mm per time step),
+    before the bound to zero.
+    """
+    return fold_scalers(model.lstm, model.input_mean, model.input_std, model.out_mean, model.out_std,
+                        model.cfg_train['target_variables'][0])
+
+#------------------------------------------------------------
+def fold_scalers(lstm, input_mean, input_std, out_mean, out_std, target_variable):
+    """``fuse_normalization()`` of an LSTM and scaler values, see ``bmi_lstm.scaler_values()``."""
+    fused_lstm = copy.deepcopy(lstm)
+    dtype = next(fused_lstm.parameters()).dtype
+    input_mean = np.asarray(input_mean, dtype=np.float64)
+    input_std = np.asarray(input_std, dtype=np.float64)
+
+    output_factor = (1/24) if target_variable == 'QObs(mm/d)' else 1.0
+    output_scale = float(out_std) * output_factor
+    output_shift = float(out_mean) * output_factor
+
+    with torch.no_grad():
+        weight_ih = fused_lstm.lstm.weight_ih_l0.double()
+        fused_lstm.lstm.bias_ih_l0.copy_((fused_lstm.lstm.bias_ih_l0.double()
+                                          - weight_ih @ torch.from_numpy(input_mean / input_std)).to(dtype))
+        fused_lstm.lstm.weight_ih_l0.copy_((weight_ih / torch.from_numpy(input_std)).to(dtype))
+        fused_lstm.head.bias.copy_((fused_lstm.head.bias.double() * output_scale + output_shift).to(dtype))
+        fused_lstm.head.weight.copy_((fused_lstm.head.weight.double() * output_scale).to(dtype))
+
+    return fused_lstm
+
+#------------------------------------------------------------
+def run_fused_normalization(model, dynamic_inputs):
+    """Whole series in one pass through ``fuse_normalization()``. Same arguments as ``run_stepwise()``."""
+    fused_engine = lstm_engines.TorchEngine(fuse_normalization(model), model._np_dtype, model.bfloat16_matmul)
+    inputs = model._input_sequence(dynamic_inputs).astype(model._np_dtype)
+    output, _, _ = fused_engine.sequence(inputs, model.h_t, model.c_t)
+    return np.maximum(output[:, 0, 0].astype(np.float64), 0.0)
+
+#------------------------------------------------------------
+def run_numpy(model, dynamic_inputs):
+    """Whole series through ``lstm_engines.NumpyEngine``. Same arguments as ``run_stepwise()``."""
+    numpy_engine = lstm_engines.NumpyEngine(model.lstm, dtype=model._np_dtype)
+    inputs = model._input_sequence(dynamic_inputs).astype(model._np_dtype)
+    inputs_scaled = (inputs - model.input_mean) / model.input_std
+    output, _, _ = numpy_engine.sequence(inputs_scaled, model.h_t, model.c_t)
+    return model._output_to_runoff_mm(output[:, 0, 0].astype(np.float64))
+
+#------------------------------------------------------------
+def quantize(lstm):
+    """Copy of a (float32) LSTM with int8 dynamically quantized weights."""
+    return torch.quantization.quantize_dynamic(lstm, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+
+#------------------------------------------------------------
+def run_quantized(model, dynamic_inputs):
+    """Step-wise, through ``update()``, with ``quantize()`` swapped in. The model's engine is replaced."""
+    model.lstm = quantize(model.lstm)
+    model.engine = lstm_engines.TorchEngine(model.lstm)
+    return run_stepwise(model, dynamic_inputs)
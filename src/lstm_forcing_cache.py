@@ -0,0 +1,196 @@
+"""Basin-major binary cache of the forcings of a NeuralHydrology format netCDF file, for repeated replays.
+
+Replaying the same forcings many times re-reads and decodes the netCDF variables every time. ``build_forcing_cache()``
+converts the (basin, date) variables of a file once into a float32 ``.npy`` array of shape (basin, time, variable),
+with a JSON index of the basins, variables and time steps. The cache goes into a directory named after the SHA-256
+hash of the file, so a changed file gets a new cache and an unchanged one, wherever it is, reuses the old one. The
+hash of each file is kept in ``file_hashes.json`` with the size and modification time of the file, and the file is only
+hashed again when these change, so opening the cache of a large file does not read the whole file.
+
+A ``ForcingCache`` memory-maps the array. The series of a basin are contiguous, so reading the forcings of some basins
+over some time steps touches only those bytes, and ``basin_forcings()`` returns a view without copying.
+``lstm_hindcast.run_hindcast()`` takes a ``ForcingCache`` in place of the netCDF file.
+
+Example (from the ``/src`` directory):
+
+    cache = lstm_forcing_cache.build_forcing_cache('../data/usgs-streamflow-nldas_hourly.nc')
+    lstm_hindcast.run_hindcast(model, cache)
+    precipitation = cache.basin_forcings('01022500', ['total_precipitation'])
+"""
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+default_cache_dir = Path('../data/forcing_cache')
+
+
+def file_hash(path, block_size=2**20):
+    """SHA-256 hash (hex digest) of the contents of a file."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+#------------------------------------------------------------
+def cached_file_hash(path, cache_dir=default_cache_dir):
+    """
+    ``file_hash()`` of a file, from ``file_hashes.json`` in ``cache_dir`` if the file's size and modification time
+    are unchanged since it was last hashed.
+    """
+    path = Path(path).resolve()
+    file_stat = path.stat()
+    stamp = [file_stat.st_size, file_stat.st_mtime_ns]
+    hashes_file = Path(cache_dir) / 'file_hashes.json'
+    try:
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+    entry = hashes.get(str(path))
+    if entry is not None and entry[:2] == stamp:
+        return entry[2]
+
+    key = file_hash(path)
+    hashes[str(path)] = stamp + [key]
+    # Written under a temporary name and renamed, so readers never see a partial file
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    partial_file = hashes_file.with_name('{}.{}.partial'.format(hashes_file.stem, os.getpid()))
+    with open(partial_file, 'w') as f:
+        json.dump(hashes, f)
+    os.replace(partial_file, hashes_file)
+    return key
+
+#------------------------------------------------------------
+def build_forcing_cache(data_file, cache_dir=default_cache_dir, var_names=None, basins_per_read=64):
+    """
+    Convert the (basin, date) variables of a netCDF file into a cache, unless it was converted already.
+
+    Parameters
+    ----------
+    data_file : str or Path
+        NeuralHydrology format netCDF file, with a ``basin`` variable and variables of shape (basin, date).
+    cache_dir : str or Path
+        Directory the caches of all the files go into, one subdirectory per file hash.
+    var_names : list of str, optional
+        Variables to cache, by default all the (basin, date) variables. A cache missing some of them is rebuilt.
+    basins_per_read : int
+        Number of basins read from the netCDF file at a time.
+
+    Returns
+    -------
+    ForcingCache
+    """
+    key = cached_file_hash(data_file, cache_dir)
+    cache_path = Path(cache_dir) / key[:16]
+    if (cache_path / 'index.json').exists():
+        cache = ForcingCache(cache_path)
+        if var_names is None or set(var_names) <= set(cache.var_names):
+            return cache
+
+    # Written into a temporary directory of this process, which becomes the cache once complete
+    build_path = cache_path.with_name('{}.{}.building'.format(cache_path.name, os.getpid()))
+    shutil.rmtree(build_path, ignore_errors=True)
+    build_path.mkdir(parents=True)
+    with Dataset(data_file, 'r') as data:
+        if var_names is None:
+            var_names = [name for name, variable in data.variables.items()
+                         if variable.dimensions == ('basin', 'date')]
+        n_basins = data.dimensions['basin'].size
+        n_steps = data.dimensions['date'].size
+        values = np.lib.format.open_memmap(build_path / 'forcings.npy', mode='w+', dtype=np.float32,
+                                           shape=(n_basins, n_steps, len(var_names)))
+        for start in range(0, n_basins, basins_per_read):
+            stop = min(start + basins_per_read, n_basins)
+            for j, var_name in enumerate(var_names):
+                values[start:stop, :, j] = np.ma.filled(data[var_name][start:stop, :].astype(np.float32), np.nan)
+        values.flush()
+        del values
+        index = {'source': Path(data_file).name,
+                 'sha256': key,
+                 'basin_ids': [str(data['basin'][x]).zfill(8) for x in range(n_basins)],
+                 'var_names': list(var_names),
+                 'n_steps': n_steps,
+                 'date': data['date'][:].tolist() if 'date' in data.variables else None}
+    with open(build_path / 'index.json', 'w') as f:
+        json.dump(index, f)
+
+    if (cache_path / 'index.json').exists():
+        # An older cache lacking some of the variables
+        shutil.rmtree(cache_path, ignore_errors=True)
+    try:
+        build_path.rename(cache_path)
+    except OSError:
+        # Another process built the cache at the same time and renamed its build first
+        cache = ForcingCache(cache_path)
+        if set(var_names) <= set(cache.var_names):
+            shutil.rmtree(build_path)
+            return cache
+        del cache
+        shutil.rmtree(cache_path, ignore_errors=True)
+        build_path.rename(cache_path)
+    return ForcingCache(cache_path)
+
+
+class ForcingCache:
+    """
+    Memory-mapped forcings with shape (basin, time, variable), made by ``build_forcing_cache()``.
+
+    Parameters
+    ----------
+    cache_path : str or Path
+        Directory of the cache of one file.
+    """
+
+    def __init__(self, cache_path):
+        self.path = Path(cache_path)
+        with open(self.path / 'index.json') as f:
+            self.index = json.load(f)
+        self.basin_ids = self.index['basin_ids']
+        self.var_names = self.index['var_names']
+        self.n_steps = self.index['n_steps']
+        self.values = np.load(self.path / 'forcings.npy', mmap_mode='r')
+        self._basin_rows = {basin_id: row for row, basin_id in enumerate(self.basin_ids)}
+        self._columns = {var_name: j for j, var_name in enumerate(self.var_names)}
+
+    #------------------------------------------------------------
+    def basin_rows(self, basin_ids):
+        """Rows of some basins in the cache."""
+        return [self._basin_rows[str(basin_id).zfill(8)] for basin_id in basin_ids]
+
+    #------------------------------------------------------------
+    def basin_forcings(self, basin_id, var_names=None):
+        """
+        Forcings of one basin with shape (time, variable), all the variables by default.
+
+        A view of the memory-mapped array when the variables are all those of the cache or a single one.
+        """
+        series = self.values[self.basin_rows([basin_id])[0]]
+        if var_names is None:
+            return series
+        columns = [self._columns[x] for x in var_names]
+        if len(columns) == 1:
+            return series[:, columns[0]:columns[0] + 1]
+        return series[:, columns]
+
+    #------------------------------------------------------------
+    def read(self, var_names, basin_rows, start, stop):
+        """
+        Forcings of some basins and time steps, with shape (time, basin, variable), missing values NaN.
+
+        The same values, as float64, as ``lstm_hindcast`` reads from the netCDF file.
+        """
+        columns = [self._columns[x] for x in var_names]
+        values = self.values[np.asarray(basin_rows), start:stop][:, :, columns]
+        return np.swapaxes(values, 0, 1).astype(np.float64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
@@ -0,0 +1,131 @@
+"""Hindcast runs of the BMI LSTM over a NeuralHydrology format netCDF file, e.g. ``data/usgs-streamflow-nldas_hourly.nc``.
+
+The forcings are read, from the file or from a ``lstm_forcing_cache.ForcingCache`` of it, in chunks of time steps
+and each chunk is run through ``bmi_LSTM.run_sequence()``, so memory use does not grow with the length of the run.
+An attached ``lstm_skill_metrics.StreamingSkill`` evaluator is updated with the simulated runoff and the observed
+streamflow of every chunk.
+
+Example (from the ``/src`` directory):
+
+    model = bmi_lstm.bmi_LSTM()
+    model.initialize_from_config(bmi_lstm.combine_bmi_configs(basin_cfgs))
+    evaluator = lstm_hindcast.run_hindcast(model, '../data/usgs-streamflow-nldas_hourly.nc')
+    print(evaluator.scores()['nse'])
+"""
+import numpy as np
+from netCDF4 import Dataset
+
+import lstm_skill_metrics
+
+# Observed streamflow (mm per hour) in the sample data
+default_obs_var_name = 'qobs_CAMELS_mm_per_hour'
+
+
+def model_basin_ids(model):
+    """Basin ids of a model, as 8 digit strings."""
+    return [str(basin_id).zfill(8) for basin_id in np.atleast_1d(model.cfg_bmi['basin_id'])]
+
+
+#------------------------------------------------------------
+def run_hindcast(model, data_file, n_steps=None, evaluator=None, obs_var_name=default_obs_var_name,
+                 chunk_size=24*30, forcing_basin_ids=None, on_chunk=None, start_step=0, result_cache=None):
+    """
+    Run an initialized model over the forcings of its basins in a netCDF file, scoring it against the observations.
+
+    Parameters
+    ----------
+    model : bmi_lstm.bmi_LSTM
+        Initialized model, with one or several basins that are all in the file. It is advanced by ``n_steps``.
+    data_file : str or Path or lstm_forcing_cache.ForcingCache
+        NeuralHydrology format netCDF file, with variables of shape (basin, date), or a cache of one.
+    n_steps : int, optional
+        Number of time steps to run, all the time steps in the file by default.
+    evaluator : lstm_skill_metrics.StreamingSkill, optional
+        Evaluator to update, a new one is made if not given. Set ``obs_var_name`` to None to run without one.
+    obs_var_name : str
+        Variable with the observed streamflow, in mm per time step.
+    chunk_size : int
+        Number of time steps read and run at a time.
+    forcing_basin_ids : list of str, optional
+        Basins of the file whose forcings and observations are used for the model's basins, by default the model's
+        own basins. Other basins can stand in, e.g. to benchmark basins that are not in the file.
+    on_chunk : callable, optional
+        Called after each chunk with its first time step (from ``start_step``) and its runoff depth (mm), with shape
+        (time, basin).
+    start_step : int
+        Time step of the file to start from, e.g. to continue from a checkpoint (see ``bmi_LSTM.load_states()``).
+    result_cache : lstm_result_cache.ResultCache, optional
+        Cache the chunks are run through, so chunks run before are read from it instead.
+
+    Returns
+    -------
+    lstm_skill_metrics.StreamingSkill
+        The evaluator, or None if ``obs_var_name`` is None.
+    """
+    basin_ids = model_basin_ids(model)
+    if forcing_basin_ids is None:
+        forcing_basin_ids = basin_ids
+    if evaluator is None and obs_var_name is not None:
+        evaluator = lstm_skill_metrics.StreamingSkill(len(basin_ids), basin_ids)
+
+    with open_forcings(data_file) as data:
+        basin_rows = data.basin_rows(forcing_basin_ids)
+        n_steps = data.n_steps - start_step if n_steps is None else min(n_steps, data.n_steps - start_step)
+
+        for start in range(0, n_steps, chunk_size):
+            stop = min(start + chunk_size, n_steps)
+            # Forcings with shape (time, basin, dynamic input)
+            dynamic_inputs = data.read(model.cfg_train['dynamic_inputs'], basin_rows, start_step + start,
+                                       start_step + stop)
+            if result_cache is None:
+                runoff_mm = model.run_sequence(dynamic_inputs)
+            else:
+                runoff_mm = result_cache.run_sequence(model, dynamic_inputs)
+            if on_chunk is not None:
+                on_chunk(start, runoff_mm)
+            if evaluator is not None:
+                evaluator.update(runoff_mm, data.read([obs_var_name], basin_rows, start_step + start,
+                                                      start_step + stop)[:, :, 0])
+
+    return evaluator
+
+#------------------------------------------------------------
+def open_forcings(data_file):
+    """
+    Forcings of a NeuralHydrology format netCDF file, or of a ``lstm_forcing_cache.ForcingCache``, to read with
+    ``read(var_names, basin_rows, start, stop)``. Use as a context manager.
+    """
+    if hasattr(data_file, 'read'):
+        return data_file
+    return _NetCDFForcings(data_file)
+
+
+class _NetCDFForcings:
+    """The (basin, date) variables of a netCDF file, read like a ``lstm_forcing_cache.ForcingCache``."""
+
+    def __init__(self, data_file):
+        self.data = Dataset(data_file, 'r')
+        self.n_steps = self.data.dimensions['date'].size
+        self.basin_ids = [str(self.data['basin'][x]).zfill(8) for x in range(self.data.dimensions['basin'].size)]
+        self._basin_rows = {basin_id: row for row, basin_id in enumerate(self.basin_ids)}
+
+    def basin_rows(self, basin_ids):
+        return [self._basin_rows[str(basin_id).zfill(8)] for basin_id in basin_ids]
+
+    def read(self, var_names, basin_rows, start, stop):
+        """Values with shape (time, basin, variable), missing values NaN."""
+        return np.stack([_read_chunk(self.data, x, basin_rows, start, stop) for x in var_names], axis=-1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.data.close()
+
+#------------------------------------------------------------
+def _read_chunk(data, var_name, basin_rows, start, stop):
+    """Values of a (basin, date) variable for some basins and time steps, shape (time, basin), missing values NaN."""
+    # netCDF indexing needs increasing rows, the same row can stand in for several basins
+    rows, basin_index = np.unique(basin_rows, return_inverse=True)
+    values = np.ma.filled(data[var_name][rows, start:stop].astype(np.float64), np.nan)
+    return values[basin_index].T
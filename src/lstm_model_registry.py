@@ -0,0 +1,151 @@
+"""Registry of trained LSTM variants shared by running instances, with hot reload and LRU eviction.
+
+A ``ModelRegistry`` loads each trained model variant (training configuration and weights file) once, and hands the
+same bundle to every instance that asks for it. When a new training epoch is rolled out, ``reload()`` swaps a whole
+set of running instances to it with ``bmi_LSTM.reload_model()``, keeping their hidden and cell states, instead of
+tearing them down and initializing them again.
+
+The registry keeps the variants in least recently used order. When their estimated size exceeds the memory budget,
+the least recently used idle variants are dropped; they are loaded again if asked for. Every instance adds itself to
+the users of the bundle it runs (a weak set in the bundle, see ``bmi_LSTM._use_bundle()``), so a variant is idle once
+no live instance runs it, however the instances got it.
+
+Variants are loaded from disk outside the registry's lock, so a slow load does not hold up instances asking for
+variants already loaded. Threads asking for a variant being loaded wait for that load rather than starting another.
+
+Example (from the ``/src`` directory):
+
+    registry = lstm_model_registry.ModelRegistry(memory_budget=200 * 2**20)
+    model.initialize_from_config(cfg, model_bundle=registry.get(cfg['train_cfg_file']))
+    ...
+    registry.reload([model], cfg['train_cfg_file'], weights_file='.../model_epoch009.pt')
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+import bmi_lstm
+import lstm_engines
+
+
+def bundle_nbytes(model_bundle):
+    """
+    Estimated memory use of a model bundle: the trained weights, once for the LSTM and once per engine that holds
+    its own copy of them (the float32 torch engine runs the LSTM itself).
+    """
+    lstm = model_bundle['lstm']
+    if lstm is None:
+        weights_nbytes = Path(model_bundle['onnx_file']).stat().st_size
+    else:
+        weights_nbytes = lstm_engines.module_nbytes(lstm)
+    return weights_nbytes + sum(engine.weights_nbytes() for engine in model_bundle.get('engines', {}).values()
+                                if getattr(engine, 'module', None) is not lstm)
+
+
+class ModelRegistry:
+    """
+    Trained model bundles by variant, evicted in least recently used order under a memory budget.
+
+    Parameters
+    ----------
+    memory_budget : int, optional
+        Bytes the variants may use together (estimated with ``bundle_nbytes()``), no limit if not given. Variants run
+        by live instances are never evicted, so the budget can be exceeded while they are.
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self._bundles = OrderedDict()
+        # Futures of the variants being loaded, for the threads asking for them meanwhile
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.n_loads = 0
+        self.n_evictions = 0
+
+    #------------------------------------------------------------
+    @staticmethod
+    def variant_key(train_cfg_file, weights_file=None):
+        """Key of a variant: the resolved training configuration and weights files."""
+        if weights_file is None:
+            cfg_train, _ = bmi_lstm.read_training_config(train_cfg_file)
+            weights_file = bmi_lstm.trained_model_file(cfg_train)
+        return (str(Path(train_cfg_file).resolve()), str(Path(weights_file).resolve()))
+
+    #------------------------------------------------------------
+    def get(self, train_cfg_file, weights_file=None):
+        """
+        Bundle of a variant, loaded with ``bmi_lstm.load_model_bundle()`` if it is not in the registry.
+
+        Parameters
+        ----------
+        train_cfg_file : str or Path
+            Training configuration of the trained model.
+        weights_file : str or Path, optional
+            Trained weights, by default those of the last training epoch.
+        """
+        key = self.variant_key(train_cfg_file, weights_file)
+        with self._lock:
+            if key in self._bundles:
+                self._bundles.move_to_end(key)
+                return self._bundles[key]
+            future = self._loading.get(key)
+            if future is None:
+                future = self._loading[key] = Future()
+                loading = True
+            else:
+                loading = False
+        if not loading:
+            return future.result()
+
+        try:
+            bundle = bmi_lstm.load_model_bundle(train_cfg_file, weights_file)
+        except BaseException as error:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(error)
+            raise
+        with self._lock:
+            self._bundles[key] = bundle
+            del self._loading[key]
+            self.n_loads += 1
+            self._evict(keep=key)
+        future.set_result(bundle)
+        return bundle
+
+    #------------------------------------------------------------
+    def reload(self, models, train_cfg_file, weights_file=None):
+        """
+        Swap running instances to another variant, keeping their states (see ``bmi_LSTM.reload_model()``).
+
+        All the instances are checked before any of them is changed, so either all or none of them are reloaded.
+        """
+        bundle = self.get(train_cfg_file, weights_file)
+        for model in models:
+            model.check_reload(bundle)
+            # Makes the engine of the model's type, the bundle keeps it for reload_model()
+            model._get_engine(bundle)
+        for model in models:
+            model.reload_model(bundle)
+        # The variants the instances ran before may be idle now
+        with self._lock:
+            self._evict(keep=self.variant_key(train_cfg_file, weights_file))
+        return bundle
+
+    #------------------------------------------------------------
+    @property
+    def nbytes(self):
+        """Estimated memory use of the variants in the registry."""
+        return sum(bundle_nbytes(bundle) for bundle in self._bundles.values())
+
+    #------------------------------------------------------------
+    def _evict(self, keep):
+        """Drop least recently used idle variants, other than ``keep``, until the registry fits in the budget."""
+        if self.memory_budget is None:
+            return
+        for key in list(self._bundles):
+            if self.nbytes <= self.memory_budget:
+                break
+            if key != keep and len(self._bundles[key].get('users', ())) == 0:
+                del self._bundles[key]
+                self.n_evictions += 1
@@ -0,0 +1,221 @@
+"""Domain-decomposed hindcast runs of many basins over MPI ranks, with ``mpi4py``.
+
+The basins are partitioned over the ranks with a cost model, and each rank runs its part as one batched ``bmi_LSTM``
+(see ``bmi_lstm.combine_bmi_configs()``) with ``lstm_hindcast.run_hindcast()``. The runoff of all the ranks is
+written either
+
+    collective   with MPI-IO into one ``.npy`` file of shape (basin, time), each rank writing its rows of every chunk
+    per_rank     into one ``.npz`` file per rank, with the basin ids and runoff of that rank
+
+and the states of each rank are checkpointed with ``bmi_LSTM.save_states()``, one file per rank, so a run can be
+continued, with the same number of ranks, from the time step it stopped at. mpi4py is only needed here, not by
+``bmi_lstm``.
+
+To run on one Linux host (from the ``/src`` directory), see ``run_mpi_hindcast.py`` and ``run_mpi_scaling.py``:
+
+    mpirun -n 4 python ./run_mpi_hindcast.py
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+
+import bmi_lstm
+import camels_bmi_configs
+import lstm_hindcast
+
+output_modes = ['collective', 'per_rank']
+
+
+def partition_basins(n_basins, n_ranks, costs=None):
+    """
+    Partition basins over ranks so the ranks have about the same cost.
+
+    The basins are assigned in order of decreasing cost, each to the rank with the lowest total cost so far (the
+    longest processing time rule). All basins of a batched instance cost about the same per time step, so the default
+    cost is one per basin; measured costs (e.g. the run time of each basin's rank over its number of basins in a
+    previous run) balance basins with different record lengths or inputs.
+
+    Returns
+    -------
+    list of np.ndarray
+        Increasing basin indices of each rank.
+    """
+    costs = np.ones(n_basins) if costs is None else np.asarray(costs, dtype=np.float64)
+    rank_costs = np.zeros(n_ranks)
+    parts = [[] for _ in range(n_ranks)]
+    # Stable sort, so equal costs are dealt out in basin order
+    for basin in np.argsort(-costs, kind='stable'):
+        rank = int(np.argmin(rank_costs))
+        parts[rank].append(basin)
+        rank_costs[rank] += costs[basin]
+    return [np.sort(np.array(part, dtype=int)) for part in parts]
+
+#------------------------------------------------------------
+def rank_file(path, rank, suffix):
+    """File of one rank next to ``path``, e.g. ``states_rank0003.npz``."""
+    path = Path(path)
+    return path.with_name("{}_rank{:04d}{}".format(path.stem, rank, suffix))
+
+#------------------------------------------------------------
+def run_partition(template_cfg, basin_ids, data_file, n_steps=None, output_file=None, output_mode='collective',
+                  checkpoint_file=None, costs=None, forcing_basin_ids=None, chunk_size=24*30, comm=None):
+    """
+    Run this rank's part of the basins and write its outputs and states. Called by every rank of ``comm``.
+
+    Parameters
+    ----------
+    template_cfg : dict
+        Parsed BMI configuration the basin configurations are made from (see ``camels_bmi_configs.py``).
+    basin_ids : list of str
+        All the basins, in the order of the output rows. The same on every rank.
+    data_file : str or Path or lstm_forcing_cache.ForcingCache
+        NeuralHydrology format netCDF file with the forcings, or a cache of one.
+    n_steps : int, optional
+        Number of time steps, all those in the file (after the checkpoint's time) by default.
+    output_file : str or Path, optional
+        ``.npy`` file of the runoff depth (mm) of all the basins, or the name the per rank ``.npz`` files are made
+        from. Nothing is written if not given.
+    output_mode : str
+        One of ``output_modes``.
+    checkpoint_file : str or Path, optional
+        Name the per rank state checkpoints are made from. An existing checkpoint of this rank is loaded first.
+    costs : list of float, optional
+        Cost of each basin, see ``partition_basins()``.
+    forcing_basin_ids : list of str, optional
+        Basins of ``data_file`` whose forcings are used for each basin, see ``lstm_hindcast.run_hindcast()``.
+    chunk_size : int
+        Number of time steps run and written at a time.
+    comm : mpi4py.MPI.Comm, optional
+        Communicator, ``MPI.COMM_WORLD`` by default.
+
+    Returns
+    -------
+    dict or None
+        On rank 0, the ``n_ranks``, and the ``n_basins``, ``initialize_time``, ``run_time`` and ``write_time``
+        (seconds) of each rank. None on the other ranks.
+    """
+    from mpi4py import MPI
+
+    if output_mode not in output_modes:
+        raise ValueError("output_mode must be one of {}, not '{}'".format(output_modes, output_mode))
+    comm = MPI.COMM_WORLD if comm is None else comm
+    rank = comm.Get_rank()
+    rows = partition_basins(len(basin_ids), comm.Get_size(), costs)[rank]
+    my_basin_ids = [basin_ids[row] for row in rows]
+    if forcing_basin_ids is None:
+        forcing_basin_ids = basin_ids
+
+    start_time = time.perf_counter()
+    model = None
+    start_step = 0
+    if my_basin_ids:
+        camels_attributes = camels_bmi_configs.read_camels_attributes()
+        model = bmi_lstm.bmi_LSTM()
+        model.initialize_from_config(bmi_lstm.combine_bmi_configs(
+            [camels_bmi_configs.make_bmi_config(template_cfg, basin_id, camels_attributes)
+             for basin_id in my_basin_ids]))
+        if checkpoint_file is not None and rank_file(checkpoint_file, rank, '.npz').exists():
+            model.load_states(rank_file(checkpoint_file, rank, '.npz'))
+            start_step = int(round(model.t / model.get_time_step()))
+    initialize_time = time.perf_counter() - start_time
+
+    # Rank 0 always has basins, all the ranks continue from its time step
+    start_step = comm.bcast(start_step, root=0)
+    with lstm_hindcast.open_forcings(data_file) as data:
+        n_file_steps = data.n_steps - start_step
+    n_steps = n_file_steps if n_steps is None else min(n_steps, n_file_steps)
+
+    writer = None
+    if output_file is not None and output_mode == 'collective':
+        writer = _CollectiveWriter(comm, output_file, rows, len(basin_ids), n_steps)
+    elif output_file is not None:
+        runoff_mm = np.zeros((len(rows), n_steps), dtype=np.float32)
+
+    write_time = 0.0
+    def write_chunk(start, chunk_runoff_mm):
+        nonlocal write_time
+        write_start = time.perf_counter()
+        if writer is not None:
+            writer.write(start, chunk_runoff_mm)
+        elif output_file is not None:
+            runoff_mm[:, start:start + len(chunk_runoff_mm)] = chunk_runoff_mm.T
+        write_time += time.perf_counter() - write_start
+
+    start_time = time.perf_counter()
+    if model is not None:
+        lstm_hindcast.run_hindcast(model, data_file, n_steps, obs_var_name=None, chunk_size=chunk_size,
+                                   forcing_basin_ids=[forcing_basin_ids[row] for row in rows], on_chunk=write_chunk,
+                                   start_step=start_step)
+    else:
+        # A rank without basins still takes part in the collective writes
+        for start in range(0, n_steps, chunk_size):
+            write_chunk(start, np.zeros((min(chunk_size, n_steps - start), 0), dtype=np.float32))
+    run_time = time.perf_counter() - start_time - write_time
+
+    start_time = time.perf_counter()
+    if writer is not None:
+        writer.close()
+    elif output_file is not None:
+        np.savez(rank_file(output_file, rank, '.npz'), basin_id=np.array(my_basin_ids, dtype=str),
+                 runoff_mm=runoff_mm)
+    if checkpoint_file is not None and model is not None:
+        model.save_states(rank_file(checkpoint_file, rank, '.npz'))
+    write_time += time.perf_counter() - start_time
+
+    rank_stats = comm.gather({'n_basins': len(rows), 'initialize_time': initialize_time, 'run_time': run_time,
+                              'write_time': write_time}, root=0)
+    if rank != 0:
+        return None
+    stats = {'n_ranks': comm.Get_size()}
+    for key in rank_stats[0]:
+        stats[key] = [x[key] for x in rank_stats]
+    return stats
+
+#------------------------------------------------------------
+def read_per_rank_outputs(output_file, basin_ids):
+    """Runoff depth (mm) with shape (basin, time) of all the basins from the per rank ``.npz`` files."""
+    output_file = Path(output_file)
+    rows = {basin_id: row for row, basin_id in enumerate(basin_ids)}
+    runoff_mm = None
+    for rank_output_file in sorted(output_file.parent.glob(output_file.stem + '_rank*.npz')):
+        with np.load(rank_output_file) as outputs:
+            if runoff_mm is None:
+                runoff_mm = np.full((len(basin_ids), outputs['runoff_mm'].shape[1]), np.nan, dtype=np.float32)
+            runoff_mm[[rows[basin_id] for basin_id in outputs['basin_id']]] = outputs['runoff_mm']
+    return runoff_mm
+
+
+class _CollectiveWriter:
+    """
+    Writes the runoff of the basins of every rank into one ``.npy`` file of shape (basin, time) with MPI-IO.
+
+    Rank 0 writes the ``.npy`` header, then every chunk is one collective write, each rank's rows of the chunk
+    described by an indexed file view.
+    """
+
+    def __init__(self, comm, output_file, rows, n_basins, n_steps):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.comm = comm
+        self.rows = np.asarray(rows, dtype=int)
+        self.n_steps = n_steps
+        offset = None
+        if comm.Get_rank() == 0:
+            header = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float32, shape=(n_basins, n_steps))
+            offset = header.offset
+            del header
+        self.offset = comm.bcast(offset, root=0)
+        self.file = MPI.File.Open(comm, str(output_file), MPI.MODE_WRONLY)
+
+    def write(self, start, chunk_runoff_mm):
+        """Collective write of a chunk of runoff, with shape (time, this rank's basins)."""
+        n_chunk_steps = len(chunk_runoff_mm)
+        filetype = self.MPI.FLOAT.Create_indexed_block(n_chunk_steps, list(self.rows * self.n_steps + start))
+        filetype.Commit()
+        self.file.Set_view(self.offset, self.MPI.FLOAT, filetype)
+        self.file.Write_all(np.ascontiguousarray(np.asarray(chunk_runoff_mm, dtype=np.float32).T))
+        filetype.Free()
+
+    def close(self):
+        self.file.Close()
@@ -0,0 +1,186 @@
+"""ONNX export of trained LSTMs, and loading them for ONNX Runtime without torch.
+
+``export_onnx()`` converts the trained model of a NeuralHydrology run directory (through its ``config.yml``) into an
+ONNX graph of the LSTM cell and head, with the same ``head.net.0.*`` -> ``head.*`` weight remapping as
+``bmi_lstm.load_model_bundle()``. By default the graph takes scaled inputs, like the torch module, and is what the
+``onnxruntime`` engine of ``lstm_engines.py`` runs. With ``fold_scalers=True`` the input and output scalers are
+folded into the weights instead (see ``lstm_fast_paths.fold_scalers()``), for use outside ``bmi_LSTM``: the graph
+then takes unscaled inputs and returns runoff depth (mm per time step), before the bound to zero.
+
+The export needs torch and onnx. Running the graph only needs onnxruntime: give the exported file as ``onnx_file`` in
+the BMI configuration and ``bmi_LSTM`` is initialized from it with ``load_onnx_bundle()``, without importing torch.
+
+Example (from the ``/src`` directory):
+
+    python -c "import lstm_onnx; print(lstm_onnx.export_onnx('../trained_neuralhydrology_models/hourly_all_attributes_and_forcings/config.yml'))"
+"""
+import inspect
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import bmi_lstm
+
+# Names of the graph inputs and outputs
+input_names = ['inputs', 'h_t', 'c_t']
+output_names = ['output', 'h_t_out', 'c_t_out']
+
+onnx_opset_version = 17
+
+
+def export_lstm(lstm, onnx_file=None, metadata=None):
+    """
+    Export a ``Nextgen_CudaLSTM`` to ONNX, with dynamic sequence length and batch size.
+
+    Parameters
+    ----------
+    lstm : nextgen_cuda_lstm.Nextgen_CudaLSTM
+        Trained LSTM, the graph has the type of its weights.
+    onnx_file : str or Path, optional
+        File to write. If not given, the serialized graph is returned instead.
+    metadata : dict, optional
+        Extra string key value pairs stored in the graph.
+
+    Returns
+    -------
+    Path or bytes
+        ``onnx_file``, or the serialized graph.
+    """
+    import onnx
+    import torch
+
+    dtype = next(lstm.parameters()).dtype
+    example_inputs = (torch.zeros(1, 1, lstm.input_size, dtype=dtype),
+                      torch.zeros(1, 1, lstm.hidden_layer_size, dtype=dtype),
+                      torch.zeros(1, 1, lstm.hidden_layer_size, dtype=dtype))
+    dynamic_axes = {'inputs': {0: 'time', 1: 'batch'},
+                    'h_t': {1: 'batch'},
+                    'c_t': {1: 'batch'},
+                    'output': {0: 'time', 1: 'batch'},
+                    'h_t_out': {1: 'batch'},
+                    'c_t_out': {1: 'batch'}}
+
+    # Newer torch versions export with dynamo by default, keep the TorchScript based exporter of older versions
+    export_options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_file = os.path.join(tmp_dir, 'lstm.onnx')
+        with torch.no_grad():
+            torch.onnx.export(lstm, example_inputs, tmp_file, input_names=input_names, output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=onnx_opset_version, **export_options)
+        graph = onnx.load(tmp_file)
+
+    properties = {'hidden_size': str(lstm.hidden_layer_size), 'input_size': str(lstm.input_size),
+                  'scalers_folded': 'False'}
+    properties.update(metadata or {})
+    onnx.helper.set_model_props(graph, properties)
+
+    if onnx_file is None:
+        return graph.SerializeToString()
+    onnx.save(graph, str(onnx_file))
+    return Path(onnx_file)
+
+#------------------------------------------------------------
+def export_onnx(train_cfg_file, onnx_file=None, fold_scalers=False):
+    """
+    Export the trained model of a NeuralHydrology run directory to ONNX.
+
+    Parameters
+    ----------
+    train_cfg_file : str or Path
+        Training configuration (``config.yml``) of the trained model, as in the BMI configuration.
+    onnx_file : str or Path, optional
+        File to write, by default the weights file of the run directory with an ``.onnx`` suffix.
+    fold_scalers : bool
+        Fold the input and output scalers into the graph (see the module docstring).
+
+    Returns
+    -------
+    Path
+        The file written.
+    """
+    bundle = bmi_lstm.load_model_bundle(train_cfg_file)
+    cfg_train = bundle['cfg_train']
+    lstm = bundle['lstm']
+    if fold_scalers:
+        import lstm_fast_paths
+        input_mean, input_std, out_mean, out_std = bmi_lstm.scaler_values(cfg_train, bundle['train_data_scaler'])
+        lstm = lstm_fast_paths.fold_scalers(lstm, input_mean, input_std, out_mean, out_std,
+                                            cfg_train['target_variables'][0])
+
+    if onnx_file is None:
+        onnx_file = bmi_lstm.trained_model_file(cfg_train, '_folded.onnx' if fold_scalers else '.onnx')
+    metadata = {'scalers_folded': str(fold_scalers),
+                'inputs': json.dumps(cfg_train['dynamic_inputs'] + cfg_train['static_attributes']),
+                'target_variables': json.dumps(cfg_train['target_variables'])}
+    return export_lstm(lstm, onnx_file, metadata)
+
+#------------------------------------------------------------
+def load_onnx_bundle(train_cfg_file, onnx_file):
+    """
+    Model bundle (see ``bmi_lstm.load_model_bundle()``) of an exported graph, read without torch.
+
+    The bundle's ``lstm`` is None and ``onnx_file`` is the graph, for the ``onnxruntime`` engine. The float32 engine
+    is started with the bundle, and its session is checked against the training configuration with ``check_graph()``,
+    so instances of that type share it rather than starting a session of their own.
+    """
+    import lstm_engines
+
+    cfg_train, bytes_read = bmi_lstm.read_training_config(train_cfg_file)
+    train_data_scaler, scaler_bytes = bmi_lstm.read_train_data_scaler(cfg_train)
+    onnx_file = Path(onnx_file)
+    engine = lstm_engines.make_engine('onnxruntime', onnx_file)
+    check_graph(engine.session, cfg_train, onnx_file)
+
+    return {'cfg_train': cfg_train,
+            'train_data_scaler': train_data_scaler,
+            'lstm': None,
+            'onnx_file': onnx_file,
+            # Keyed as in bmi_LSTM._get_engine()
+            'engines': {('onnxruntime', 'float32'): engine},
+            'bytes_read': bytes_read + scaler_bytes + onnx_file.stat().st_size}
+
+#------------------------------------------------------------
+def check_graph(session, cfg_train, onnx_file=None):
+    """
+    Raise a ValueError if an exported graph does not fit a training configuration.
+
+    The graph inputs and outputs must have the names and shapes of ``export_lstm()``: inputs of the size of the
+    dynamic inputs and static attributes (the same ones, if the graph lists them), states of the hidden size and
+    outputs of the number of target variables.
+
+    Parameters
+    ----------
+    session : onnxruntime.InferenceSession
+        Session of the graph.
+    cfg_train : dict
+        Training configuration, see ``bmi_lstm.read_training_config()``.
+    onnx_file : str or Path, optional
+        File of the graph, for the error messages.
+    """
+    graph_name = "ONNX graph {}".format(onnx_file) if onnx_file is not None else "ONNX graph"
+    inputs = {x.name: x.shape for x in session.get_inputs()}
+    outputs = {x.name: x.shape for x in session.get_outputs()}
+    if list(inputs) != input_names or list(outputs) != output_names:
+        raise ValueError("{} has inputs {} and outputs {}, not {} and {}".format(
+                         graph_name, list(inputs), list(outputs), input_names, output_names))
+
+    lstm_inputs = cfg_train['dynamic_inputs'] + cfg_train['static_attributes']
+    hidden_size = cfg_train['hidden_size']
+    expected_sizes = {'inputs': len(lstm_inputs), 'h_t': hidden_size, 'c_t': hidden_size,
+                      'output': len(cfg_train['target_variables']), 'h_t_out': hidden_size, 'c_t_out': hidden_size}
+    for name, shape in list(inputs.items()) + list(outputs.items()):
+        if len(shape) != 3 or shape[-1] != expected_sizes[name]:
+            raise ValueError("{} has '{}' of shape {}, the training configuration needs a last dimension of {} "
+                             "({} dynamic inputs and {} static attributes, hidden size {})".format(
+                             graph_name, name, shape, expected_sizes[name], len(cfg_train['dynamic_inputs']),
+                             len(cfg_train['static_attributes']), hidden_size))
+
+    metadata = session.get_modelmeta().custom_metadata_map
+    if 'hidden_size' in metadata and int(metadata['hidden_size']) != hidden_size:
+        raise ValueError("{} has hidden size {}, the training configuration {}".format(
+                         graph_name, metadata['hidden_size'], hidden_size))
+    if 'inputs' in metadata and json.loads(metadata['inputs']) != lstm_inputs:
+        raise ValueError("{} was exported with the inputs {}, the training configuration has {}".format(
+                         graph_name, json.loads(metadata['inputs']), lstm_inputs))
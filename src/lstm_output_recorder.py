@@ -0,0 +1,142 @@
+"""Record BMI LSTM outputs into a preallocated memory-mapped file.
+
+Collecting outputs by appending to Python lists grows without bound over long runs. An ``OutputRecorder`` instead
+preallocates a ``np.memmap`` with shape (time, basin, variable) on disk. Each ``update()`` of an attached model writes
+its output variables into the row of the next time step, and the file is flushed periodically, so the run can be
+longer than fits in memory. Analysis code opens the file with ``open_recording()`` and reads it without copying.
+
+Example (from the ``/src`` directory):
+
+    recorder = lstm_output_recorder.OutputRecorder('./runoff.dat', n_steps=8760, n_basins=1)
+    model.attach_recorder(recorder)
+    for k in range(8760):
+        ...set forcings...
+        model.update()
+    model.finalize()
+    runoff, header = lstm_output_recorder.open_recording('./runoff.dat')
+"""
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class OutputRecorder:
+    """
+    Preallocated (time, basin, variable) output store backed by a memory-mapped file.
+
+    Several models can share one recorder, each writing its own basins (see ``bmi_LSTM.attach_recorder()``). Every
+    basin has its own time step index, so models do not need to be updated in any particular order.
+
+    Parameters
+    ----------
+    path : str or Path
+        Data file. A JSON header with the shape, type and names is written next to it (``<path>.json``).
+    n_steps : int
+        Number of time steps to preallocate.
+    n_basins : int
+        Number of basins.
+    var_names : list of str, optional
+        BMI output variables to record. Defaults to all the outputs of ``bmi_LSTM``.
+    basin_ids : list of str, optional
+        Basin ids, stored in the header for the analysis code.
+    dtype : numpy dtype
+        Type of the stored values.
+    flush_every : int
+        Number of time steps between flushes to disk.
+    """
+
+    def __init__(self, path, n_steps, n_basins=1, var_names=None, basin_ids=None, dtype=np.float32,
+                 flush_every=1000):
+        if var_names is None:
+            import bmi_lstm
+            var_names = list(bmi_lstm.bmi_LSTM._output_var_names)
+        self.path = Path(path)
+        self.header_path = Path(str(path) + '.json')
+        self.var_names = list(var_names)
+        self.basin_ids = None if basin_ids is None else [str(basin_id) for basin_id in basin_ids]
+        self.flush_every = flush_every
+        self.data = np.memmap(self.path, dtype=dtype, mode='w+', shape=(n_steps, n_basins, len(self.var_names)))
+
+        # Stride index: the next time step (row) to write, for each basin
+        self.next_step = np.zeros(n_basins, dtype=np.int64)
+        self._last_flush = 0
+        # Models sharing the recorder can be updated from several threads (see lstm_thread_pool.py)
+        self._lock = threading.RLock()
+        self._write_header()
+
+    #------------------------------------------------------------
+    @property
+    def n_recorded(self):
+        """Number of time steps recorded for all the basins."""
+        return int(self.next_step.min())
+
+    #------------------------------------------------------------
+    def record(self, model, first_basin=0):
+        """
+        Write the current output values of a model.
+
+        Parameters
+        ----------
+        model : bmi_lstm.bmi_LSTM
+            Model to read the output variables from.
+        first_basin : int
+            Basin index of the model's first value. A model with n values per variable fills n basins.
+        """
+        with self._lock:
+            for j, var_name in enumerate(self.var_names):
+                values = model.get_value_ptr(var_name)
+                basins = slice(first_basin, first_basin + values.size)
+                steps = self.next_step[basins]
+                if steps.max() >= self.data.shape[0]:
+                    raise IndexError("OutputRecorder is full, it was preallocated for {} time steps".format(
+                                     self.data.shape[0]))
+                self.data[steps, np.arange(basins.start, basins.stop), j] = values
+            self.next_step[basins] += 1
+
+            if self.n_recorded - self._last_flush >= self.flush_every:
+                self.flush()
+
+    #------------------------------------------------------------
+    def flush(self):
+        """Write the recorded values and the header to disk."""
+        with self._lock:
+            self.data.flush()
+            self._last_flush = self.n_recorded
+            self._write_header()
+
+    #------------------------------------------------------------
+    def _write_header(self):
+        header = {'shape': list(self.data.shape),
+                  'dtype': np.dtype(self.data.dtype).name,
+                  'var_names': self.var_names,
+                  'basin_ids': self.basin_ids,
+                  'n_recorded': self.n_recorded}
+        with open(self.header_path, 'w') as f:
+            json.dump(header, f)
+
+
+#------------------------------------------------------------
+def open_recording(path, mode='r'):
+    """
+    Open a file written by an ``OutputRecorder``, without reading it into memory.
+
+    Parameters
+    ----------
+    path : str or Path
+        Data file given to the ``OutputRecorder``.
+    mode : str
+        ``np.memmap`` mode, read-only by default.
+
+    Returns
+    -------
+    data : np.memmap
+        The recorded time steps, shape (time, basin, variable).
+    header : dict
+        ``var_names``, ``basin_ids``, ``n_recorded``, ``shape`` and ``dtype``.
+    """
+    with open(str(path) + '.json', 'r') as f:
+        header = json.load(f)
+    data = np.memmap(path, dtype=header['dtype'], mode=mode, shape=tuple(header['shape']))
+    return data[:header['n_recorded']], header
@@ -0,0 +1,207 @@
+"""Area-weighted regridding of gridded forcings to the basins of a batched BMI LSTM.
+
+The models are trained on basin-averaged forcings (NLDAS hourly). Starting from gridded fields, the forcings of every
+basin are the area-weighted averages of the grid cells it overlaps. The weights only depend on the basins and the
+grid, so they are computed once, as a sparse (basin, grid cell) matrix, and cached in a ``scipy.sparse`` ``.npz``
+file with a JSON header next to it (``<path>.json``) recording the basins and grid they are for. Mapping a time step
+of gridded fields to the dynamic inputs of all the basins is then one sparse product per field, written straight
+into the BMI input variables of a batched model.
+
+The BMI configurations only have the basin area and gauge coordinates (``area_sqkm``, ``lat`` and ``lon``), so each
+basin is taken as a latitude-longitude box of its area centred on its coordinates. Cell overlaps are areas on the
+sphere, so cells of different latitudes weigh what they cover, and longitudes wrap around, so a basin can be on the
+seam of a global grid or use the other longitude convention (-180 to 180 or 0 to 360 degrees). Weights computed from
+the basin polygons elsewhere can be used instead, see ``GridRegridder``.
+
+Needs ``scipy``, which ``bmi_lstm`` does not.
+
+Example (from the ``/src`` directory):
+
+    regridder = lstm_regrid.GridRegridder.for_model(model, grid_lat, grid_lon, cache_file='./weights.npz')
+    for fields in gridded_forcings:      # each with shape (dynamic input, lat, lon)
+        regridder.update(model, fields)
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+
+# Mean radius of the Earth (km)
+earth_radius_km = 6371.0
+
+
+def cell_edges(centers):
+    """Edges of the cells of a regular or irregular 1D grid, from their centres (increasing or decreasing)."""
+    centers = np.asarray(centers, dtype=np.float64)
+    if centers.size < 2:
+        raise ValueError("A grid needs at least two cells along each axis")
+    middles = 0.5 * (centers[1:] + centers[:-1])
+    return np.concatenate([[2*centers[0] - middles[0]], middles, [2*centers[-1] - middles[-1]]])
+
+#------------------------------------------------------------
+def _overlaps(lower, upper, edges):
+    """Length of the overlap of the interval [lower, upper] with each cell between the edges."""
+    cell_lower = np.minimum(edges[:-1], edges[1:])
+    cell_upper = np.maximum(edges[:-1], edges[1:])
+    return np.maximum(np.minimum(upper, cell_upper) - np.maximum(lower, cell_lower), 0.0)
+
+#------------------------------------------------------------
+def box_weights(lat, lon, area_sqkm, grid_lat, grid_lon, mask=None):
+    """
+    Area weights of the grid cells overlapped by each basin, the basin taken as a box of its area.
+
+    Parameters
+    ----------
+    lat, lon, area_sqkm : array_like
+        Centre (degrees) and area of each basin.
+    grid_lat, grid_lon : array_like
+        Cell centres (degrees) of a regular latitude-longitude grid, increasing or decreasing. The longitudes can be
+        from -180 to 180 or 0 to 360 degrees, whichever the basins use.
+    mask : np.ndarray, optional
+        Boolean (lat, lon) array, False for cells without data (e.g. over the sea), which get no weight.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Weights with shape (basin, lat * lon), each row adding up to one.
+    """
+    lat, lon, area_sqkm = [np.atleast_1d(np.asarray(x, dtype=np.float64)) for x in (lat, lon, area_sqkm)]
+    lat_edges = cell_edges(grid_lat)
+    lon_edges = cell_edges(grid_lon)
+    n_lon = len(lon_edges) - 1
+
+    # Half sides of the boxes in degrees
+    half_lat = np.degrees(0.5 * np.sqrt(area_sqkm) / earth_radius_km)
+    half_lon = half_lat / np.cos(np.radians(lat))
+    sin_lat_edges = np.sin(np.radians(np.clip(lat_edges, -90.0, 90.0)))
+
+    rows, columns, values = [], [], []
+    for basin in range(len(lat)):
+        # Areas on the sphere are proportional to the difference of the sines of the latitudes times the longitudes
+        lat_overlap = _overlaps(np.sin(np.radians(lat[basin] - half_lat[basin])),
+                                np.sin(np.radians(lat[basin] + half_lat[basin])), sin_lat_edges)
+        # Longitudes wrap around: the box also overlaps cells one turn away, e.g. on a 0 to 360 degree grid for a
+        # basin given from -180 to 180 degrees, or across the seam of a global grid
+        lon_overlap = sum(_overlaps(lon[basin] - half_lon[basin] + turn, lon[basin] + half_lon[basin] + turn,
+                                    lon_edges) for turn in (-360.0, 0.0, 360.0))
+        i = np.flatnonzero(lat_overlap)
+        j = np.flatnonzero(lon_overlap)
+        weights = np.outer(lat_overlap[i], lon_overlap[j])
+        if mask is not None:
+            weights = weights * np.asarray(mask, dtype=bool)[np.ix_(i, j)]
+        if weights.sum() <= 0.0:
+            raise ValueError("Basin {} at ({}, {}) does not overlap any grid cell with data".format(
+                             basin, lat[basin], lon[basin]))
+        cells = (i[:, np.newaxis] * n_lon + j).ravel()
+        rows.append(np.full(cells.size, basin))
+        columns.append(cells)
+        values.append((weights / weights.sum()).ravel())
+
+    shape = (len(lat), (len(lat_edges) - 1) * n_lon)
+    weights = scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                      shape=shape)
+    weights.eliminate_zeros()
+    return weights
+
+
+class GridRegridder:
+    """
+    Sparse area weights mapping gridded forcings to the dynamic inputs of the basins of a batched model.
+
+    Parameters
+    ----------
+    weights : scipy.sparse matrix
+        Weights with shape (basin, grid cell), the grid cells in the (lat, lon) order of the fields, flattened.
+    grid_shape : tuple of int
+        Shape (lat, lon) of the fields.
+    """
+
+    def __init__(self, weights, grid_shape):
+        self.weights = scipy.sparse.csr_matrix(weights)
+        self.grid_shape = tuple(grid_shape)
+        if self.weights.shape[1] != int(np.prod(self.grid_shape)):
+            raise ValueError("Weights for {} grid cells do not fit a grid of shape {}".format(
+                             self.weights.shape[1], self.grid_shape))
+        self._input_ptrs = None
+        self._model = None
+
+    #------------------------------------------------------------
+    @classmethod
+    def for_model(cls, model, grid_lat, grid_lon, mask=None, cache_file=None):
+        """
+        Regridder for the basins of an initialized model, with the weights of ``box_weights()``.
+
+        With ``cache_file``, the weights are read from it if it was written for the same basins and grid, and
+        computed and written to it otherwise.
+        """
+        grid_shape = (len(grid_lat), len(grid_lon))
+        header = {'basin_id': [str(x) for x in np.atleast_1d(model.cfg_bmi['basin_id'])],
+                  'lat': model._basin_values('lat').tolist(),
+                  'lon': model._basin_values('lon').tolist(),
+                  'area_sqkm': model._basin_values('area_sqkm').tolist(),
+                  'grid_lat': np.asarray(grid_lat, dtype=np.float64).tolist(),
+                  'grid_lon': np.asarray(grid_lon, dtype=np.float64).tolist(),
+                  'mask': None if mask is None else np.flatnonzero(~np.asarray(mask, dtype=bool)).tolist()}
+        if cache_file is not None:
+            header_file = Path(str(cache_file) + '.json')
+            if Path(cache_file).exists() and header_file.exists():
+                with open(header_file) as f:
+                    if json.load(f) == header:
+                        return cls(scipy.sparse.load_npz(cache_file), grid_shape)
+
+        weights = box_weights(header['lat'], header['lon'], header['area_sqkm'], grid_lat, grid_lon, mask)
+        if cache_file is not None:
+            scipy.sparse.save_npz(cache_file, weights)
+            with open(header_file, 'w') as f:
+                json.dump(header, f)
+        return cls(weights, grid_shape)
+
+    #------------------------------------------------------------
+    def regrid(self, fields):
+        """
+        Basin averages of gridded fields.
+
+        Parameters
+        ----------
+        fields : np.ndarray
+            Fields with shape (variable, lat, lon), or (time, variable, lat, lon).
+
+        Returns
+        -------
+        np.ndarray
+            Basin averages with shape (basin, variable), or (time, basin, variable).
+        """
+        fields = np.asarray(fields, dtype=np.float64)
+        if fields.shape[-2:] != self.grid_shape:
+            raise ValueError("Fields of shape {} are not on the grid of shape {}".format(fields.shape,
+                                                                                        self.grid_shape))
+        # One sparse product per field, over its contiguous cells: a single (basin, cell) x (cell, variable) product
+        # would first need a transposed copy of all the fields, which takes much longer than the products
+        flat_fields = fields.reshape(-1, self.weights.shape[1])
+        averages = np.empty((len(flat_fields), self.weights.shape[0]))
+        for i, field in enumerate(flat_fields):
+            averages[i] = self.weights.dot(field)
+        return np.swapaxes(averages.reshape(fields.shape[:-2] + (-1,)), -1, -2)
+
+    #------------------------------------------------------------
+    def set_inputs(self, model, fields):
+        """
+        Set the dynamic inputs of all the basins of a model from one time step of gridded fields.
+
+        ``fields`` has shape (dynamic input, lat, lon), ordered as ``cfg_train['dynamic_inputs']`` and in the units
+        of the BMI input variables. The basin averages are copied into the backing arrays of the input variables.
+        """
+        if self._model is not model:
+            self._input_ptrs = [model.get_value_ptr(model._var_name_map_short_first[x])
+                                for x in model.cfg_train['dynamic_inputs']]
+            self._model = model
+        averages = self.regrid(fields)
+        for i, input_ptr in enumerate(self._input_ptrs):
+            input_ptr[:] = averages[:, i]
+
+    #------------------------------------------------------------
+    def update(self, model, fields):
+        """Set the dynamic inputs of a model from gridded fields (see ``set_inputs()``) and update it."""
+        self.set_inputs(model, fields)
+        model.update()
@@ -0,0 +1,172 @@
+"""On-disk cache of BMI LSTM sequence results, to skip the LSTM for runs that were made before.
+
+Many runs repeat exactly: the same trained model, basins, forcings and initial states. A ``ResultCache`` sits in front
+of ``bmi_LSTM.run_sequence()``: it hashes everything the result depends on,
+
+    model      the trained weights (torch parameters or ONNX graph), the scalers, the inputs and target the model was
+               trained with, and the engine and numeric type it runs with
+    basins     the static attributes of every basin
+    forcings   the forcing window, values and shape
+    states     the initial hidden and cell states
+
+and looks the SHA-256 key up in a directory of ``.npz`` files. A hit loads the runoff, the LSTM outputs and the
+end states, and leaves the model as the run would have, without running the LSTM; a miss runs it and stores the
+result. ``lstm_hindcast.run_hindcast()`` runs every chunk through a cache given as ``result_cache``, so a repeated
+hindcast is read back chunk by chunk. The least recently used results are deleted when the cache grows beyond
+``max_bytes``, from an index of the result sizes kept as results are stored, read and deleted, so the directory is only
+listed when the cache is opened.
+
+Example (from the ``/src`` directory):
+
+    cache = lstm_result_cache.ResultCache('../data/result_cache', max_bytes=2**30)
+    runoff_mm = cache.run_sequence(model, dynamic_inputs)
+    lstm_hindcast.run_hindcast(model, data_file, result_cache=cache)
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+default_cache_dir = Path('../data/result_cache')
+
+
+def model_hash(model):
+    """SHA-256 hash of everything about a model that its results depend on, apart from the basins and states."""
+    sha256 = hashlib.sha256()
+    if model.lstm is not None:
+        for name, tensor in model.lstm.state_dict().items():
+            sha256.update(name.encode())
+            sha256.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    else:
+        sha256.update(model.engine._graph)
+    for scaler in (model.input_mean, model.input_std, model.out_mean, model.out_std):
+        sha256.update(np.ascontiguousarray(scaler, dtype=np.float64).tobytes())
+    sha256.update(repr((model.cfg_train['dynamic_inputs'], model.cfg_train['static_attributes'],
+                        model.cfg_train['target_variables'], model.engine.name, model.dtype,
+                        model.bfloat16_matmul)).encode())
+    return sha256.hexdigest()
+
+#------------------------------------------------------------
+def sequence_key(model, dynamic_inputs, model_key=None):
+    """
+    Cache key of running a model over a sequence of forcings from its current states.
+
+    ``model_key`` is the ``model_hash()`` of the model, computed if not given. It hashes the weights themselves
+    (about 0.1 ms for the example models), so a key is the same in every process and changes with the weights.
+    """
+    sha256 = hashlib.sha256((model_key or model_hash(model)).encode())
+    static_inputs = np.stack([np.broadcast_to(np.asarray(getattr(model, model._var_name_map_short_first[x]),
+                                                         dtype=np.float64), (model.n_basins,))
+                              for x in model.cfg_train['static_attributes']])
+    dynamic_inputs = np.ascontiguousarray(dynamic_inputs, dtype=np.float64)
+    for values in [static_inputs, dynamic_inputs] + list(model._get_states()):
+        sha256.update(repr(values.shape).encode())
+        sha256.update(np.ascontiguousarray(values).tobytes())
+    return sha256.hexdigest()
+
+
+class ResultCache:
+    """
+    Sequence results by content hash, in a directory of ``.npz`` files evicted in least recently used order.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Directory of the results, made if needed. It can be shared by processes and runs, each cache evicting the
+        results it has seen: those in the directory when it was opened and those it read or stored since.
+    max_bytes : int
+        Size of the results kept, the least recently used are deleted beyond it.
+    """
+
+    def __init__(self, cache_dir=default_cache_dir, max_bytes=2**30):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Size of each result file, in least recently used order, and their total
+        results = []
+        for path in self.cache_dir.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            results.append((stat.st_mtime, path.name, stat.st_size))
+        self._sizes = OrderedDict((name, size) for _, name, size in sorted(results))
+        self._nbytes = sum(self._sizes.values())
+
+    #------------------------------------------------------------
+    def run_sequence(self, model, dynamic_inputs):
+        """
+        ``model.run_sequence(dynamic_inputs)``, read from the cache if it was run before.
+
+        On a hit the states, time and BMI variables of the model are left as the run would have left them.
+        """
+        if model.steps_per_model_step > 1:
+            raise ValueError("run_sequence() runs the LSTM on the BMI time step, use update() for an LSTM with a "
+                             "longer time step")
+        result_file = self.cache_dir / (sequence_key(model, dynamic_inputs) + '.npz')
+        try:
+            with np.load(result_file) as result:
+                runoff_mm, output = result['runoff_mm'], result['output']
+                h_t, c_t = result['h_t'], result['c_t']
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            # Not cached, or a file being written by another process
+            self.misses += 1
+            return self._run_and_store(model, dynamic_inputs, result_file)
+
+        self.hits += 1
+        os.utime(result_file)
+        self._add(result_file)
+        model._finish_sequence(dynamic_inputs, output, h_t, c_t)
+        return runoff_mm
+
+    #------------------------------------------------------------
+    @property
+    def nbytes(self):
+        """Size of the cached results."""
+        return self._nbytes
+
+    #------------------------------------------------------------
+    def evict(self):
+        """Delete the least recently used results until the cache is no larger than ``max_bytes``."""
+        while self._nbytes > self.max_bytes and self._sizes:
+            name, size = self._sizes.popitem(last=False)
+            self._nbytes -= size
+            try:
+                (self.cache_dir / name).unlink()
+            except FileNotFoundError:
+                pass
+
+    #------------------------------------------------------------
+    def clear(self):
+        """Delete all the cached results."""
+        for path in self.cache_dir.glob('*.npz'):
+            path.unlink()
+        self._sizes.clear()
+        self._nbytes = 0
+
+    #------------------------------------------------------------
+    def _add(self, result_file):
+        """Add a result file to the index, or move it to the most recently used end."""
+        self._nbytes -= self._sizes.pop(result_file.name, 0)
+        try:
+            self._sizes[result_file.name] = result_file.stat().st_size
+        except FileNotFoundError:
+            return
+        self._nbytes += self._sizes[result_file.name]
+
+    def _run_and_store(self, model, dynamic_inputs, result_file):
+        """Run the LSTM, as ``bmi_LSTM.run_sequence()`` does, and store the result."""
+        runoff_mm, output = model._run_sequence(dynamic_inputs)
+        h_t, c_t = model._get_states()
+        # Written under a temporary name and renamed, so readers never see a partial file
+        partial_file = result_file.with_name('{}.{}.partial'.format(result_file.stem, os.getpid()))
+        with open(partial_file, 'wb') as f:
+            np.savez(f, runoff_mm=runoff_mm, output=output, h_t=h_t, c_t=c_t)
+        os.replace(partial_file, result_file)
+        self._add(result_file)
+        self.evict()
+        return runoff_mm
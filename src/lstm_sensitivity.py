@@ -0,0 +1,117 @@
+"""Sensitivity of the simulated runoff to the static attributes of a basin.
+
+``static_sensitivity()`` takes one basin of an initialized ``bmi_LSTM`` and one forcing series, and returns the
+derivative of the runoff at every time step with respect to each static attribute (e.g. ``soil_porosity`` or
+``frac_forest``), in mm per unit of the attribute. Like ``bmi_LSTM.run_scenarios()``, the model is run from the
+basin's current states and is not changed. There are two methods:
+
+    perturbation   central differences: the base and two perturbed attribute vectors per attribute are run as one
+                   batch through the model's engine, any engine works
+    autograd       exact Jacobian through the whole sequence with torch autograd, needs the torch LSTM
+
+Example (from the ``/src`` directory):
+
+    sensitivity = lstm_sensitivity.static_sensitivity(model, dynamic_inputs)
+    print(dict(zip(sensitivity['attributes'], sensitivity['sensitivity'].mean(axis=0))))
+"""
+import numpy as np
+
+sensitivity_methods = ['perturbation', 'autograd']
+
+
+def static_sensitivity(model, dynamic_inputs, basin=0, attributes=None, method='perturbation', step=0.01):
+    """
+    Derivatives of the runoff of a basin with respect to its static attributes.
+
+    Parameters
+    ----------
+    model : bmi_lstm.bmi_LSTM
+        Initialized model. Its states and static attributes of ``basin`` are the base, the model is not changed.
+    dynamic_inputs : np.ndarray
+        Forcings with shape (number of time steps, number of dynamic inputs), ordered as
+        ``cfg_train['dynamic_inputs']``.
+    basin : int
+        Index of the base basin.
+    attributes : list of str, optional
+        Static attributes, as in ``cfg_train['static_attributes']``, by default all those the model was trained with.
+    method : str
+        One of ``sensitivity_methods``.
+    step : float
+        Perturbation of each attribute, in training standard deviations of the attribute (perturbation method).
+
+    Returns
+    -------
+    dict
+        ``attributes``, ``sensitivity`` (runoff depth in mm per unit of each attribute) with shape (number of time
+        steps, number of attributes), and the base ``runoff_mm``.
+    """
+    if method not in sensitivity_methods:
+        raise ValueError("method must be one of {}, not '{}'".format(sensitivity_methods, method))
+    if model.steps_per_model_step > 1:
+        raise ValueError("The sensitivity runs the LSTM on the BMI time step, like run_sequence()")
+
+    attributes = list(model.cfg_train['static_attributes'] if attributes is None else attributes)
+    columns = [model.all_lstm_inputs.index(x) for x in attributes]
+    # Unscaled inputs of the base basin, with shape (time, input)
+    dynamic_inputs = np.asarray(dynamic_inputs, dtype=np.float64)
+    static_inputs = [np.atleast_1d(getattr(model, model._var_name_map_short_first[x]))[basin]
+                     for x in model.cfg_train['static_attributes']]
+    base_inputs = np.concatenate([dynamic_inputs, np.broadcast_to(np.array(static_inputs, dtype=np.float64),
+                                                                  (len(dynamic_inputs), len(static_inputs)))], axis=1)
+    h_t, c_t = model._get_states()
+    h_t = h_t[:, basin:basin+1]
+    c_t = c_t[:, basin:basin+1]
+
+    if method == 'perturbation':
+        return _perturbation_sensitivity(model, base_inputs, h_t, c_t, attributes, columns, step)
+    return _autograd_sensitivity(model, base_inputs, h_t, c_t, attributes, columns)
+
+#------------------------------------------------------------
+def _perturbation_sensitivity(model, base_inputs, h_t, c_t, attributes, columns, step):
+    """Central differences, with the base and the perturbed attribute vectors run as one batch."""
+    n_batch = 1 + 2 * len(columns)
+    deltas = step * model.input_std[columns].astype(np.float64)
+    # Batch row 0 is the base, rows 2i+1 and 2i+2 attribute i plus and minus its delta
+    inputs = np.repeat(base_inputs[:, np.newaxis, :], n_batch, axis=1)
+    for i, (column, delta) in enumerate(zip(columns, deltas)):
+        inputs[:, 2*i + 1, column] += delta
+        inputs[:, 2*i + 2, column] -= delta
+    inputs_scaled = (inputs.astype(model._np_dtype) - model.input_mean) / model.input_std
+
+    output, _, _ = model.engine.sequence(inputs_scaled, np.repeat(h_t, n_batch, axis=1),
+                                         np.repeat(c_t, n_batch, axis=1))
+    runoff_mm = model._output_to_runoff_mm(output[:, :, 0].astype(np.float64))
+    sensitivity = (runoff_mm[:, 1::2] - runoff_mm[:, 2::2]) / (2 * deltas)
+
+    return {'attributes': attributes, 'sensitivity': sensitivity, 'runoff_mm': runoff_mm[:, 0]}
+
+#------------------------------------------------------------
+def _autograd_sensitivity(model, base_inputs, h_t, c_t, attributes, columns):
+    """Jacobian of the runoff series with respect to the attributes, with torch autograd through the sequence."""
+    if model.lstm is None:
+        raise ValueError("The autograd method needs the torch LSTM, this model only has an ONNX graph")
+    import torch
+
+    torch_dtype = getattr(torch, np.dtype(model._np_dtype).name)
+    inputs = torch.from_numpy(base_inputs.astype(model._np_dtype))
+    input_mean = torch.from_numpy(np.asarray(model.input_mean))
+    input_std = torch.from_numpy(np.asarray(model.input_std))
+    daily_target = model.cfg_train['target_variables'][0] == 'QObs(mm/d)'
+
+    def runoff_mm(attribute_values):
+        # Same conversion as bmi_LSTM._output_to_runoff_mm(), in torch so it can be differentiated
+        x = inputs.clone()
+        x[:, columns] = attribute_values.to(torch_dtype)
+        output, _, _ = model.lstm.forward(((x - input_mean) / input_std)[:, np.newaxis], torch.from_numpy(h_t),
+                                          torch.from_numpy(c_t))
+        runoff = output[:, 0, 0].double() * float(model.out_std) + float(model.out_mean)
+        if daily_target:
+            runoff = runoff * (1/24)
+        return torch.clamp(runoff, min=0.0)
+
+    base_values = torch.from_numpy(base_inputs[0, columns].astype(np.float64))
+    sensitivity = torch.autograd.functional.jacobian(runoff_mm, base_values)
+    with torch.no_grad():
+        base_runoff_mm = runoff_mm(base_values)
+
+    return {'attributes': attributes, 'sensitivity': sensitivity.numpy(), 'runoff_mm': base_runoff_mm.numpy()}
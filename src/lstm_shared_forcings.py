@@ -0,0 +1,183 @@
+"""Run BMI LSTM worker processes fed through shared memory by a driver process.
+
+When a driver reads the forcings and sends every time step to worker processes through pipes or queues, pickling the
+arrays costs more than running the LSTM. A ``SharedForcingRunner`` instead keeps one ``multiprocessing.shared_memory``
+block with
+
+    forcings   a double buffer of shape (2, basin, dynamic input), written by the driver
+    outputs    a double buffer of shape (2, output, basin), the BMI output variables written by the workers
+
+Each worker runs one batched ``bmi_LSTM`` for a contiguous slice of the basins. The driver writes time step k into
+slot k % 2 while the workers run time step k - 1 from the other slot. The only synchronization is a pair of
+``multiprocessing.Event`` per worker and slot: ``ready``, set by the driver once the forcings of a slot are written,
+and ``done``, set by the worker once its outputs of that slot are written. Workers read their slice of the forcings in
+place and copy it into the (stable) backing arrays of their BMI input variables, nothing is pickled per time step.
+
+Example (from the ``/src`` directory):
+
+    with lstm_shared_forcings.SharedForcingRunner(basin_cfgs, n_workers=4) as runner:
+        outputs = runner.run(forcings)   # forcings with shape (time, basin, dynamic input)
+"""
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import bmi_lstm
+
+# Output variables written to the shared output buffer
+output_var_names = ['land_surface_water__runoff_depth', 'land_surface_water__runoff_volume_flux']
+
+
+class SharedForcingRunner:
+    """
+    Driver of worker processes running the basins of ``basin_cfgs``, fed through shared memory.
+
+    Parameters
+    ----------
+    basin_cfgs : list of dict
+        Parsed BMI configurations of single basins (see ``bmi_lstm.read_bmi_config()``), run as a batch per worker.
+    n_workers : int
+        Number of worker processes, each runs a contiguous slice of the basins.
+    context : multiprocessing context, optional
+        Start method of the workers, the platform default if not given.
+    """
+
+    def __init__(self, basin_cfgs, n_workers, context=None):
+        self.context = context or multiprocessing.get_context()
+        self.n_basins = len(basin_cfgs)
+        cfg_train, _ = bmi_lstm.read_training_config(basin_cfgs[0]['train_cfg_file'])
+        self.n_inputs = len(cfg_train['dynamic_inputs'])
+        self.slices = [(part[0], part[-1] + 1) for part in np.array_split(np.arange(self.n_basins), n_workers)
+                       if len(part) > 0]
+
+        forcings_nbytes = 2 * self.n_basins * self.n_inputs * 8
+        outputs_nbytes = 2 * len(output_var_names) * self.n_basins * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=forcings_nbytes + outputs_nbytes)
+        self.forcings, self.outputs = _buffers(self.shm, self.n_basins, self.n_inputs)
+
+        self.ready = [[self.context.Event(), self.context.Event()] for _ in self.slices]
+        self.done = [[self.context.Event(), self.context.Event()] for _ in self.slices]
+        self.stop = self.context.Event()
+        self.workers = []
+        for i, (start, stop) in enumerate(self.slices):
+            worker = self.context.Process(target=_worker_main,
+                                          args=(self.shm.name, self.n_basins, self.n_inputs, basin_cfgs[start:stop],
+                                                start, stop, self.ready[i], self.done[i], self.stop),
+                                          daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        # The done events of a slot are set while it is free, the workers set both once they are initialized
+        for slot in range(2):
+            self._wait_done(slot)
+        # Slots holding time steps whose outputs are not collected yet, oldest first
+        self._pending = deque()
+        self._n_steps = 0
+
+    #------------------------------------------------------------
+    def run(self, forcings):
+        """
+        Run the workers over a series of forcings.
+
+        Parameters
+        ----------
+        forcings : iterable of np.ndarray
+            Forcings of each time step with shape (basin, dynamic input), ordered as ``cfg_train['dynamic_inputs']``,
+            e.g. an array with shape (time, basin, dynamic input) or a generator reading them step by step.
+
+        Returns
+        -------
+        np.ndarray
+            Outputs with shape (time, output, basin), the output variables as in ``output_var_names``.
+        """
+        outputs = []
+        for forcing_step in forcings:
+            slot = self._n_steps % 2
+            # The slot is free once the workers are done with the step before the last, collect its outputs first
+            self._wait_done(slot)
+            if self._pending and self._pending[0] == slot:
+                outputs.append(self.outputs[self._pending.popleft()].copy())
+            for done in self.done:
+                done[slot].clear()
+            self.forcings[slot] = forcing_step
+            for ready in self.ready:
+                ready[slot].set()
+            self._pending.append(slot)
+            self._n_steps += 1
+        # The last two time steps
+        while self._pending:
+            self._wait_done(self._pending[0])
+            outputs.append(self.outputs[self._pending.popleft()].copy())
+        return np.array(outputs)
+
+    #------------------------------------------------------------
+    def close(self):
+        """Stop the workers and free the shared memory."""
+        self.stop.set()
+        for ready in self.ready:
+            ready[0].set()
+            ready[1].set()
+        for worker in self.workers:
+            worker.join()
+        self.forcings = self.outputs = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #------------------------------------------------------------
+    def _wait_done(self, slot):
+        """Wait for all the workers to be done with a slot."""
+        for i in range(len(self.workers)):
+            self._wait(self.done[i][slot], i)
+
+    def _wait(self, event, worker):
+        """Wait for an event of a worker, raising if the worker died."""
+        while not event.wait(timeout=1.0):
+            if not self.workers[worker].is_alive():
+                raise RuntimeError("LSTM worker {} stopped with exit code {}".format(
+                                   worker, self.workers[worker].exitcode))
+
+
+#------------------------------------------------------------
+def _buffers(shm, n_basins, n_inputs):
+    """The forcings and outputs double buffers in a shared memory block."""
+    forcings = np.ndarray((2, n_basins, n_inputs), dtype=np.float64, buffer=shm.buf)
+    outputs = np.ndarray((2, len(output_var_names), n_basins), dtype=np.float64, buffer=shm.buf,
+                         offset=forcings.nbytes)
+    return forcings, outputs
+
+#------------------------------------------------------------
+def _worker_main(shm_name, n_basins, n_inputs, basin_cfgs, start, stop, ready, done, stop_event):
+    """Run the basins ``start:stop`` one time step per ready slot, until the driver stops."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    forcings, outputs = _buffers(shm, n_basins, n_inputs)
+    model = bmi_lstm.bmi_LSTM()
+    model.initialize_from_config(bmi_lstm.combine_bmi_configs(basin_cfgs))
+    input_ptrs = [model.get_value_ptr(model._var_name_map_short_first[x]) for x in model.cfg_train['dynamic_inputs']]
+    output_ptrs = [model.get_value_ptr(x) for x in output_var_names]
+    done[0].set()
+    done[1].set()
+
+    k = 0
+    while True:
+        slot = k % 2
+        ready[slot].wait()
+        ready[slot].clear()
+        if stop_event.is_set():
+            break
+        for i, input_ptr in enumerate(input_ptrs):
+            input_ptr[:] = forcings[slot, start:stop, i]
+        model.update()
+        for i, output_ptr in enumerate(output_ptrs):
+            outputs[slot, i, start:stop] = output_ptr
+        done[slot].set()
+        k += 1
+
+    del forcings, outputs
+    shm.close()
@@ -0,0 +1,128 @@
+"""Streaming skill metrics of simulated against observed streamflow.
+
+A ``StreamingSkill`` evaluator keeps only the running means and co-moments needed for the Nash-Sutcliffe efficiency
+(NSE), Kling-Gupta efficiency (KGE), bias and correlation of each basin, and is updated one time step (or one chunk of
+time steps) at a time, so long hindcasts can be scored without keeping the simulated and observed series. Time steps
+with a missing (NaN) observation or simulation are left out for that basin.
+
+The statistics of each chunk are merged into the running ones with the pairwise update of Chan et al., rather than
+kept as raw sums of squares, which lose precision to cancellation over long series with a large mean.
+
+    Nash, J.E. and Sutcliffe, J.V. 1970. River flow forecasting through conceptual models part I - A discussion of
+    principles. https://doi.org/10.1016/0022-1694(70)90255-6
+    Gupta, H.V., Kling, H., Yilmaz, K.K. and Martinez, G.F. 2009. Decomposition of the mean squared error and NSE
+    performance criteria. https://doi.org/10.1016/j.jhydrol.2009.08.003
+    Chan, T.F., Golub, G.H. and LeVeque, R.J. 1979. Updating formulae and a pairwise algorithm for computing sample
+    variances. Stanford CS report STAN-CS-79-773.
+
+See ``lstm_hindcast.py`` for running a model over a NeuralHydrology netCDF file with an evaluator attached.
+"""
+import numpy as np
+
+
+class StreamingSkill:
+    """
+    Running means and co-moments for the skill metrics of several basins.
+
+    Parameters
+    ----------
+    n_basins : int
+        Number of basins.
+    basin_ids : list of str, optional
+        Basin ids, returned with the scores.
+    """
+
+    def __init__(self, n_basins=1, basin_ids=None):
+        self.basin_ids = None if basin_ids is None else [str(basin_id) for basin_id in basin_ids]
+        self.n = np.zeros(n_basins, dtype=np.int64)
+        self.mean_sim = np.zeros(n_basins)
+        self.mean_obs = np.zeros(n_basins)
+        # Sums of squared deviations from the means, and of the products of the deviations
+        self.m2_sim = np.zeros(n_basins)
+        self.m2_obs = np.zeros(n_basins)
+        self.c_sim_obs = np.zeros(n_basins)
+
+    #------------------------------------------------------------
+    def update(self, simulated, observed):
+        """
+        Add time steps to the statistics.
+
+        Parameters
+        ----------
+        simulated, observed : np.ndarray
+            Values with shape (number of basins,) for one time step, or (number of time steps, number of basins).
+            NaN marks a missing value.
+        """
+        simulated = np.asarray(simulated, dtype=np.float64).reshape(-1, self.n.size)
+        observed = np.asarray(observed, dtype=np.float64).reshape(-1, self.n.size)
+        valid = ~(np.isnan(simulated) | np.isnan(observed))
+
+        # Statistics of the chunk, about its own means
+        chunk = StreamingSkill(self.n.size)
+        chunk.n = valid.sum(axis=0)
+        n = np.maximum(chunk.n, 1)
+        chunk.mean_sim = np.where(valid, simulated, 0.0).sum(axis=0) / n
+        chunk.mean_obs = np.where(valid, observed, 0.0).sum(axis=0) / n
+        deviation_sim = np.where(valid, simulated - chunk.mean_sim, 0.0)
+        deviation_obs = np.where(valid, observed - chunk.mean_obs, 0.0)
+        chunk.m2_sim = (deviation_sim * deviation_sim).sum(axis=0)
+        chunk.m2_obs = (deviation_obs * deviation_obs).sum(axis=0)
+        chunk.c_sim_obs = (deviation_sim * deviation_obs).sum(axis=0)
+        self.merge(chunk)
+
+    #------------------------------------------------------------
+    def merge(self, other):
+        """
+        Add the time steps of another evaluator of the same basins, e.g. one of another chunk or process.
+
+        Parameters
+        ----------
+        other : StreamingSkill
+            Evaluator to merge in, it is not changed.
+        """
+        n = self.n + other.n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(n > 0, other.n / n, 0.0)
+        delta_sim = other.mean_sim - self.mean_sim
+        delta_obs = other.mean_obs - self.mean_obs
+        self.m2_sim = self.m2_sim + other.m2_sim + delta_sim * delta_sim * self.n * weight
+        self.m2_obs = self.m2_obs + other.m2_obs + delta_obs * delta_obs * self.n * weight
+        self.c_sim_obs = self.c_sim_obs + other.c_sim_obs + delta_sim * delta_obs * self.n * weight
+        self.mean_sim = self.mean_sim + delta_sim * weight
+        self.mean_obs = self.mean_obs + delta_obs * weight
+        self.n = n
+
+    #------------------------------------------------------------
+    def scores(self):
+        """
+        Skill metrics of each basin from the time steps added so far.
+
+        Returns
+        -------
+        dict
+            ``nse``, ``kge``, ``r`` (Pearson correlation), ``alpha`` (ratio of standard deviations), ``beta`` (ratio
+            of means), ``bias`` (mean simulated minus observed) and ``percent_bias``, each an array with one value per
+            basin (NaN for a basin without valid time steps), plus ``n`` (number of valid time steps) and
+            ``basin_ids``.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = np.where(self.n > 0, self.n, np.nan)
+            mean_sim = np.where(self.n > 0, self.mean_sim, np.nan)
+            mean_obs = np.where(self.n > 0, self.mean_obs, np.nan)
+            # Sum of squared errors, from the deviations about the means and the difference of the means
+            squared_error = np.maximum(self.m2_sim - 2 * self.c_sim_obs + self.m2_obs + n * (mean_sim - mean_obs)**2,
+                                       0.0)
+
+            r = self.c_sim_obs / np.sqrt(self.m2_sim * self.m2_obs)
+            alpha = np.sqrt(self.m2_sim / self.m2_obs)
+            beta = mean_sim / mean_obs
+
+            return {'nse': 1 - squared_error / self.m2_obs,
+                    'kge': 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2),
+                    'r': r,
+                    'alpha': alpha,
+                    'beta': beta,
+                    'bias': mean_sim - mean_obs,
+                    'percent_bias': 100 * (mean_sim - mean_obs) / mean_obs,
+                    'n': self.n.copy(),
+                    'basin_ids': self.basin_ids}
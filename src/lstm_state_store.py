@@ -0,0 +1,159 @@
+"""Hidden and cell states of many basins under a memory budget, paged out to a memory-mapped file.
+
+With 100k+ catchments the LSTM states are most of what stays in memory between updates. A ``StateStore`` keeps the
+``h_t`` and ``c_t`` of every basin as one compact (basin, 2, hidden size) ``np.memmap`` on disk, and only the pages
+(the two state vectors of a basin) that fit in the memory budget in a resident pool. Instances attached with
+``bmi_LSTM.attach_state_store()`` do not keep their states: they page them in before each ``update()`` and store them
+back afterwards. Pages beyond the budget are paged out in least recently used order, and ``end_window()`` pages out
+the cold basins, those not updated since the previous window. With a ``codec`` (see ``lstm_state_codec.py``) the
+pages are compressed in the file, e.g. to half the size and I/O with float16, while the resident pool stays in the
+type the LSTM runs with.
+
+Example (from the ``/src`` directory):
+
+    store = lstm_state_store.StateStore('./states.dat', basin_ids, hidden_size=64, memory_budget=64 * 2**20)
+    for model in models:
+        model.attach_state_store(store)
+    for k in range(n_steps):
+        ...update the models...
+        store.end_window()
+    print(store.n_page_ins, store.n_page_outs)
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import lstm_state_codec
+
+
+class StateStore:
+    """
+    States of many basins, with the pages that fit in ``memory_budget`` resident and the others in a memmap file.
+
+    Parameters
+    ----------
+    path : str or Path
+        File holding the paged out states.
+    basin_ids : list of str
+        All the basins of the store.
+    hidden_size : int
+        Size of each state vector.
+    memory_budget : int
+        Bytes the resident pages may use. Must fit at least the basins of the largest instance attached.
+    dtype : numpy dtype
+        Type of the states, that the attached instances run with (see ``bmi_LSTM.set_numeric_type()``).
+    codec : str or lstm_state_codec.StateCodec, optional
+        At-rest codec of the pages in the file, full precision (``dtype``) if not given.
+    """
+
+    def __init__(self, path, basin_ids, hidden_size, memory_budget, dtype=np.float32, codec=None):
+        self.rows = {str(basin_id): row for row, basin_id in enumerate(basin_ids)}
+        self.dtype = np.dtype(dtype)
+        self.page_nbytes = 2 * hidden_size * self.dtype.itemsize
+        self.capacity = int(memory_budget // self.page_nbytes)
+        if self.capacity < 1:
+            raise ValueError("memory_budget of {} bytes is less than one page ({} bytes)".format(memory_budget,
+                                                                                                self.page_nbytes))
+        self.codec = lstm_state_codec.make_codec(codec)
+        # One record per basin, see lstm_state_codec.StateCodec.record_dtype()
+        self.disk = np.memmap(path, dtype=self.codec.record_dtype((2, hidden_size), self.dtype), mode='w+',
+                              shape=(len(self.rows),))
+        self.pool = np.zeros((self.capacity, 2, hidden_size), dtype=self.dtype)
+
+        # Resident pages: basin row -> pool slot, in least recently used order
+        self.resident = OrderedDict()
+        self._free_slots = list(range(self.capacity - 1, -1, -1))
+        self._window = set()
+        self.n_page_ins = 0
+        self.n_page_outs = 0
+        # Instances attached to the store can be updated from several threads (see lstm_thread_pool.py)
+        self._lock = threading.RLock()
+
+    #------------------------------------------------------------
+    def basin_rows(self, basin_ids):
+        """Rows of the store of some basins."""
+        return np.array([self.rows[str(basin_id)] for basin_id in np.atleast_1d(basin_ids)])
+
+    #------------------------------------------------------------
+    def get(self, rows):
+        """
+        States of some basins (rows), paging them in if needed.
+
+        Returns
+        -------
+        h_t, c_t : np.ndarray
+            Copies, with shape (1, number of basins, hidden size).
+        """
+        with self._lock:
+            slots = self._page_in(rows)
+            pages = self.pool[slots]
+            return np.ascontiguousarray(pages[np.newaxis, :, 0]), np.ascontiguousarray(pages[np.newaxis, :, 1])
+
+    #------------------------------------------------------------
+    def put(self, rows, h_t, c_t):
+        """Store the states of some basins (rows), with shape (1, number of basins, hidden size)."""
+        with self._lock:
+            slots = self._page_in(rows, read=False)
+            self.pool[slots, 0] = h_t[0]
+            self.pool[slots, 1] = c_t[0]
+            self._window.update(int(row) for row in rows)
+
+    #------------------------------------------------------------
+    def end_window(self):
+        """Page out the cold basins, not stored since the last ``end_window()``, and start a new window."""
+        with self._lock:
+            for row in [row for row in self.resident if row not in self._window]:
+                self._page_out(row)
+            self._window = set()
+
+    #------------------------------------------------------------
+    def flush(self):
+        """Write all the resident pages to the file, keeping them resident."""
+        with self._lock:
+            rows = list(self.resident)
+            self.disk[rows] = self.codec.encode(self.pool[[self.resident[row] for row in rows]])
+            self.disk.flush()
+
+    #------------------------------------------------------------
+    @property
+    def resident_nbytes(self):
+        """Memory used by the resident pages."""
+        return len(self.resident) * self.page_nbytes
+
+    #------------------------------------------------------------
+    @property
+    def disk_nbytes(self):
+        """Size of the file of paged out states."""
+        return self.disk.nbytes
+
+    #------------------------------------------------------------
+    def _page_in(self, rows, read=True):
+        """Pool slots of some rows, paging them in (and others out to make room) as needed."""
+        rows = [int(row) for row in rows]
+        requested = set(rows)
+        if len(rows) > self.capacity:
+            raise ValueError("{} basins do not fit in the memory budget of {} pages".format(len(rows), self.capacity))
+        for row in rows:
+            if row in self.resident:
+                self.resident.move_to_end(row)
+        slots = []
+        for row in rows:
+            if row not in self.resident:
+                if not self._free_slots:
+                    # Least recently used page that is not part of this request
+                    self._page_out(next(x for x in self.resident if x not in requested))
+                slot = self._free_slots.pop()
+                if read:
+                    self.pool[slot] = self.codec.decode(self.disk[row:row+1], self.dtype)[0]
+                    self.n_page_ins += 1
+                self.resident[row] = slot
+            slots.append(self.resident[row])
+        return slots
+
+    #------------------------------------------------------------
+    def _page_out(self, row):
+        slot = self.resident.pop(row)
+        self.disk[row:row+1] = self.codec.encode(self.pool[slot:slot+1])
+        self._free_slots.append(slot)
+        self.n_page_outs += 1
@@ -0,0 +1,161 @@
+"""Step many BMI LSTM instances concurrently from a thread pool.
+
+torch, NumPy and ONNX Runtime release the GIL in their kernels, so instances updated from several threads of one
+process overlap their forward passes. Each ``bmi_LSTM`` holds its own lock in ``update()``, the value getters and
+setters and the other methods that read or change its time, states or variables, so an instance is never updated
+halfway by two threads. What instances share is safe too: engines hold no states, and the state store and the output
+recorders lock their own bookkeeping.
+
+A ``ThreadedStepper`` splits the instances into one group per thread and, every time step, sets the forcings of each
+instance and updates it, all the groups at once. torch's intra-op thread count is a setting of the whole process
+(``torch.set_num_threads()``), not of a thread, so per thread limits are kept by setting it, while the stepper is
+open, to the cores shared out over the threads (``intra_op_threads``), and restoring it on ``close()``. ONNX Runtime
+sessions fix their thread pools when they start and are not changed.
+
+Example (from the ``/src`` directory), see ``run_thread_scaling.py`` for the speedup by thread count:
+
+    with lstm_thread_pool.ThreadedStepper(models, n_threads=4) as stepper:
+        runoff_mm = stepper.run(forcings)   # forcings with shape (time, basin, dynamic input)
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class ThreadedStepper:
+    """
+    Thread pool updating a set of instances every time step, each thread a contiguous group of them.
+
+    Parameters
+    ----------
+    models : list of bmi_lstm.bmi_LSTM
+        Initialized instances, with one or several basins each.
+    n_threads : int
+        Number of threads.
+    intra_op_threads : int, optional
+        torch intra-op threads while the stepper is open, by default the cores over ``n_threads`` (at least one).
+    """
+
+    def __init__(self, models, n_threads, intra_op_threads=None):
+        self.models = list(models)
+        self.n_threads = n_threads
+        self.intra_op_threads = intra_op_threads or max(1, (os.cpu_count() or 1) // n_threads)
+        self.groups = [list(group) for group in np.array_split(np.arange(len(self.models)), n_threads) if len(group)]
+        # Basin columns of each instance in the forcings and outputs of all the instances
+        bounds = np.cumsum([0] + [model.n_basins for model in self.models])
+        self.basin_slices = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        self.n_basins = int(bounds[-1])
+        self._input_ptrs = [[model.get_value_ptr(model._var_name_map_short_first[x])
+                             for x in model.cfg_train['dynamic_inputs']] for model in self.models]
+        self._saved_intra_op_threads = _set_torch_threads(self.intra_op_threads)
+        self.executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='bmi_LSTM')
+
+    #------------------------------------------------------------
+    def step(self, forcings=None):
+        """
+        Update every instance once, the groups concurrently.
+
+        Parameters
+        ----------
+        forcings : np.ndarray, optional
+            Forcings of this time step with shape (basin, dynamic input), over the basins of all the instances in
+            order and ordered as ``cfg_train['dynamic_inputs']``. Without them the instances run on the inputs
+            already set.
+        """
+        futures = [self.executor.submit(self._step_group, group, forcings) for group in self.groups]
+        # Raises the first error of a thread
+        for future in futures:
+            future.result()
+
+    #------------------------------------------------------------
+    def run(self, forcings):
+        """
+        Step the instances over a series of forcings.
+
+        Parameters
+        ----------
+        forcings : iterable of np.ndarray
+            Forcings of each time step, see ``step()``, e.g. an array with shape (time, basin, dynamic input).
+
+        Returns
+        -------
+        np.ndarray
+            Runoff depth (mm) with shape (time, basin).
+        """
+        runoff_mm = []
+        for forcing_step in forcings:
+            self.step(forcing_step)
+            runoff_mm.append(np.concatenate([np.atleast_1d(model.get_value_ptr('land_surface_water__runoff_depth'))
+                                             for model in self.models]) * 1000.0)
+        return np.array(runoff_mm)
+
+    #------------------------------------------------------------
+    def close(self):
+        """Stop the threads and restore torch's intra-op thread count."""
+        self.executor.shutdown()
+        _set_torch_threads(self._saved_intra_op_threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #------------------------------------------------------------
+    def _step_group(self, group, forcings):
+        for i in group:
+            model = self.models[i]
+            # Held over setting the inputs and updating, so other threads see the instance before or after both
+            with model._lock:
+                if forcings is not None:
+                    for j, input_ptr in enumerate(self._input_ptrs[i]):
+                        input_ptr[:] = forcings[self.basin_slices[i], j]
+                model.update()
+
+
+#------------------------------------------------------------
+def thread_scaling(make_models, forcings, thread_counts):
+    """
+    Time stepping the same instances over the same forcings with different numbers of threads.
+
+    Parameters
+    ----------
+    make_models : callable
+        Returns freshly initialized instances, called once per thread count.
+    forcings : np.ndarray
+        Forcings with shape (time, basin, dynamic input), see ``ThreadedStepper.run()``.
+    thread_counts : list of int
+        Numbers of threads, the first is the base of the speedups.
+
+    Returns
+    -------
+    list of dict
+        ``n_threads``, ``intra_op_threads``, ``time`` (seconds), ``speedup`` and ``max_difference`` (mm, from the
+        runoff of the first thread count) of each thread count.
+    """
+    results = []
+    for n_threads in thread_counts:
+        models = make_models()
+        with ThreadedStepper(models, n_threads) as stepper:
+            start_time = time.perf_counter()
+            runoff_mm = stepper.run(forcings)
+            run_time = time.perf_counter() - start_time
+        if not results:
+            base_time, base_runoff_mm = run_time, runoff_mm
+        results.append({'n_threads': n_threads, 'intra_op_threads': stepper.intra_op_threads, 'time': run_time,
+                        'speedup': base_time / run_time,
+                        'max_difference': float(np.nanmax(np.abs(runoff_mm - base_runoff_mm)))})
+    return results
+
+#------------------------------------------------------------
+def _set_torch_threads(n_threads):
+    """Set torch's intra-op thread count if torch is loaded, returning the previous count (None without torch)."""
+    torch = sys.modules.get('torch')
+    if torch is None or n_threads is None:
+        return None
+    previous = torch.get_num_threads()
+    torch.set_num_threads(n_threads)
+    return previous
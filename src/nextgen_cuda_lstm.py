@@ -17,10 +17,10 @@ class Nextgen_CudaLSTM(nn.Module):
         self.head = nn.Linear(self.hidden_layer_size, self.output_size)
 
     def forward(self, input_layer, h_t, c_t):
-        h_t = h_t.float()
-        c_t = c_t.float()
-        input_layer = input_layer.float()
-        input_view = input_layer.view(self.seq_length, self.batch_size, self.input_size)
+        # The inputs and states must already have the same type as the weights, no casting is done here.
+        # The sequence length is taken from the input and the batch size from the states, so a whole sequence, or
+        # several basins at once, can be run in one call.
+        input_view = input_layer.view(-1, h_t.shape[1], self.input_size)
         output, (h_t, c_t) = self.lstm(input_view, (h_t,c_t))
         prediction = self.head(output)
         return prediction, h_t, c_t
\ No newline at end of file
@@ -58,6 +58,21 @@ try:
 except:
     bmi_except('initialize()')
 
+#-------------------------------------------------------------------
+# initialize() of several basins as one batch, combining their single basin configurations
+try:
+    import camels_bmi_configs
+    multi_basin_ids = camels_bmi_configs.read_basin_list(Path('../data/4_basins_test_set.txt'))[:3]
+    camels_attributes = camels_bmi_configs.read_camels_attributes()
+    multi_cfgs = [camels_bmi_configs.make_bmi_config(bmi_lstm.read_bmi_config(cfg_file), basin_id, camels_attributes)
+                  for basin_id in multi_basin_ids]
+    multi_bmi = bmi_lstm.bmi_LSTM()
+    multi_bmi.initialize_from_config(bmi_lstm.combine_bmi_configs(multi_cfgs))
+    print(" initializing " + str(len(multi_basin_ids)) + " basins...")
+    pass_count += 1
+except:
+    bmi_except('initialize() of several basins')
+
 #-------------------------------------------------------------------
 #-------------------------------------------------------------------
 # BMI: Model Information Functions
@@ -266,6 +281,52 @@ try:
 except:
     bmi_except('get_grid_type()')    
 
+#-------------------------------------------------------------------
+# get_grid_node_count()
+try:
+    print ("  node count: " + str(bmi.get_grid_node_count(grid_id)))
+    pass_count += 1
+except:
+    bmi_except('get_grid_node_count()')
+
+#-------------------------------------------------------------------
+# get_grid_shape()
+try:
+    grid_shape = np.zeros(bmi.get_grid_rank(grid_id), dtype=int)
+    print ("  shape: " + str(bmi.get_grid_shape(grid_id, grid_shape)))
+    pass_count += 1
+except:
+    bmi_except('get_grid_shape()')
+
+#-------------------------------------------------------------------
+# get_grid_x() and get_grid_y()
+try:
+    grid_x = np.zeros(bmi.get_grid_node_count(grid_id))
+    grid_y = np.zeros(bmi.get_grid_node_count(grid_id))
+    bmi.get_grid_x(grid_id, grid_x)
+    bmi.get_grid_y(grid_id, grid_y)
+    print ("  x (lon): " + str(grid_x) + ", y (lat): " + str(grid_y))
+    pass_count += 1
+except:
+    bmi_except('get_grid_x() / get_grid_y()')
+
+#-------------------------------------------------------------------
+# points grid of several basins: one node per basin, at the basin locations
+try:
+    n_nodes = multi_bmi.get_grid_node_count(grid_id)
+    assert n_nodes == multi_bmi.get_grid_size(grid_id) == len(multi_basin_ids)
+    grid_shape = np.zeros(multi_bmi.get_grid_rank(grid_id), dtype=int)
+    assert list(multi_bmi.get_grid_shape(grid_id, grid_shape)) == [len(multi_basin_ids)]
+    grid_x = multi_bmi.get_grid_x(grid_id, np.zeros(n_nodes))
+    grid_y = multi_bmi.get_grid_y(grid_id, np.zeros(n_nodes))
+    assert np.array_equal(grid_x, [cfg['lon'] for cfg in multi_cfgs])
+    assert np.array_equal(grid_y, [cfg['lat'] for cfg in multi_cfgs])
+    assert len(set(grid_x)) == len(multi_basin_ids)
+    print ("  " + str(n_nodes) + " basins, x (lon): " + str(grid_x) + ", y (lat): " + str(grid_y))
+    pass_count += 1
+except:
+    bmi_except('grid functions of several basins')
+
 
 #-------------------------------------------------------------------
 #-------------------------------------------------------------------
@@ -371,6 +432,21 @@ for var_name in (bmi.get_output_var_names() + bmi.get_input_var_names()):
 # set back to zero
 var_name_counter = 0
 
+#-------------------------------------------------------------------
+# set_value_at_indices() and get_value_at_indices() of several basins, only the basins at the indices change
+try:
+    for var_name in multi_bmi.get_input_var_names():
+        multi_bmi.set_value(var_name, np.array([1.0, 2.0, 3.0]))
+        multi_bmi.set_value_at_indices(var_name, np.array([2, 0]), np.array([-30.0, -10.0]))
+        assert np.array_equal(multi_bmi.get_value_ptr(var_name), [-10.0, 2.0, -30.0])
+        dest_array = np.zeros(2)
+        multi_bmi.get_value_at_indices(var_name, dest_array, np.array([1, 2]))
+        assert np.array_equal(dest_array, [2.0, -30.0])
+    print ("  set/get value at indices of several basins (values match)")
+    pass_count += 1
+except:
+    bmi_except('set_value_at_indices() / get_value_at_indices() of several basins')
+
 #-------------------------------------------------------------------
 #-------------------------------------------------------------------
 # BMI: Control Functions
@@ -406,6 +482,26 @@ try:
 except:
     bmi_except('update_until()')          
 
+#-------------------------------------------------------------------
+# get_value_ptr() stays valid across update()
+# the backing arrays of the input and output variables are updated in place, never reallocated
+try:
+    var_names = bmi.get_input_var_names() + bmi.get_output_var_names()
+    pointers = {var_name: bmi.get_value_ptr(var_name) for var_name in var_names}
+    addresses = {var_name: pointers[var_name].ctypes.data for var_name in var_names}
+    runoff_ptr = pointers['land_surface_water__runoff_depth']
+    for k in range(3):
+        bmi.set_value('land_surface_air__temperature', np.array([float(k)]))
+        bmi.land_surface_air__temperature = float(k)
+        bmi.update()
+        assert runoff_ptr[0] == bmi.get_value_ptr('land_surface_water__runoff_depth')[0]
+    assert all(bmi.get_value_ptr(var_name) is pointers[var_name] for var_name in var_names)
+    assert all(bmi.get_value_ptr(var_name).ctypes.data == addresses[var_name] for var_name in var_names)
+    print (" get_value_ptr() stable across update()")
+    pass_count += 1
+except:
+    bmi_except('get_value_ptr() stable across update()')
+
 #-------------------------------------------------------------------
 # finalize()
 try:
@@ -415,6 +511,664 @@ try:
 except:
     bmi_except('finalize()')
 
+#-------------------------------------------------------------------
+#-------------------------------------------------------------------
+# Components built on the BMI LSTM
+#-------------------------------------------------------------------
+#-------------------------------------------------------------------
+print ("\nCOMPONENTS\n**********")
+
+#-------------------------------------------------------------------
+# lstm_bulk_initialize: configurations that only differ in weights_file get their own model bundles
+try:
+    import tempfile
+    import torch
+    import yaml
+    import lstm_bulk_initialize
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cfg_yaml = yaml.safe_load(cfg_file.read_text())
+        cfg_train, _ = bmi_lstm.read_training_config(cfg_yaml['train_cfg_file'])
+        weights_file = Path(bmi_lstm.trained_model_file(cfg_train)).resolve()
+        other_weights_file = Path(tmp_dir) / 'model_epoch999.pt'
+        trained_state_dict = torch.load(weights_file, map_location='cpu')
+        torch.save({key: value * 0.5 for key, value in trained_state_dict.items()}, other_weights_file)
+        bulk_cfg_files = []
+        for i, weights in enumerate([weights_file, other_weights_file]):
+            bulk_cfg_files.append(Path(tmp_dir) / 'basin_{}.yml'.format(i))
+            bulk_cfg_files[-1].write_text(yaml.safe_dump(dict(cfg_yaml, weights_file=str(weights))))
+        bulk_models, bulk_stats = lstm_bulk_initialize.bulk_initialize(bulk_cfg_files)
+    assert bulk_stats['n_bundles'] == 2
+    assert not torch.equal(bulk_models[0].lstm.head.weight, bulk_models[1].lstm.head.weight)
+    assert torch.equal(bulk_models[1].lstm.head.weight, 0.5 * bulk_models[0].lstm.head.weight)
+    print (" bulk_initialize() loads a bundle per weights_file")
+    pass_count += 1
+except:
+    bmi_except('bulk_initialize() loads a bundle per weights_file')
+
+#-------------------------------------------------------------------
+# run_sequence() feeds the aggregation periods and output recorders as update() does
+try:
+    import lstm_aggregation
+    import lstm_output_recorder
+    cfg_aggregated = dict(bmi_lstm.read_bmi_config(cfg_file), aggregation_periods=['daily'],
+                          time_origin='2000-01-01 00:00')
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sequence_models, sequence_recorders = [], []
+        for name in ['update', 'run_sequence']:
+            model = bmi_lstm.bmi_LSTM()
+            model.initialize_from_config(cfg_aggregated)
+            n_inputs = len(model.cfg_train['dynamic_inputs'])
+            recorder = lstm_output_recorder.OutputRecorder(Path(tmp_dir) / (name + '.dat'), 60)
+            model.attach_recorder(recorder)
+            sequence_models.append(model)
+            sequence_recorders.append(recorder)
+        forcings = (sequence_models[0].input_mean[:n_inputs]
+                    + sequence_models[0].input_std[:n_inputs] * rng.standard_normal((60, n_inputs)))
+        for forcing_step in forcings:
+            for i, x in enumerate(sequence_models[0].cfg_train['dynamic_inputs']):
+                sequence_models[0].set_value(sequence_models[0]._var_name_map_short_first[x], forcing_step[i:i + 1])
+            sequence_models[0].update()
+        sequence_models[1].run_sequence(forcings)
+        for var_name in lstm_aggregation.aggregated_var_names('daily'):
+            assert np.allclose(sequence_models[0].get_value_ptr(var_name), sequence_models[1].get_value_ptr(var_name),
+                               rtol=1e-5)
+        assert sequence_models[1].get_value_ptr('land_surface_water__runoff_depth__daily_sum')[0] != 0
+        assert np.allclose(sequence_recorders[0].data, sequence_recorders[1].data, rtol=1e-5)
+        assert sequence_models[0].get_current_time() == sequence_models[1].get_current_time()
+        del sequence_recorders
+    print (" run_sequence() aggregates and records like update()")
+    pass_count += 1
+except:
+    bmi_except('run_sequence() aggregates and records like update()')
+
+#-------------------------------------------------------------------
+# Multi-timescale LSTM: the forcings of each model step (the highest of use_frequencies) are buffered over BMI steps
+try:
+    cfg_bmi = bmi_lstm.read_bmi_config(cfg_file)
+    bundle = bmi_lstm.load_config_bundle(cfg_bmi)
+    slow_bundle = dict(bundle, cfg_train=dict(bundle['cfg_train'], use_frequencies=['3H', '1D']))
+    slow_model, step_model = bmi_lstm.bmi_LSTM(), bmi_lstm.bmi_LSTM()
+    slow_model.initialize_from_config(cfg_bmi, model_bundle=slow_bundle)
+    step_model.initialize_from_config(cfg_bmi, model_bundle=bundle)
+    assert slow_model.steps_per_model_step == 3
+    dynamic_inputs = slow_model.cfg_train['dynamic_inputs']
+    n_inputs = len(dynamic_inputs)
+    rng = np.random.default_rng(1)
+    forcings = slow_model.input_mean[:n_inputs] + slow_model.input_std[:n_inputs] * rng.standard_normal((6, n_inputs))
+    runoff = []
+    for forcing_step in forcings:
+        for i, x in enumerate(dynamic_inputs):
+            slow_model.set_value(slow_model._var_name_map_short_first[x], forcing_step[i:i + 1])
+        slow_model.update()
+        runoff.append(slow_model.get_value_ptr('land_surface_water__runoff_depth')[0])
+    # The 3 hour step of the reference model gets the sums of the summed forcings and the means of the others
+    step_runoff = []
+    for model_step in forcings.reshape(2, 3, n_inputs):
+        for i, x in enumerate(dynamic_inputs):
+            value = model_step[:, i].sum() if x in bmi_lstm.bmi_LSTM._summed_forcings else model_step[:, i].mean()
+            step_model.set_value(step_model._var_name_map_short_first[x], np.array([value]))
+        step_model.update()
+        step_runoff.append(step_model.get_value_ptr('land_surface_water__runoff_depth')[0])
+    assert runoff[0] == runoff[1] == 0.0
+    assert np.allclose(runoff[2:5], step_runoff[0], rtol=1e-6)
+    assert np.isclose(runoff[5], step_runoff[1], rtol=1e-6) and runoff[5] != runoff[4]
+    # The sequence runs take one LSTM step per BMI step, so they refuse an LSTM with a longer time step
+    for sequence_run in [lambda: slow_model.run_sequence(forcings),
+                         lambda: slow_model.run_scenarios(forcings[np.newaxis]),
+                         lambda: slow_model.compare_to_float64(forcings)]:
+        try:
+            sequence_run()
+            raise AssertionError("a sequence run ran an LSTM with a longer time step")
+        except ValueError:
+            pass
+    print (" multi-timescale LSTM buffers forcings over its model step")
+    pass_count += 1
+except:
+    bmi_except('multi-timescale LSTM buffers forcings over its model step')
+
+#-------------------------------------------------------------------
+# StreamingSkill over chunks of time steps with missing values gives the scores of the whole series
+try:
+    import lstm_skill_metrics
+    rng = np.random.default_rng(2)
+    # A large mean with small variations, where raw sums of squares lose the variance to cancellation
+    observed = 1e4 + rng.gamma(2.0, 1.0, (1000, 3))
+    simulated = observed + rng.normal(0.2, 0.5, (1000, 3))
+    observed[rng.random(observed.shape) < 0.1] = np.nan
+    simulated[rng.random(simulated.shape) < 0.05] = np.nan
+    simulated[:, 2] = np.nan
+    evaluator = lstm_skill_metrics.StreamingSkill(3)
+    for start, stop in [(0, 1), (1, 200), (200, 201), (201, 777), (777, 1000)]:
+        evaluator.update(simulated[start:stop], observed[start:stop])
+    skill = evaluator.scores()
+    for basin in range(2):
+        valid = ~(np.isnan(simulated[:, basin]) | np.isnan(observed[:, basin]))
+        sim, obs = simulated[valid, basin], observed[valid, basin]
+        nse = 1 - ((sim - obs)**2).sum() / ((obs - obs.mean())**2).sum()
+        r = np.corrcoef(sim, obs)[0, 1]
+        kge = 1 - np.sqrt((r - 1)**2 + (sim.std() / obs.std() - 1)**2 + (sim.mean() / obs.mean() - 1)**2)
+        assert skill['n'][basin] == valid.sum()
+        assert np.isclose(skill['nse'][basin], nse, rtol=1e-9)
+        assert np.isclose(skill['kge'][basin], kge, rtol=1e-9)
+        assert np.isclose(skill['r'][basin], r, rtol=1e-9)
+    assert skill['n'][2] == 0 and np.isnan(skill['nse'][2]) and np.isnan(skill['kge'][2])
+    print (" StreamingSkill scores match the scores of the whole series")
+    pass_count += 1
+except:
+    bmi_except('StreamingSkill scores match the scores of the whole series')
+
+#-------------------------------------------------------------------
+# ModelRegistry loads a variant once for concurrent requests, and only evicts the variants no live instance runs
+try:
+    import gc
+    from concurrent.futures import ThreadPoolExecutor
+    import lstm_engines
+    import lstm_model_registry
+    train_cfg_files = [bmi_lstm.read_bmi_config(Path('../bmi_config_files/01022500_' + name + '.yml'))['train_cfg_file']
+                       for name in ['hourly_all_attributes_forcings', 'hourly_forcings_lat_lon_elev',
+                                    'hourly_slope_mean_precip_temp']]
+    variant_keys = [lstm_model_registry.ModelRegistry.variant_key(x) for x in train_cfg_files]
+    registry = lstm_model_registry.ModelRegistry(memory_budget=1)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        variant_bundles = list(executor.map(lambda _: registry.get(train_cfg_files[0]), range(4)))
+    assert registry.n_loads == 1 and all(x is variant_bundles[0] for x in variant_bundles)
+    registry_model = bmi_lstm.bmi_LSTM()
+    registry_model.initialize_from_config(bmi_lstm.read_bmi_config(cfg_file), model_bundle=variant_bundles[0])
+    # The torch engine runs the trained LSTM itself, the numpy engine holds a copy of its weights
+    lstm_nbytes = lstm_engines.module_nbytes(variant_bundles[0]['lstm'])
+    assert list(variant_bundles[0]['engines']) == [('torch', 'float32')]
+    assert lstm_model_registry.bundle_nbytes(variant_bundles[0]) == lstm_nbytes
+    numpy_model = bmi_lstm.bmi_LSTM()
+    numpy_model.initialize_from_config(dict(bmi_lstm.read_bmi_config(cfg_file), engine='numpy'),
+                                       model_bundle=variant_bundles[0])
+    # The numpy engine adds the two bias vectors of the LSTM into one
+    bias_nbytes = variant_bundles[0]['lstm'].lstm.bias_hh_l0.nbytes
+    assert lstm_model_registry.bundle_nbytes(variant_bundles[0]) == 2 * lstm_nbytes - bias_nbytes
+    del numpy_model
+    del variant_bundles
+    # Over the budget, but the first variant is run by registry_model
+    registry.get(train_cfg_files[1])
+    assert registry.n_evictions == 0 and variant_keys[0] in registry._bundles
+    del registry_model
+    gc.collect()
+    registry.get(train_cfg_files[2])
+    assert registry.n_evictions == 2 and list(registry._bundles) == variant_keys[2:]
+    print (" ModelRegistry loads once and keeps the variants in use")
+    pass_count += 1
+except:
+    bmi_except('ModelRegistry loads once and keeps the variants in use')
+
+#-------------------------------------------------------------------
+# StateStore paging the states of float64 instances in and out of a small memory budget keeps them exactly
+try:
+    import lstm_state_store
+    paged_cfgs = [dict(cfg, dtype='float64') for cfg in multi_cfgs]
+    paged_models, resident_models = [], []
+    for cfg in paged_cfgs + paged_cfgs:
+        model = bmi_lstm.bmi_LSTM()
+        model.initialize_from_config(cfg)
+        (paged_models if len(paged_models) < len(paged_cfgs) else resident_models).append(model)
+    n_inputs = len(paged_models[0].cfg_train['dynamic_inputs'])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            paged_models[0].attach_state_store(lstm_state_store.StateStore(
+                Path(tmp_dir) / 'float32.dat', multi_basin_ids, paged_models[0].hidden_layer_size, 2**20))
+            raise AssertionError("a float32 state store took the states of a float64 instance")
+        except ValueError:
+            pass
+        # Room for the states of two of the three basins
+        store = lstm_state_store.StateStore(Path(tmp_dir) / 'states.dat', multi_basin_ids,
+                                            paged_models[0].hidden_layer_size,
+                                            2 * 2 * paged_models[0].hidden_layer_size * 8, dtype=np.float64)
+        for model in paged_models:
+            model.attach_state_store(store)
+        rng = np.random.default_rng(3)
+        for forcing_step in rng.standard_normal((24, len(paged_cfgs), n_inputs)):
+            for paged_model, resident_model, forcings in zip(paged_models, resident_models, forcing_step):
+                for model in (paged_model, resident_model):
+                    for i, x in enumerate(model.cfg_train['dynamic_inputs']):
+                        model.set_value(model._var_name_map_short_first[x],
+                                        model.input_mean[i:i + 1] + model.input_std[i:i + 1] * forcings[i])
+                    model.update()
+            store.end_window()
+        assert store.n_page_outs > 0 and store.n_page_ins > 0
+        for paged_model, resident_model in zip(paged_models, resident_models):
+            for paged_states, resident_states in zip(paged_model._get_states(), resident_model._get_states()):
+                assert paged_states.dtype == np.float64 and np.array_equal(paged_states, resident_states)
+            assert np.array_equal(paged_model.get_value_ptr('land_surface_water__runoff_depth'),
+                                  resident_model.get_value_ptr('land_surface_water__runoff_depth'))
+        del store
+    print (" StateStore pages the states out and back in exactly")
+    pass_count += 1
+except:
+    bmi_except('StateStore pages the states out and back in exactly')
+
+#-------------------------------------------------------------------
+# compare_to_float64() needs the torch LSTM, a model loaded from an onnx_file raises a ValueError, and the ONNX graph
+# has to fit the training configuration
+try:
+    import lstm_onnx
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cfg_bmi = bmi_lstm.read_bmi_config(cfg_file)
+        onnx_file = lstm_onnx.export_onnx(cfg_bmi['train_cfg_file'], Path(tmp_dir) / 'model.onnx')
+        onnx_model = bmi_lstm.bmi_LSTM()
+        onnx_model.initialize_from_config(dict(cfg_bmi, onnx_file=str(onnx_file)))
+        # The session started to check the graph is the one the instances run
+        onnx_bundle = lstm_onnx.load_onnx_bundle(cfg_bmi['train_cfg_file'], onnx_file)
+        bundle_engine = onnx_bundle['engines'][('onnxruntime', 'float32')]
+        shared_onnx_model = bmi_lstm.bmi_LSTM()
+        shared_onnx_model.initialize_from_config(dict(cfg_bmi, onnx_file=str(onnx_file)), model_bundle=onnx_bundle)
+        assert shared_onnx_model.engine is bundle_engine
+        try:
+            onnx_model.compare_to_float64(np.zeros((2, len(onnx_model.cfg_train['dynamic_inputs']))))
+            raise AssertionError("compare_to_float64() ran without a torch LSTM")
+        except ValueError:
+            pass
+        # A graph of another trained model does not fit the training configuration
+        other_cfg_bmi = bmi_lstm.read_bmi_config(Path('../bmi_config_files/01022500_hourly_slope_mean_precip_temp.yml'))
+        try:
+            lstm_onnx.load_onnx_bundle(other_cfg_bmi['train_cfg_file'], onnx_file)
+            raise AssertionError("load_onnx_bundle() took the graph of another model")
+        except ValueError:
+            pass
+    print (" ONNX models are checked against their training configuration")
+    pass_count += 1
+except:
+    bmi_except('ONNX models are checked against their training configuration')
+
+#-------------------------------------------------------------------
+# ResultCache keys on the weights, not the model objects, and keeps its size index in step with the directory
+try:
+    import lstm_result_cache
+    cfg_bmi = bmi_lstm.read_bmi_config(cfg_file)
+    cached_models = []
+    for _ in range(3):
+        model = bmi_lstm.bmi_LSTM()
+        model.initialize_from_config(cfg_bmi, model_bundle=bmi_lstm.load_config_bundle(cfg_bmi))
+        cached_models.append(model)
+    cached_models[2].engine.module.head.bias.data += 0.1
+    n_inputs = len(cached_models[0].cfg_train['dynamic_inputs'])
+    rng = np.random.default_rng(4)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = lstm_result_cache.ResultCache(tmp_dir)
+        forcings = rng.standard_normal((24, n_inputs))
+        for model in cached_models:
+            cache.run_sequence(model, forcings)
+        # The second model has its own copy of the same weights, the third other weights
+        assert (cache.hits, cache.misses) == (1, 2)
+        result_sizes = [path.stat().st_size for path in Path(tmp_dir).glob('*.npz')]
+        assert cache.nbytes == sum(result_sizes) and len(result_sizes) == 2
+        cache.max_bytes = max(result_sizes)
+        cache.evict()
+        assert cache.nbytes == sum(path.stat().st_size for path in Path(tmp_dir).glob('*.npz')) <= cache.max_bytes
+        assert lstm_result_cache.ResultCache(tmp_dir).nbytes == cache.nbytes
+    print (" ResultCache keys on the weights and tracks its size")
+    pass_count += 1
+except:
+    bmi_except('ResultCache keys on the weights and tracks its size')
+
+#-------------------------------------------------------------------
+# SharedForcingRunner: the recycled double buffer slots carry each time step's own forcings and outputs, the same as
+# updating the basins in this process
+try:
+    import lstm_shared_forcings
+    serial_bmi = bmi_lstm.bmi_LSTM()
+    serial_bmi.initialize_from_config(bmi_lstm.combine_bmi_configs(multi_cfgs))
+    n_inputs = len(serial_bmi.cfg_train['dynamic_inputs'])
+    rng = np.random.default_rng(5)
+    forcings = serial_bmi.input_mean[:n_inputs] + serial_bmi.input_std[:n_inputs] * rng.standard_normal(
+        (7, len(multi_cfgs), n_inputs))
+    serial_outputs = []
+    for forcing_step in np.concatenate([forcings, forcings[::-1]]):
+        for i, x in enumerate(serial_bmi.cfg_train['dynamic_inputs']):
+            serial_bmi.set_value(serial_bmi._var_name_map_short_first[x], forcing_step[:, i])
+        serial_bmi.update()
+        serial_outputs.append([serial_bmi.get_value_ptr(x).copy() for x in lstm_shared_forcings.output_var_names])
+    with lstm_shared_forcings.SharedForcingRunner(multi_cfgs, n_workers=2) as runner:
+        # A second run goes on from the slots of the first
+        shared_outputs = np.concatenate([runner.run(forcings), runner.run(forcings[::-1])])
+    assert shared_outputs.shape == (14, len(lstm_shared_forcings.output_var_names), len(multi_cfgs))
+    assert np.allclose(shared_outputs, serial_outputs, rtol=1e-6, atol=0)
+    print (" SharedForcingRunner matches updating the basins serially")
+    pass_count += 1
+except:
+    bmi_except('SharedForcingRunner matches updating the basins serially')
+
+#-------------------------------------------------------------------
+# AsyncOutputWriter: the netCDF4 and Zarr files hold the outputs of every update(), over several recycled chunks
+try:
+    import lstm_async_writer
+    from netCDF4 import Dataset
+    import zarr
+    rng = np.random.default_rng(6)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for file_name in ['runoff.nc', 'runoff.zarr']:
+            writer_bmi = bmi_lstm.bmi_LSTM()
+            writer_bmi.initialize_from_config(bmi_lstm.combine_bmi_configs(multi_cfgs))
+            n_inputs = len(writer_bmi.cfg_train['dynamic_inputs'])
+            writer = lstm_async_writer.AsyncOutputWriter(Path(tmp_dir) / file_name, len(multi_cfgs),
+                                                         basin_ids=multi_basin_ids, chunk_steps=4,
+                                                         max_queued_chunks=1, dtype=np.float64)
+            writer_bmi.attach_recorder(writer)
+            expected, expected_times = [], []
+            for forcing_step in rng.standard_normal((10, len(multi_cfgs), n_inputs)):
+                for i, x in enumerate(writer_bmi.cfg_train['dynamic_inputs']):
+                    writer_bmi.set_value(writer_bmi._var_name_map_short_first[x],
+                                         writer_bmi.input_mean[i] + writer_bmi.input_std[i] * forcing_step[:, i])
+                writer_bmi.update()
+                expected.append([writer_bmi.get_value_ptr(x).copy() for x in writer.var_names])
+                expected_times.append(writer_bmi.get_current_time())
+            writer_bmi.finalize()
+            writer.close()
+            # The written chunks came back to be recycled, reset
+            free_buffers = list(writer._free_buffers.queue)
+            assert free_buffers and all(np.isnan(buffer).all() for buffer, _ in free_buffers)
+            if file_name.endswith('.nc'):
+                with Dataset(Path(tmp_dir) / file_name) as data:
+                    written = np.stack([data[x][:] for x in writer.var_names], axis=1)
+                    written_times = data['time'][:]
+                    written_basin_ids = list(data['basin_id'][:])
+            else:
+                group = zarr.open_group(str(Path(tmp_dir) / file_name), mode='r')
+                written = np.stack([group[x][:] for x in writer.var_names], axis=1)
+                written_times = group['time'][:]
+                written_basin_ids = list(group['basin_id'][:])
+            assert np.array_equal(written, expected) and np.array_equal(written_times, expected_times)
+            assert written_basin_ids == multi_basin_ids
+    print (" AsyncOutputWriter files hold every update()")
+    pass_count += 1
+except:
+    bmi_except('AsyncOutputWriter files hold every update()')
+
+#-------------------------------------------------------------------
+# Arrow record batches and Parquet files of a recording hold the recorded values, one row per time step and basin
+try:
+    import pyarrow.parquet as pq
+    import lstm_arrow_export
+    rng = np.random.default_rng(7)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        recorded_bmi = bmi_lstm.bmi_LSTM()
+        recorded_bmi.initialize_from_config(bmi_lstm.combine_bmi_configs(multi_cfgs))
+        n_inputs = len(recorded_bmi.cfg_train['dynamic_inputs'])
+        recording_file = Path(tmp_dir) / 'runoff.dat'
+        # Preallocated for more time steps than are recorded
+        recorder = lstm_output_recorder.OutputRecorder(recording_file, 16, len(multi_cfgs), basin_ids=multi_basin_ids)
+        recorded_bmi.attach_recorder(recorder)
+        for forcing_step in rng.standard_normal((10, len(multi_cfgs), n_inputs)):
+            for i, x in enumerate(recorded_bmi.cfg_train['dynamic_inputs']):
+                recorded_bmi.set_value(recorded_bmi._var_name_map_short_first[x],
+                                       recorded_bmi.input_mean[i] + recorded_bmi.input_std[i] * forcing_step[:, i])
+            recorded_bmi.update()
+        recorded_bmi.finalize()
+        recorded = np.array(recorder.data[:10])
+        n_vars = len(recorder.var_names)
+        rows = recorded.reshape(-1, n_vars)
+        batches = list(lstm_arrow_export.record_batches(recording_file, batch_steps=4))
+        assert [batch.num_rows for batch in batches] == [12, 12, 6]
+        batch_values = np.concatenate([batch.column('values').flatten().to_numpy() for batch in batches])
+        assert np.array_equal(batch_values.reshape(-1, n_vars), rows)
+        for split_variables in (False, True):
+            parquet_file = Path(tmp_dir) / 'runoff_{}.parquet'.format(split_variables)
+            assert lstm_arrow_export.write_parquet(recording_file, parquet_file, batch_steps=4,
+                                                   split_variables=split_variables) == rows.shape[0]
+            table = pq.read_table(parquet_file)
+            assert pq.ParquetFile(parquet_file).num_row_groups == 3
+            assert np.array_equal(table.column('time').to_numpy(), np.repeat(np.arange(10), len(multi_cfgs)))
+            assert table.column('basin_id').to_pylist() == multi_basin_ids * 10
+            if split_variables:
+                parquet_values = np.stack([table.column(x).to_numpy() for x in recorder.var_names], axis=1)
+            else:
+                parquet_values = table.column('values').combine_chunks().flatten().to_numpy().reshape(-1, n_vars)
+            assert np.array_equal(parquet_values, rows)
+        del recorder, batches
+    print (" Arrow and Parquet exports hold the recorded values")
+    pass_count += 1
+except:
+    bmi_except('Arrow and Parquet exports hold the recorded values')
+
+#-------------------------------------------------------------------
+# A hindcast replayed from the forcing cache is the same as one read from the netCDF file
+try:
+    import lstm_forcing_cache
+    import lstm_hindcast
+    sample_data_file = Path('../data/usgs-streamflow-nldas_hourly.nc')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        forcing_cache = lstm_forcing_cache.build_forcing_cache(sample_data_file, tmp_dir)
+        # An unchanged file is not hashed again
+        file_hash = lstm_forcing_cache.file_hash
+        def rehash(path, block_size=2**20):
+            raise AssertionError("an unchanged file was hashed again")
+        lstm_forcing_cache.file_hash = rehash
+        try:
+            assert lstm_forcing_cache.build_forcing_cache(sample_data_file, tmp_dir).path == forcing_cache.path
+        finally:
+            lstm_forcing_cache.file_hash = file_hash
+        # Processes building the same cache at the same time all end up with the one cache
+        import concurrent.futures
+        with tempfile.TemporaryDirectory() as race_dir:
+            with concurrent.futures.ProcessPoolExecutor(3) as pool:
+                race_caches = list(pool.map(lstm_forcing_cache.build_forcing_cache, [sample_data_file] * 3,
+                                            [race_dir] * 3))
+            assert set(x.path for x in race_caches) == {Path(race_dir) / forcing_cache.path.name}
+            assert set(x.name for x in Path(race_dir).iterdir()) == {forcing_cache.path.name, 'file_hashes.json'}
+            assert np.array_equal(lstm_forcing_cache.ForcingCache(race_caches[0].path).values, forcing_cache.values,
+                                  equal_nan=True)
+            del race_caches
+        with lstm_hindcast.open_forcings(sample_data_file) as sample_data:
+            assert forcing_cache.basin_ids == sample_data.basin_ids and forcing_cache.n_steps == sample_data.n_steps
+            rows = sample_data.basin_rows(multi_basin_ids)
+            assert np.array_equal(forcing_cache.read(forcing_cache.var_names, forcing_cache.basin_rows(multi_basin_ids),
+                                                     0, 500),
+                                  sample_data.read(forcing_cache.var_names, rows, 0, 500), equal_nan=True)
+        replays = []
+        for data_file in [sample_data_file, forcing_cache]:
+            replay_bmi = bmi_lstm.bmi_LSTM()
+            replay_bmi.initialize_from_config(bmi_lstm.combine_bmi_configs(multi_cfgs))
+            chunks = []
+            evaluator = lstm_hindcast.run_hindcast(replay_bmi, data_file, n_steps=100, chunk_size=48,
+                                                   on_chunk=lambda start, runoff_mm: chunks.append(runoff_mm))
+            replays.append((np.concatenate(chunks), evaluator.scores()['nse'], replay_bmi._get_states()))
+        assert replays[0][0].shape == (100, len(multi_cfgs))
+        assert np.array_equal(replays[0][0], replays[1][0])
+        assert np.array_equal(replays[0][1], replays[1][1], equal_nan=True)
+        assert all(np.array_equal(x, y) for x, y in zip(replays[0][2], replays[1][2]))
+        del forcing_cache
+    print (" hindcast from the forcing cache matches the netCDF file")
+    pass_count += 1
+except:
+    bmi_except('hindcast from the forcing cache matches the netCDF file')
+
+#-------------------------------------------------------------------
+# Regridding weights of each basin add up to one, and longitudes wrap around the seam of a global grid
+try:
+    import lstm_regrid
+    grid_lat = np.arange(24.25, 53.0, 0.5)
+    grid_lon = np.arange(0.25, 360.0, 0.5)
+    rng = np.random.default_rng(8)
+    fields = rng.random((2, len(grid_lat), len(grid_lon)))
+    # The basins have longitudes from -180 to 180 degrees, the grid from 0 to 360
+    regridder = lstm_regrid.GridRegridder.for_model(multi_bmi, grid_lat, grid_lon)
+    shifted_regridder = lstm_regrid.GridRegridder.for_model(multi_bmi, grid_lat, grid_lon - 180.0)
+    assert np.allclose(regridder.weights.sum(axis=1), 1.0)
+    assert np.allclose(regridder.regrid(fields), shifted_regridder.regrid(np.roll(fields, 360, axis=-1)))
+    # A box across the seam covers the first and the last columns of cells, each with half its weight
+    seam_weights = lstm_regrid.box_weights(40.1, 0.0, 400.0, grid_lat, grid_lon).toarray().reshape(len(grid_lat), -1)
+    assert np.isclose(seam_weights.sum(), 1.0)
+    assert np.isclose(seam_weights[:, 0].sum(), 0.5) and np.isclose(seam_weights[:, -1].sum(), 0.5)
+    # Cells without data get no weight, the others of the basin still add up to one
+    mask = np.ones((len(grid_lat), len(grid_lon)), dtype=bool)
+    mask[:, ::2] = False
+    masked_weights = lstm_regrid.box_weights(multi_bmi._basin_values('lat'), multi_bmi._basin_values('lon'),
+                                             multi_bmi._basin_values('area_sqkm') * 100, grid_lat, grid_lon, mask)
+    assert np.allclose(masked_weights.sum(axis=1), 1.0) and not masked_weights[:, ~mask.ravel()].nnz
+    print (" regridding weights add up to one and wrap around in longitude")
+    pass_count += 1
+except:
+    bmi_except('regridding weights add up to one and wrap around in longitude')
+
+#-------------------------------------------------------------------
+# ThreadedStepper updating instances from a thread pool gives the runoff of updating them one after the other
+try:
+    import lstm_thread_pool
+    cfg_bmi = bmi_lstm.read_bmi_config(cfg_file)
+    bundle = bmi_lstm.load_config_bundle(cfg_bmi)
+    def make_stepped_models():
+        # Single basin instances and a batched one sharing the bundle, as in lstm_thread_pool's use
+        cfgs = [multi_cfgs[:1], multi_cfgs[1:2], multi_cfgs[2:], multi_cfgs[:2]]
+        models = []
+        for basin_cfgs in cfgs:
+            model = bmi_lstm.bmi_LSTM()
+            model.initialize_from_config(bmi_lstm.combine_bmi_configs(basin_cfgs) if len(basin_cfgs) > 1
+                                         else basin_cfgs[0], model_bundle=bundle)
+            models.append(model)
+        return models
+    serial_models = make_stepped_models()
+    n_inputs = len(serial_models[0].cfg_train['dynamic_inputs'])
+    n_stepped_basins = sum(model.n_basins for model in serial_models)
+    rng = np.random.default_rng(9)
+    forcings = (serial_models[0].input_mean[:n_inputs]
+                + serial_models[0].input_std[:n_inputs] * rng.standard_normal((12, n_stepped_basins, n_inputs)))
+    serial_runoff = []
+    for forcing_step in forcings:
+        first_basin = 0
+        for model in serial_models:
+            for i, x in enumerate(model.cfg_train['dynamic_inputs']):
+                model.set_value(model._var_name_map_short_first[x],
+                                forcing_step[first_basin:first_basin + model.n_basins, i])
+            model.update()
+            first_basin += model.n_basins
+        serial_runoff.append(np.concatenate([np.atleast_1d(model.get_value_ptr('land_surface_water__runoff_depth'))
+                                             for model in serial_models]) * 1000.0)
+    for n_threads in (1, 3):
+        with lstm_thread_pool.ThreadedStepper(make_stepped_models(), n_threads) as stepper:
+            threaded_runoff = stepper.run(forcings)
+        # The intra-op thread count of torch changes with n_threads, which can change the last bits
+        assert np.allclose(threaded_runoff, serial_runoff, rtol=1e-6, atol=0)
+    print (" ThreadedStepper matches serial update()")
+    pass_count += 1
+except:
+    bmi_except('ThreadedStepper matches serial update()')
+
+#-------------------------------------------------------------------
+# run_scenarios(): each scenario is run_sequence() of a copy of the model, from the states and attributes of the basin
+try:
+    import copy
+    n_inputs = len(multi_bmi.cfg_train['dynamic_inputs'])
+    n_basins = len(multi_basin_ids)
+    rng = np.random.default_rng(11)
+    multi_bmi.run_sequence(multi_bmi.input_mean[:n_inputs]
+                           + multi_bmi.input_std[:n_inputs] * rng.standard_normal((24, n_basins, n_inputs)))
+    scenarios = (multi_bmi.input_mean[:n_inputs]
+                 + multi_bmi.input_std[:n_inputs] * rng.standard_normal((4, 48, n_inputs)))
+    outputs = {var_name: multi_bmi.get_value_ptr(var_name).copy() for var_name in multi_bmi.get_output_var_names()}
+    h_t, c_t = (x.copy() for x in multi_bmi._get_states())
+    t = multi_bmi.t
+    scenario_runoff = [multi_bmi.run_scenarios(scenarios, basin=basin) for basin in range(n_basins)]
+    for basin in range(n_basins):
+        assert scenario_runoff[basin].shape == (4, 48)
+        for scenario, runoff in zip(scenarios, scenario_runoff[basin]):
+            # All the basins of the copy get the scenario, the batch rows are independent
+            trace = np.repeat(scenario[:, np.newaxis, :], n_basins, axis=1)
+            assert np.allclose(runoff, copy.deepcopy(multi_bmi).run_sequence(trace)[:, basin], rtol=1e-6, atol=0)
+    assert not np.allclose(scenario_runoff[1], scenario_runoff[0])
+    assert all(np.array_equal(multi_bmi.get_value_ptr(var_name), value) for var_name, value in outputs.items())
+    assert all(np.array_equal(x, y) for x, y in zip(multi_bmi._get_states(), (h_t, c_t)))
+    assert multi_bmi.t == t
+    print (" run_scenarios() matches run_sequence() of the basin and leaves the model unchanged")
+    pass_count += 1
+except:
+    bmi_except('run_scenarios() matches run_sequence() of the basin and leaves the model unchanged')
+
+#-------------------------------------------------------------------
+# static_sensitivity(): perturbation and autograd agree, and the base run is run_sequence() of an untouched model
+try:
+    import copy
+    import lstm_sensitivity
+    sensitivity_model = bmi_lstm.bmi_LSTM()
+    sensitivity_model.initialize(cfg_file)
+    n_inputs = len(sensitivity_model.cfg_train['dynamic_inputs'])
+    rng = np.random.default_rng(12)
+    forcings = (sensitivity_model.input_mean[:n_inputs]
+                + sensitivity_model.input_std[:n_inputs] * rng.standard_normal((72, n_inputs)))
+    sensitivity_model.run_sequence(forcings[:24])
+    h_t, c_t = (x.copy() for x in sensitivity_model._get_states())
+    t = sensitivity_model.t
+    sensitivities = {method: lstm_sensitivity.static_sensitivity(sensitivity_model, forcings[24:], method=method)
+                     for method in lstm_sensitivity.sensitivity_methods}
+    perturbation, autograd = sensitivities['perturbation']['sensitivity'], sensitivities['autograd']['sensitivity']
+    assert perturbation.shape == (48, len(sensitivity_model.cfg_train['static_attributes']))
+    # Central differences of the float32 model are within 0.1 % of the largest exact derivative
+    assert np.abs(autograd).max() > 0
+    assert np.allclose(perturbation, autograd, rtol=0, atol=1e-3 * np.abs(autograd).max())
+    reference_runoff = copy.deepcopy(sensitivity_model).run_sequence(forcings[24:])
+    for method in lstm_sensitivity.sensitivity_methods:
+        assert np.allclose(sensitivities[method]['runoff_mm'], reference_runoff, rtol=1e-6, atol=0)
+    assert all(np.array_equal(x, y) for x, y in zip(sensitivity_model._get_states(), (h_t, c_t)))
+    assert sensitivity_model.t == t
+    print (" static_sensitivity() methods agree and leave the model unchanged")
+    pass_count += 1
+except:
+    bmi_except('static_sensitivity() methods agree and leave the model unchanged')
+
+#-------------------------------------------------------------------
+# partition_basins(): every basin on one rank, with balanced costs
+try:
+    import lstm_mpi_runner
+    rng = np.random.default_rng(13)
+    basin_costs = rng.uniform(0.5, 4.0, 23)
+    for n_ranks, costs in [(4, None), (4, basin_costs), (5, basin_costs[:3])]:
+        n_partitioned = 23 if costs is None else len(costs)
+        costs = np.ones(n_partitioned) if costs is None else costs
+        parts = lstm_mpi_runner.partition_basins(n_partitioned, n_ranks, costs)
+        assert len(parts) == n_ranks
+        assert np.array_equal(np.sort(np.concatenate(parts)), np.arange(n_partitioned))
+        rank_costs = [costs[part].sum() for part in parts]
+        # The longest processing time rule leaves the ranks at most one basin's cost apart
+        assert max(rank_costs) - min(rank_costs) <= costs.max()
+    assert [len(part) for part in parts] == [1, 1, 1, 0, 0]
+    print (" partition_basins() assigns every basin once and balances the ranks")
+    pass_count += 1
+except:
+    bmi_except('partition_basins() assigns every basin once and balances the ranks')
+
+#-------------------------------------------------------------------
+# run_partition() on a single rank: the collective and per rank outputs hold the runoff of run_hindcast()
+try:
+    import tempfile
+    from mpi4py import MPI
+    import camels_bmi_configs
+    import lstm_hindcast
+    import lstm_mpi_runner
+    sample_data_file = Path('../data/usgs-streamflow-nldas_hourly.nc')
+    with Dataset(sample_data_file, 'r') as sample_data:
+        sample_basins = [str(sample_data['basin'][x]).zfill(8) for x in range(sample_data.dimensions['basin'].size)]
+    template_cfg = bmi_lstm.read_bmi_config(cfg_file)
+    camels_attributes = camels_bmi_configs.read_camels_attributes()
+    reference_model = bmi_lstm.bmi_LSTM()
+    reference_model.initialize_from_config(bmi_lstm.combine_bmi_configs(
+        [camels_bmi_configs.make_bmi_config(template_cfg, basin_id, camels_attributes) for basin_id in sample_basins]))
+    reference_chunks = []
+    lstm_hindcast.run_hindcast(reference_model, sample_data_file, 50, obs_var_name=None, chunk_size=20,
+                               on_chunk=lambda start, chunk_runoff_mm: reference_chunks.append(chunk_runoff_mm))
+    reference_runoff = np.concatenate(reference_chunks).T.astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for output_mode in lstm_mpi_runner.output_modes:
+            stats = lstm_mpi_runner.run_partition(template_cfg, sample_basins, sample_data_file, 50,
+                                                  Path(tmp_dir) / (output_mode + '.npy'), output_mode,
+                                                  Path(tmp_dir) / (output_mode + '_states.npz'), chunk_size=20,
+                                                  comm=MPI.COMM_SELF)
+            assert stats['n_ranks'] == 1 and stats['n_basins'] == [len(sample_basins)]
+        collective_runoff = np.load(Path(tmp_dir) / 'collective.npy')
+        per_rank_runoff = lstm_mpi_runner.read_per_rank_outputs(Path(tmp_dir) / 'per_rank.npy', sample_basins)
+    assert collective_runoff.shape == (len(sample_basins), 50)
+    assert np.allclose(collective_runoff, reference_runoff, rtol=1e-6, atol=0)
+    assert np.array_equal(per_rank_runoff, collective_runoff)
+    print (" run_partition() on one rank writes the runoff of run_hindcast()")
+    pass_count += 1
+except:
+    bmi_except('run_partition() on one rank writes the runoff of run_hindcast()')
+
 # lastly - print test summary
 print ("\n Total BMI function PASS: " + str(pass_count))
 print (" Total BMI function FAIL: " + str(fail_count))
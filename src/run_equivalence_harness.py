@@ -0,0 +1,185 @@
+"""Numerical-equivalence regression harness for the fast LSTM paths.
+
+Replays the sample forcings of the basins in ``data/4_basins_test_set.txt`` through the step-wise reference
+(``bmi_LSTM.update()`` once per time step) and checks every alternative path in ``lstm_fast_paths.py``, a single
+instance running all the basins, the inference engines of the BMI ``engine`` option, the numeric types of the BMI
+``dtype`` option, restarts from states pickled with each ``state_codec`` and a rerun read back from a result cache,
+against it with a per-path tolerance. The timing of each path is reported next to its speedup over the reference.
+
+The reference runoff is stored as a golden series the first time the harness runs. Later runs also check the
+reference itself against the golden series, so a change of the reference is caught too; a golden series of other
+basins or fewer time steps fails. The committed one has the default 720 time steps. Delete the golden file, or pass
+``update-golden``, to record it again after an intended change.
+
+To run, from the ``/src`` directory:
+    python ./run_equivalence_harness.py [number_of_time_steps] [update-golden]
+"""
+
+import pickle
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+# This is the BMI LSTM that we will be running
+import bmi_lstm
+import camels_bmi_configs
+import lstm_engines
+import lstm_fast_paths
+import lstm_result_cache
+
+# Define the bmi config of the trained model, input data and basin list file paths
+template_cfg_file = Path('../bmi_config_files/01022500_hourly_all_attributes_forcings.yml')
+sample_data_file = Path('../data/usgs-streamflow-nldas_hourly.nc')
+basin_list_file = Path('../data/4_basins_test_set.txt')
+golden_file = Path('../data/equivalence_golden_runoff.npz')
+
+n_steps = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 24 * 30
+update_golden = 'update-golden' in sys.argv[1:]
+
+# Largest absolute runoff difference from the reference allowed for each path (mm per time step).
+# The float32 paths differ from the reference only by the order of floating point operations.
+tolerances = {'golden': 1e-6,
+              'sequence': 1e-5,
+              'batched': 1e-5,
+              'multi_basin': 1e-5,
+              'fused_normalization': 1e-4,
+              'numpy': 1e-5,
+              'quantized': 5e-2,
+              'float64': 1e-4,
+              'bfloat16': 5e-2,
+              'state_codec_float16': 1e-4,
+              'state_codec_int8': 5e-2,
+              'result_cache': 1e-5}
+# The engines only differ from the reference (the torch engine) by the order of floating point operations too
+tolerances.update({'engine_' + name: 1e-5 for name in lstm_engines.engine_names()})
+
+#-------------------------------------------------------------------
+# Basins, their configurations and forcings
+#-------------------------------------------------------------------
+template_cfg = bmi_lstm.read_bmi_config(template_cfg_file)
+basin_ids = camels_bmi_configs.read_basin_list(basin_list_file)
+camels_attributes = camels_bmi_configs.read_camels_attributes()
+basin_cfgs = [camels_bmi_configs.make_bmi_config(template_cfg, basin_id, camels_attributes) for basin_id in basin_ids]
+bundle = bmi_lstm.load_model_bundle(template_cfg['train_cfg_file'])
+
+sample_data = Dataset(sample_data_file, 'r')
+sample_basins = {str(sample_data['basin'][x]).zfill(8): x for x in range(len(list(sample_data['basin'])))}
+n_steps = min(n_steps, sample_data.dimensions['date'].size)
+
+# Forcings with shape (time, basin, dynamic input)
+dynamic_inputs = np.stack([np.stack([np.asarray(sample_data[x][sample_basins[basin_id]][:n_steps], dtype=np.float64)
+                                     for x in bundle['cfg_train']['dynamic_inputs']], axis=-1)
+                           for basin_id in basin_ids], axis=1)
+
+def make_models(dtype='float32', engine='torch'):
+    """Freshly initialized models, one per basin, sharing the trained model bundle."""
+    models = []
+    for cfg in basin_cfgs:
+        model = bmi_lstm.bmi_LSTM()
+        model.initialize_from_config(dict(cfg, dtype=dtype, engine=engine), model_bundle=bundle)
+        models.append(model)
+    return models
+
+def make_multi_basin_model():
+    """One model running all the basins as a batch."""
+    model = bmi_lstm.bmi_LSTM()
+    model.initialize_from_config(bmi_lstm.combine_bmi_configs(basin_cfgs), model_bundle=bundle)
+    return model
+
+def per_basin(run_function, dtype='float32', engine='torch'):
+    """Turn a single basin path of lstm_fast_paths into one returning runoff with shape (time, basin)."""
+    def run():
+        return np.stack([run_function(model, dynamic_inputs[:, i])
+                         for i, model in enumerate(make_models(dtype, engine))], axis=1)
+    return run
+
+def snapshot_halfway(state_codec):
+    """Run the reference path for half the time steps, then pickle the models with a state codec and go on."""
+    def run():
+        half = n_steps // 2
+        models = make_models()
+        runoff_mm = [lstm_fast_paths.run_stepwise(model, dynamic_inputs[:half, i]) for i, model in enumerate(models)]
+        for i, model in enumerate(models):
+            model.state_codec = state_codec
+            model = pickle.loads(pickle.dumps(model))
+            runoff_mm[i] = np.concatenate([runoff_mm[i], lstm_fast_paths.run_stepwise(model, dynamic_inputs[half:, i])])
+        return np.stack(runoff_mm, axis=1)
+    return run
+
+def result_cache_rerun():
+    """Run all the basins as a batch through an empty result cache in two chunks, then again, read from the cache."""
+    def run():
+        half = n_steps // 2
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = lstm_result_cache.ResultCache(cache_dir)
+            for _ in range(2):
+                model = make_multi_basin_model()
+                runoff_mm = np.concatenate([cache.run_sequence(model, dynamic_inputs[:half]),
+                                            cache.run_sequence(model, dynamic_inputs[half:])])
+            if cache.hits != 2:
+                raise RuntimeError("The rerun was not read from the result cache")
+        return runoff_mm
+    return run
+
+paths = {'sequence': per_basin(lstm_fast_paths.run_sequence),
+         'batched': lambda: lstm_fast_paths.run_batched(make_models(), dynamic_inputs),
+         'multi_basin': lambda: lstm_fast_paths.run_stepwise(make_multi_basin_model(), dynamic_inputs),
+         'fused_normalization': per_basin(lstm_fast_paths.run_fused_normalization),
+         'numpy': per_basin(lstm_fast_paths.run_numpy),
+         'quantized': per_basin(lstm_fast_paths.run_quantized),
+         'float64': per_basin(lstm_fast_paths.run_stepwise, dtype='float64'),
+         'bfloat16': per_basin(lstm_fast_paths.run_stepwise, dtype='bfloat16')}
+paths.update({'engine_' + name: per_basin(lstm_fast_paths.run_stepwise, engine=name)
+              for name in lstm_engines.engine_names()})
+paths.update({'state_codec_' + name: snapshot_halfway(name) for name in ['float16', 'int8']})
+paths['result_cache'] = result_cache_rerun()
+
+#-------------------------------------------------------------------
+# Reference and golden series
+#-------------------------------------------------------------------
+print("\nLSTM EQUIVALENCE HARNESS\n************************")
+print(" basins: " + ', '.join(basin_ids))
+print(" time steps: " + str(n_steps))
+
+start_time = time.perf_counter()
+reference = per_basin(lstm_fast_paths.run_stepwise)()
+reference_time = time.perf_counter() - start_time
+
+results = []
+if golden_file.exists() and not update_golden:
+    golden = np.load(golden_file)
+    if list(golden['basin_ids']) == basin_ids and golden['runoff_mm'].shape[0] >= n_steps:
+        results.append(('golden', np.abs(reference - golden['runoff_mm'][:n_steps]).max(), reference_time))
+    else:
+        # A golden series that cannot be compared fails, rather than the check being skipped
+        print(" golden series is for other basins or fewer time steps, pass update-golden to record it again")
+        results.append(('golden', np.inf, reference_time))
+else:
+    np.savez(golden_file, basin_ids=basin_ids, runoff_mm=reference)
+    print(" golden series recorded in " + str(golden_file))
+
+#-------------------------------------------------------------------
+# Alternative paths
+#-------------------------------------------------------------------
+for name, run in paths.items():
+    start_time = time.perf_counter()
+    runoff_mm = run()
+    results.append((name, np.abs(runoff_mm - reference).max(), time.perf_counter() - start_time))
+
+print("\n {:<20s} {:>12s} {:>10s} {:>10s} {:>8s}".format('path', 'max error', 'tolerance', 'time (s)', 'speedup'))
+print(" {:<20s} {:>12s} {:>10s} {:>10.3f} {:>8.2f}".format('reference', '-', '-', reference_time, 1.0))
+fail_list = []
+for name, max_error, run_time in results:
+    passed = max_error <= tolerances[name]
+    if not passed:
+        fail_list.append(name)
+    print(" {:<20s} {:>12.3e} {:>10.0e} {:>10.3f} {:>8.2f} {}".format(
+          name, max_error, tolerances[name], run_time, reference_time / run_time, '' if passed else '**FAIL**'))
+
+print("\n Total paths PASS: " + str(len(results) - len(fail_list)))
+print(" Total paths FAIL: " + str(len(fail_list)))
+sys.exit(1 if fail_list else 0)
@@ -0,0 +1,64 @@
+"""Hindcast of the CAMELS basins over MPI ranks, see ``lstm_mpi_runner.py``.
+
+The basins of ``data/camels_basin_list_516.txt`` (or the first ``number_of_basins`` of them) are partitioned over the
+ranks and run with the forcings of ``data/usgs-streamflow-nldas_hourly.nc``. The sample file only has the forcings of
+four basins, so these stand in, in turn, for the basins that are not in it. The runoff is written to
+``data/mpi_runoff.npy`` (collective) or ``data/mpi_runoff_rank*.npz`` (per_rank), and the states of each rank to
+``data/mpi_states_rank*.npz``; a second run continues from them. Rank 0 prints the timings of each rank, and their
+json on the last line.
+
+To run, from the ``/src`` directory:
+    mpirun -n 4 python ./run_mpi_hindcast.py [number_of_time_steps] [collective|per_rank] [number_of_basins] [restart]
+"""
+
+import json
+import sys
+from pathlib import Path
+
+from mpi4py import MPI
+from netCDF4 import Dataset
+
+import bmi_lstm
+import camels_bmi_configs
+import lstm_mpi_runner
+
+template_cfg_file = Path('../bmi_config_files/01022500_hourly_all_attributes_forcings.yml')
+sample_data_file = Path('../data/usgs-streamflow-nldas_hourly.nc')
+basin_list_file = Path('../data/camels_basin_list_516.txt')
+output_file = Path('../data/mpi_runoff.npy')
+checkpoint_file = Path('../data/mpi_states.npz')
+
+n_steps = int(sys.argv[1]) if len(sys.argv) > 1 else 24 * 30
+output_mode = sys.argv[2] if len(sys.argv) > 2 else 'collective'
+n_basins = int(sys.argv[3]) if len(sys.argv) > 3 else None
+restart = 'restart' in sys.argv[1:]
+
+comm = MPI.COMM_WORLD
+basin_ids = camels_bmi_configs.read_basin_list(basin_list_file)[:n_basins]
+
+with Dataset(sample_data_file, 'r') as sample_data:
+    sample_basins = [str(sample_data['basin'][x]).zfill(8) for x in range(sample_data.dimensions['basin'].size)]
+forcing_basin_ids = [basin_id if basin_id in sample_basins else sample_basins[i % len(sample_basins)]
+                     for i, basin_id in enumerate(basin_ids)]
+
+# Start from the initial states, unless continuing from the checkpoints of a previous run
+if comm.Get_rank() == 0 and not restart:
+    for rank_checkpoint_file in checkpoint_file.parent.glob(checkpoint_file.stem + '_rank*.npz'):
+        rank_checkpoint_file.unlink()
+comm.Barrier()
+
+stats = lstm_mpi_runner.run_partition(bmi_lstm.read_bmi_config(template_cfg_file), basin_ids, sample_data_file,
+                                      n_steps, output_file, output_mode, checkpoint_file,
+                                      forcing_basin_ids=forcing_basin_ids, comm=comm)
+
+if stats is not None:
+    print("\nLSTM MPI HINDCAST\n*****************")
+    print(" ranks: {}   basins: {}   time steps: {}   output: {}".format(stats['n_ranks'], len(basin_ids), n_steps,
+                                                                           output_mode))
+    print("\n {:>6s} {:>8s} {:>16s} {:>10s} {:>12s}".format('rank', 'basins', 'initialize (s)', 'run (s)', 'write (s)'))
+    for rank in range(stats['n_ranks']):
+        print(" {:>6d} {:>8d} {:>16.3f} {:>10.3f} {:>12.3f}".format(rank, stats['n_basins'][rank],
+                                                                     stats['initialize_time'][rank],
+                                                                     stats['run_time'][rank],
+                                                                     stats['write_time'][rank]))
+    print(json.dumps(stats))
@@ -0,0 +1,56 @@
+"""Strong and weak scaling of the MPI hindcast (``run_mpi_hindcast.py``) on the CAMELS 516 basins.
+
+Strong scaling runs all 516 basins on 1, 2, 4, ... up to ``max_ranks`` ranks. Weak scaling runs
+``basins_per_rank`` basins per rank on the same rank counts. The time of a run is that of its slowest rank, for the
+hindcast and the writes of its outputs (the initialization, mostly importing torch and reading the CAMELS attributes,
+is reported apart). Speedup and efficiency are relative to one rank. The ranks only scale up to the number of cores
+the host has; beyond that, Open MPI's ``--oversubscribe`` lets them share cores.
+
+To run, from the ``/src`` directory:
+    python ./run_mpi_scaling.py [max_ranks] [number_of_time_steps] [basins_per_rank] [collective|per_rank]
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# Open MPI launcher, --oversubscribe allows more ranks than cores
+mpirun_command = ['mpirun', '--oversubscribe']
+n_camels_basins = 516
+
+max_ranks = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+n_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 24 * 30
+basins_per_rank = int(sys.argv[3]) if len(sys.argv) > 3 else n_camels_basins // max_ranks
+output_mode = sys.argv[4] if len(sys.argv) > 4 else 'collective'
+
+def run_hindcast(n_ranks, n_basins):
+    """Run the MPI hindcast and return the stats json rank 0 prints last."""
+    command = mpirun_command + ['-n', str(n_ranks), sys.executable, './run_mpi_hindcast.py', str(n_steps),
+                                output_mode, str(n_basins)]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    stats = json.loads(output.strip().splitlines()[-1])
+    stats['time'] = max(run + write for run, write in zip(stats['run_time'], stats['write_time']))
+    return stats
+
+rank_counts = [2**k for k in range(max_ranks.bit_length()) if 2**k <= max_ranks]
+
+print("\nLSTM MPI SCALING\n****************")
+print(" time steps: {}   output: {}   cores: {}".format(n_steps, output_mode, os.cpu_count()))
+
+for weak in [False, True]:
+    if weak:
+        print("\n weak scaling, {} basins per rank".format(basins_per_rank))
+    else:
+        print("\n strong scaling, {} basins".format(n_camels_basins))
+    print(" {:>6s} {:>8s} {:>16s} {:>10s} {:>10s} {:>12s}".format('ranks', 'basins', 'initialize (s)', 'time (s)',
+                                                                  'speedup', 'efficiency'))
+    for n_ranks in rank_counts:
+        n_basins = min(basins_per_rank * n_ranks, n_camels_basins) if weak else n_camels_basins
+        stats = run_hindcast(n_ranks, n_basins)
+        if n_ranks == 1:
+            base_time = stats['time']
+        # Weak scaling does n_ranks times the work of one rank in (ideally) the same time
+        speedup = base_time / stats['time'] * (n_ranks if weak else 1)
+        print(" {:>6d} {:>8d} {:>16.3f} {:>10.3f} {:>10.2f} {:>12.2f}".format(
+              n_ranks, n_basins, max(stats['initialize_time']), stats['time'], speedup, speedup / n_ranks))
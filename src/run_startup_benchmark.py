@@ -0,0 +1,80 @@
+"""Startup benchmark for the BMI LSTM.
+
+Measures, each in a fresh python process so nothing is already imported or cached:
+    1. the time to ``import bmi_lstm``, and which heavy libraries that import pulls in
+    2. the time of the first ``initialize()``
+    3. the time of a second ``initialize()`` in the same process (cached training configuration)
+
+To run, from the ``/src`` directory:
+    python ./run_startup_benchmark.py [max_import_seconds] [max_initialize_seconds]
+
+The script exits with a non-zero status if ``import bmi_lstm`` imports torch or pandas, or if a time exceeds the
+optional limits given on the command line, so that startup regressions are caught.
+"""
+
+import json
+import subprocess
+import sys
+
+# Define the bmi config used for the initialize() timings
+bmi_cfg_file = '../bmi_config_files/01022500_hourly_all_attributes_forcings.yml'
+
+# Libraries that should NOT be imported by "import bmi_lstm"
+heavy_modules = ['torch', 'pandas', 'xarray', 'yaml']
+
+import_script = """
+import json, sys, time
+t0 = time.perf_counter()
+import bmi_lstm
+t1 = time.perf_counter()
+print(json.dumps({{'import_time': t1 - t0,
+                  'heavy_imports': [m for m in {heavy_modules!r} if m in sys.modules]}}))
+""".format(heavy_modules=heavy_modules)
+
+initialize_script = """
+import json, time
+import bmi_lstm
+t0 = time.perf_counter()
+model = bmi_lstm.bmi_LSTM()
+model.initialize({bmi_cfg_file!r})
+t1 = time.perf_counter()
+model = bmi_lstm.bmi_LSTM()
+model.initialize({bmi_cfg_file!r})
+t2 = time.perf_counter()
+model.update()
+t3 = time.perf_counter()
+print(json.dumps({{'first_initialize_time': t1 - t0,
+                  'second_initialize_time': t2 - t1,
+                  'first_update_time': t3 - t2}}))
+""".format(bmi_cfg_file=bmi_cfg_file)
+
+def run_python(script):
+    """Run a script in a fresh python process and return the json it prints last."""
+    output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+max_import_time = float(sys.argv[1]) if len(sys.argv) > 1 else None
+max_initialize_time = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+print("\nBMI LSTM STARTUP BENCHMARK\n**************************")
+results = run_python(import_script)
+results.update(run_python(initialize_script))
+
+print(" import bmi_lstm:          {:8.3f} s".format(results['import_time']))
+print(" heavy imports:            {}".format(', '.join(results['heavy_imports']) or 'none'))
+print(" first initialize():       {:8.3f} s".format(results['first_initialize_time']))
+print(" second initialize():      {:8.3f} s".format(results['second_initialize_time']))
+print(" first update():           {:8.3f} s".format(results['first_update_time']))
+
+failures = []
+if results['heavy_imports']:
+    failures.append('import bmi_lstm imported ' + ', '.join(results['heavy_imports']))
+if max_import_time is not None and results['import_time'] > max_import_time:
+    failures.append('import took longer than {} s'.format(max_import_time))
+if max_initialize_time is not None and results['first_initialize_time'] > max_initialize_time:
+    failures.append('first initialize() took longer than {} s'.format(max_initialize_time))
+
+for failure in failures:
+    print(" **REGRESSION** " + failure)
+sys.exit(1 if failures else 0)
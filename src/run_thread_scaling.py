@@ -0,0 +1,66 @@
+"""Speedup of stepping many single basin BMI LSTM instances from a thread pool, see ``lstm_thread_pool.py``.
+
+The first ``number_of_instances`` basins of ``data/camels_basin_list_516.txt`` are each run as their own instance, as
+a framework like NextGen runs one per catchment, with the forcings of ``data/usgs-streamflow-nldas_hourly.nc`` (its
+four basins stand in, in turn, for the others). They are stepped on 1, 2, 4, ... up to ``max_threads`` threads,
+each count with fresh instances, and the time, speedup over one thread and largest runoff difference from the one
+thread run are printed. Threads only speed the run up as far as the host has cores.
+
+To run, from the ``/src`` directory:
+    python ./run_thread_scaling.py [max_threads] [number_of_time_steps] [number_of_instances] [engine]
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import bmi_lstm
+import camels_bmi_configs
+import lstm_hindcast
+import lstm_thread_pool
+
+template_cfg_file = Path('../bmi_config_files/01022500_hourly_all_attributes_forcings.yml')
+sample_data_file = Path('../data/usgs-streamflow-nldas_hourly.nc')
+basin_list_file = Path('../data/camels_basin_list_516.txt')
+
+max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else max(os.cpu_count(), 4)
+n_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 24 * 7
+n_instances = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+engine = sys.argv[4] if len(sys.argv) > 4 else 'torch'
+
+template_cfg = bmi_lstm.read_bmi_config(template_cfg_file)
+basin_ids = camels_bmi_configs.read_basin_list(basin_list_file)[:n_instances]
+camels_attributes = camels_bmi_configs.read_camels_attributes()
+basin_cfgs = [dict(camels_bmi_configs.make_bmi_config(template_cfg, basin_id, camels_attributes), engine=engine)
+              for basin_id in basin_ids]
+bundle = bmi_lstm.load_model_bundle(template_cfg['train_cfg_file'])
+
+# Forcings with shape (time, basin, dynamic input)
+with lstm_hindcast.open_forcings(sample_data_file) as sample_data:
+    forcing_basin_ids = [basin_id if basin_id in sample_data.basin_ids
+                         else sample_data.basin_ids[i % len(sample_data.basin_ids)]
+                         for i, basin_id in enumerate(basin_ids)]
+    forcings = sample_data.read(bundle['cfg_train']['dynamic_inputs'], sample_data.basin_rows(forcing_basin_ids),
+                                0, n_steps)
+
+def make_models():
+    """Freshly initialized instances, one per basin, sharing the trained model bundle."""
+    models = []
+    for cfg in basin_cfgs:
+        model = bmi_lstm.bmi_LSTM()
+        model.initialize_from_config(cfg, model_bundle=bundle)
+        models.append(model)
+    return models
+
+thread_counts = [2**k for k in range(max_threads.bit_length()) if 2**k <= max_threads]
+results = lstm_thread_pool.thread_scaling(make_models, forcings, thread_counts)
+
+print("\nLSTM THREAD SCALING\n*******************")
+print(" instances: {}   time steps: {}   engine: {}   cores: {}".format(len(basin_ids), len(forcings), engine,
+                                                                      os.cpu_count()))
+print("\n {:>8s} {:>10s} {:>10s} {:>10s} {:>16s}".format('threads', 'intra-op', 'time (s)', 'speedup',
+                                                          'max diff (mm)'))
+for result in results:
+    print(" {:>8d} {:>10d} {:>10.3f} {:>10.2f} {:>16.3e}".format(result['n_threads'], result['intra_op_threads'],
+                                                                 result['time'], result['speedup'],
+                                                                 result['max_difference']))